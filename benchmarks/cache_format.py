@@ -0,0 +1,178 @@
+#! /usr/bin/python3
+
+#============================================================================
+# Compare the time it takes to load the cache in JSON and binary format.
+#
+# Builds a synthetic datastore (100 lights and 300 scenes by default),
+# writes it out as a cache in each format, and times a cold load of the
+# objects huemgr needs for scene commands: lights, groups, scenes and
+# every scene's attributes.
+#
+#   python3 benchmarks/cache_format.py [--lights N] [--scenes N] [--rounds N]
+#============================================================================
+
+from argparse import ArgumentParser
+import os
+import os.path
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from huectl.cache import HueCache
+
+def light_def(lightid):
+	return {
+		'state': {
+			'on': True, 'bri': 254, 'hue': 8418, 'sat': 140,
+			'effect': 'none', 'xy': [0.4573, 0.41], 'ct': 366,
+			'alert': 'select', 'colormode': 'ct', 'mode': 'homeautomation',
+			'reachable': True
+		},
+		'swupdate': { 'state': 'noupdates', 'lastinstall': '2020-01-01T00:00:00' },
+		'type': 'Extended color light',
+		'name': f'Light {lightid}',
+		'modelid': 'LCT016',
+		'manufacturername': 'Signify Netherlands B.V.',
+		'productname': 'Hue color lamp',
+		'capabilities': {
+			'certified': True,
+			'control': {
+				'mindimlevel': 1000, 'maxlumen': 800, 'colorgamuttype': 'C',
+				'colorgamut': [[0.6915, 0.3083], [0.17, 0.7], [0.1532, 0.0475]],
+				'ct': { 'min': 153, 'max': 500 }
+			},
+			'streaming': { 'renderer': True, 'proxy': True }
+		},
+		'config': { 'archetype': 'sultanbulb', 'function': 'mixed', 'direction': 'omnidirectional' },
+		'uniqueid': f'00:17:88:01:00:00:{lightid:04x}-0b',
+		'swversion': '1.50.2_r30933'
+	}
+
+def scene_def(sceneid, lights):
+	return {
+		'name': f'Scene {sceneid}',
+		'type': 'GroupScene',
+		'group': '1',
+		'lights': lights,
+		'owner': 'ffffffffe0341b1b376a2389376a2389',
+		'recycle': False,
+		'locked': False,
+		'appdata': { 'version': 1, 'data': 'xxxxx_r01_d01' },
+		'picture': '',
+		'lastupdated': '2020-01-01T00:00:00',
+		'version': 2
+	}
+
+def scene_attrs_def(sceneid, lights):
+	d= scene_def(sceneid, lights)
+	d['lightstates']= dict()
+	for lightid in lights:
+		d['lightstates'][lightid]= { 'on': True, 'bri': 200, 'xy': [0.4, 0.4] }
+
+	return d
+
+def build_datastore(nlights, nscenes, per_scene=10):
+	lights= dict()
+	for i in range(1, nlights+1):
+		lights[str(i)]= light_def(i)
+
+	groups= dict()
+	lightids= list(lights.keys())
+	for i in range(0, nlights, per_scene):
+		groupid= str(len(groups)+1)
+		groups[groupid]= {
+			'name': f'Room {groupid}',
+			'lights': lightids[i:i+per_scene],
+			'sensors': list(),
+			'type': 'Room', 'class': 'Living room',
+			'recycle': False,
+			'state': { 'all_on': True, 'any_on': True },
+			'action': light_def(0)['state']
+		}
+
+	scenes= dict()
+	scene_attrs= dict()
+	for i in range(nscenes):
+		sceneid= f'scene{i:011d}'
+		start= (i*per_scene) % max(1, nlights-per_scene)
+		members= lightids[start:start+per_scene]
+		scenes[sceneid]= scene_def(sceneid, members)
+		scene_attrs[sceneid]= scene_attrs_def(sceneid, members)
+
+	return {
+		'lights': lights,
+		'groups': groups,
+		'scenes': scenes,
+		'scene_attrs': scene_attrs
+	}
+
+def write_cache(path, datastore):
+	cache= HueCache(path)
+	cache.load()
+	cache.update({ k: v for k, v in datastore.items() if k != 'scene_attrs' })
+	cache.update_oid('scene_attrs', datastore['scene_attrs'])
+	cache.save()
+
+def time_load(path, rounds):
+	times= list()
+	for i in range(rounds):
+		t= time.perf_counter()
+		cache= HueCache(path)
+		cache.load()
+		cache.lights
+		cache.groups
+		cache.scenes
+		cache.scene_attrs
+		times.append(time.perf_counter() - t)
+
+	return times
+
+def time_save(path, datastore, rounds):
+	times= list()
+	for i in range(rounds):
+		shutil.rmtree(path, ignore_errors=True)
+		t= time.perf_counter()
+		write_cache(path, datastore)
+		times.append(time.perf_counter() - t)
+
+	return times
+
+def disk_size(path):
+	total= 0
+	for dirpath, dirnames, filenames in os.walk(path):
+		for name in filenames:
+			total+= os.path.getsize(os.path.join(dirpath, name))
+
+	return total
+
+def main():
+	parser= ArgumentParser(description='Compare JSON and binary cache load times')
+	parser.add_argument('--lights', type=int, default=100)
+	parser.add_argument('--scenes', type=int, default=300)
+	parser.add_argument('--rounds', type=int, default=20)
+	args= parser.parse_args()
+
+	datastore= build_datastore(args.lights, args.scenes)
+	tmpdir= tempfile.mkdtemp(prefix='huecache-bench')
+
+	try:
+		print(f'{args.lights} lights, {args.scenes} scenes, {args.rounds} rounds')
+		print(f'{"format":<8} {"load median":>12} {"load min":>10} {"save median":>12} {"size":>10}')
+
+		for fmt, name in (('json', 'huecache'), ('binary', 'huecache.bin')):
+			path= os.path.join(tmpdir, name)
+			save= time_save(path, datastore, max(1, args.rounds//4))
+			load= time_load(path, args.rounds)
+
+			print('{:<8} {:>10.2f}ms {:>8.2f}ms {:>10.2f}ms {:>9.1f}k'.format(fmt,
+				statistics.median(load)*1000, min(load)*1000,
+				statistics.median(save)*1000, disk_size(path)/1024))
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
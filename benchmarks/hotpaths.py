@@ -0,0 +1,297 @@
+#! /usr/bin/python3
+
+#============================================================================
+# Time huectl's hot paths: parsing object definitions, loading and saving
+# the cache, resolving collections, parsing time specs, and converting
+# and naming colors.
+#
+# Runs offline against synthetic datastores (see cache_format.py), at one
+# or more sizes. Objects are parsed with a HueBridge connected to a
+# HueEmulator, which is also used to time fetches through the bridge.
+# Results are written as JSON for tracking regressions between versions.
+#
+#   python3 benchmarks/hotpaths.py [--lights N ...] [--scenes N ...]
+#       [--rounds N] [--only NAME ...] [--output FILE]
+#============================================================================
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from huectl.bridge import HueBridge
+from huectl.emulator import HueEmulator
+from huectl.light import HueLight
+from huectl.group import HueGroup
+from huectl.scene import HueScene
+from huectl.cache import HueCache
+from huectl.time import parse_timespec
+import huectl.color as color
+import huectl.colorwheel as colorwheel
+from cache_format import build_datastore, write_cache
+
+# Time specs of every kind the bridge uses in schedules and rules
+TimeSpecs= (
+	'2020-01-01T10:00:00',
+	'2020-01-01T10:00:00A00:30:00',
+	'W124/T06:00:00',
+	'W127/T06:00:00A00:15:00',
+	'T06:00:00/T07:00:00',
+	'W127/T06:00:00/T07:00:00',
+	'PT00:10:00',
+	'PT00:10:00A00:01:00',
+	'R05/PT00:10:00',
+	'R/PT01:00:00'
+)
+
+# Number of colors to convert in each color benchmark
+Colors= 1000
+
+#----------------------------------------------------------------------------
+# Timing
+#----------------------------------------------------------------------------
+
+# Call fn rounds times. n is the number of items fn handles per call,
+# so results can be compared across sizes.
+
+def bench(fn, rounds, n=1, setup=None):
+	times= list()
+	for i in range(rounds):
+		if setup is not None:
+			setup()
+
+		t= time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - t)
+
+	median= statistics.median(times)
+
+	return {
+		'rounds': rounds,
+		'items': n,
+		'median': median,
+		'min': min(times),
+		'max': max(times),
+		'mean': statistics.mean(times),
+		'stdev': statistics.stdev(times) if rounds > 1 else 0.0,
+		'per_item': median/n if n else None
+	}
+
+#----------------------------------------------------------------------------
+# Benchmarks. Each returns a dict of { name: (fn, n, setup) }.
+#----------------------------------------------------------------------------
+
+def parse_benchmarks(bridge, ds):
+	lights= ds['lights']
+	groups= ds['groups']
+	scenes= ds['scene_attrs']
+
+	def parse_lights():
+		for lightid, data in lights.items():
+			HueLight.parse_definition(data, lightid=lightid, bridge=bridge)
+
+	def parse_groups():
+		for groupid, data in groups.items():
+			HueGroup.parse_definition(data, groupid=groupid, bridge=bridge)
+
+	def parse_scenes():
+		for sceneid, data in scenes.items():
+			HueScene.parse_definition(data, bridge=bridge, sceneid=sceneid)
+
+	return {
+		'light.parse_definition': (parse_lights, len(lights), None),
+		'group.parse_definition': (parse_groups, len(groups), None),
+		'scene.parse_definition': (parse_scenes, len(scenes), None)
+	}
+
+def cache_benchmarks(ds, tmpdir):
+	rv= dict()
+
+	for fmt, name in (('json', 'huecache'), ('binary', 'huecache.bin')):
+		path= os.path.join(tmpdir, name)
+
+		def save(path=path):
+			write_cache(path, ds)
+
+		def clear(path=path):
+			shutil.rmtree(path, ignore_errors=True)
+
+		def load(path=path):
+			cache= HueCache(path)
+			cache.load()
+			cache.lights
+			cache.groups
+			cache.scenes
+			cache.scene_attrs
+
+		n= len(ds['scenes'])
+		rv[f'cache.save.{fmt}']= (save, n, clear)
+		rv[f'cache.load.{fmt}']= (load, n, None)
+
+	return rv
+
+def resolve_benchmarks(bridge, ds):
+	lights= dict(map(lambda x: (x[0], HueLight.parse_definition(x[1],
+		lightid=x[0], bridge=bridge)), ds['lights'].items()))
+	scenes= list(map(lambda x: HueScene.parse_definition(x[1], bridge=bridge,
+		sceneid=x[0]), ds['scenes'].items()))
+
+	def resolve():
+		for scene in scenes:
+			scene.lights.resolve_items(lights, refresh=True)
+
+	return {
+		'collection.resolve_items': (resolve, len(scenes), None)
+	}
+
+def time_benchmarks():
+	specs= TimeSpecs*100
+
+	def parse():
+		for s in specs:
+			parse_timespec(s)
+
+	return {
+		'time.parse_timespec': (parse, len(specs), None)
+	}
+
+def color_benchmarks():
+	rnd= random.Random(1)
+	rgbs= list(map(lambda x: (rnd.random(), rnd.random(), rnd.random()),
+		range(Colors)))
+	hsbs= list(map(color.rgb_to_hsb, rgbs))
+	xyYs= list(map(color.rgb_to_xyY, rgbs))
+	xys= list(map(lambda x: (rnd.uniform(0.31, 0.53), rnd.uniform(0.32, 0.42)),
+		range(Colors)))
+	ccts= list(map(lambda x: rnd.uniform(2000, 6500), range(Colors)))
+
+	def each(fn, values):
+		def run():
+			for v in values:
+				fn(v)
+		return run
+
+	def colorname():
+		for h, s, b in hsbs:
+			colorwheel.colorname(h, s, b)
+
+	return {
+		'color.rgb_to_hsb': (each(color.rgb_to_hsb, rgbs), Colors, None),
+		'color.hsb_to_rgb': (each(color.hsb_to_rgb, hsbs), Colors, None),
+		'color.rgb_to_xyY': (each(color.rgb_to_xyY, rgbs), Colors, None),
+		'color.xyY_to_rgb': (each(color.xyY_to_rgb, xyYs), Colors, None),
+		'color.xy_to_cct': (each(color.xy_to_cct, xys), Colors, None),
+		'color.cct_to_xy': (each(color.cct_to_xy, ccts), Colors, None),
+		'colorwheel.colorname': (colorname, Colors, None)
+	}
+
+# Fetch and parse through the bridge, with no cache, so the emulator's
+# HTTP round trip is included.
+
+def bridge_benchmarks(bridge, ds):
+	sceneids= list(ds['scenes'].keys())[:50]
+
+	def get_scenes():
+		for sceneid in sceneids:
+			bridge.get_scene(sceneid)
+
+	return {
+		'bridge.get_all_lights': (bridge.get_all_lights, len(ds['lights']), None),
+		'bridge.get_all_scenes': (bridge.get_all_scenes, len(ds['scenes']), None),
+		'bridge.get_scene': (get_scenes, len(sceneids), None)
+	}
+
+#----------------------------------------------------------------------------
+# Run them all at one size
+#----------------------------------------------------------------------------
+
+def run_size(nlights, nscenes, rounds, only, tmpdir):
+	ds= build_datastore(nlights, nscenes)
+
+	emulator= HueEmulator({ k: v for k, v in ds.items() if k != 'scene_attrs' })
+	emulator.datastore['scenes']= ds['scene_attrs']
+	emulator.start()
+
+	results= dict()
+	try:
+		bridge= HueBridge(emulator.address, user_id=emulator.user_id,
+			proto='http')
+
+		benchmarks= dict()
+		benchmarks.update(parse_benchmarks(bridge, ds))
+		benchmarks.update(cache_benchmarks(ds, tmpdir))
+		benchmarks.update(resolve_benchmarks(bridge, ds))
+		benchmarks.update(time_benchmarks())
+		benchmarks.update(color_benchmarks())
+		benchmarks.update(bridge_benchmarks(bridge, ds))
+
+		for name, (fn, n, setup) in benchmarks.items():
+			if only and not any(map(lambda x: name.startswith(x), only)):
+				continue
+
+			results[name]= bench(fn, rounds, n, setup)
+			print(f'{nlights:>5} {nscenes:>5}  {name:<28} {results[name]["median"]*1000:>10.3f}ms',
+				file=sys.stderr)
+
+		bridge.close()
+	finally:
+		emulator.stop()
+
+	return results
+
+def main():
+	parser= ArgumentParser(description='Benchmark huectl hot paths')
+	parser.add_argument('--lights', type=int, nargs='+', default=[50, 500],
+		help='Number of lights, for each size')
+	parser.add_argument('--scenes', type=int, nargs='+', default=[100, 1000],
+		help='Number of scenes, for each size')
+	parser.add_argument('--rounds', type=int, default=10)
+	parser.add_argument('--only', nargs='+', metavar='NAME',
+		help='Only run benchmarks whose names start with NAME')
+	parser.add_argument('-o', '--output', metavar='FILE',
+		help='Write results to FILE instead of stdout')
+	args= parser.parse_args()
+
+	if len(args.lights) != len(args.scenes):
+		parser.error('--lights and --scenes need the same number of values')
+
+	report= {
+		'started': datetime.now(timezone.utc).isoformat(),
+		'python': platform.python_version(),
+		'implementation': platform.python_implementation(),
+		'platform': platform.platform(),
+		'rounds': args.rounds,
+		'sizes': list()
+	}
+
+	tmpdir= tempfile.mkdtemp(prefix='huectl-bench')
+	try:
+		for nlights, nscenes in zip(args.lights, args.scenes):
+			report['sizes'].append({
+				'lights': nlights,
+				'scenes': nscenes,
+				'results': run_size(nlights, nscenes, args.rounds, args.only,
+					tmpdir)
+			})
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	else:
+		with open(args.output, 'w') as fp:
+			json.dump(report, fp, indent=2)
+
+if __name__ == '__main__':
+	main()
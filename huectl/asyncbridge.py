@@ -0,0 +1,796 @@
+import aiohttp
+import asyncio
+import hashlib
+import json
+import ssl
+import threading
+import time
+import huectl.exception
+from huectl.bridge import HueBridge, HueBridgeConfiguration, HueDeviceScanResults
+from huectl.light import HueLightStateChange
+from huectl.group import HueGroupType, HueRoom
+from huectl.scene import HueScene
+from huectl.accessory import HueAccessory
+from huectl.time import HueDateTime
+from huectl.version import HueApiVersion
+from huectl.ratelimit import HueCommandScheduler
+from huectl.cache import HueObjectCache
+
+#============================================================================
+# An asyncio counterpart to HueBridge. The getters and state changes are
+# coroutines, and every call goes through a single aiohttp session so
+# connections are pooled. Several bridges can share one session (and thus
+# one connection pool) by passing it to connect().
+#
+# Objects are built by the same parse_definition factories that HueBridge
+# uses (and reused in the same way when object_cache is set), and are
+# bound to this bridge. Object methods that call back into the bridge
+# (e.g. HueLight.change_state) therefore return awaitables.
+#
+# Create bridges with connect(), not the constructor, since loading the
+# bridge configuration requires a call to the bridge:
+#
+#   bridge= await AsyncHueBridge.connect('10.0.0.1', user_id=user_id)
+#   lights= await bridge.get_all_lights()
+#
+# There is no HueCache support here. The cache file is designed around
+# short-lived processes like huemgr; long-running asyncio applications
+# should hold on to the objects they fetch instead.
+#
+# Every HueBridge method that talks to the bridge is overridden with a
+# coroutine, since the inherited ones would call call() without awaiting
+# it. The rest (api_version, name, the call hooks and so on) only look
+# at data we already have, and are inherited as they are.
+#============================================================================
+
+class AsyncHueBridge(HueBridge):
+	@classmethod
+	async def connect(cls, address, user_id=None, serial=None, session=None,
+		pool_size=None, timeout=None, proto=None, fingerprint=None,
+		scheduler=None, object_cache=False, metrics=None, profiler=None):
+
+		bridge= cls(address, session=session, pool_size=pool_size,
+			timeout=timeout, proto=proto, fingerprint=fingerprint,
+			scheduler=scheduler, object_cache=object_cache, metrics=metrics,
+			profiler=profiler)
+
+		# If we were sent a serial number, verify that we are talking to
+		# the correct bridge before we send a user id.
+
+		if serial is not None:
+			with bridge._phase('serial check'):
+				bserial= await bridge.serial_number()
+			if serial != bserial:
+				await bridge.close()
+				raise ValueError(f'Bridge serial number {bserial} does not match expected serial number {serial}')
+
+			bridge.config= None
+
+		if user_id is not None:
+			bridge.set_user_id(user_id)
+
+		with bridge._phase('load config'):
+			await bridge._load_config()
+
+		return bridge
+
+	# HueBridge.__init__ talks to the bridge, so it's deliberately not
+	# called here.
+
+	def __init__(self, address, session=None, pool_size=None, timeout=None,
+		proto=None, fingerprint=None, scheduler=None, object_cache=False,
+		metrics=None, profiler=None):
+		self.user_id= '0'
+		self.address= address
+		self.config= None
+		self.proto= None
+		self.fingerprint= None
+		self.cache= None
+		self._exit_hook= None
+		self.objects= HueObjectCache() if object_cache else None
+		self.refresh= HueBridge.CacheRefreshInterval
+		self.short_refresh= HueBridge.ShortCacheRefreshInterval
+		self.long_refresh= HueBridge.LongCacheRefreshInterval
+		self.adaptive_ttl= False
+
+		# Nothing is ever refreshed in the background, but wait_refresh
+		# is inherited.
+		self.max_stale= None
+		self.refresh_errors= list()
+		self._refreshing= dict()
+		self._refresh_lock= threading.Lock()
+
+		if scheduler is None:
+			scheduler= HueCommandScheduler()
+		self.scheduler= scheduler
+
+		self.call_hooks= list()
+		if metrics is not None:
+			metrics.attach(self)
+
+		self.profiler= profiler
+		if profiler is not None:
+			profiler.attach(self)
+
+		if pool_size is None:
+			pool_size= HueBridge.PoolSize
+		if timeout is None:
+			timeout= HueBridge.Timeout
+
+		if isinstance(timeout, tuple):
+			connect, read= timeout
+		else:
+			connect= read= timeout
+
+		self.pool_size= pool_size
+		self.timeout= aiohttp.ClientTimeout(sock_connect=connect,
+			sock_read=read)
+
+		# Only close the session if we created it
+		self.session= session
+		self._own_session= session is None
+
+		self.reprobe= False
+		if proto is not None:
+			self.reprobe= True
+			self._set_protocol(proto, fingerprint)
+
+	# The session is created on first use so that it's bound to the
+	# running event loop.
+
+	def _session(self):
+		if self.session is None:
+			connector= aiohttp.TCPConnector(limit=self.pool_size)
+			self.session= aiohttp.ClientSession(connector=connector)
+
+		return self.session
+
+	async def close(self):
+		if self._own_session and self.session is not None:
+			await self.session.close()
+			self.session= None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *args):
+		await self.close()
+
+	#------------------------------------------------------------
+	# High level functions
+	#------------------------------------------------------------
+
+	async def serial_number(self):
+		await self._load_config()
+		return self.config.mac.replace(':', '')
+
+	async def userlist(self):
+		await self._load_config()
+		return self.config.userlist
+
+	async def recall_scene(self, sceneid):
+		scene= await self.get_scene(sceneid)
+
+		# No group id means we use group 0
+		groupid= scene.group
+		if groupid is None:
+			groupid= 0
+
+		await self.scheduler.acquire_async(HueCommandScheduler.Group)
+		rv= await self.call(f'groups/{groupid}/action', method='PUT',
+			data={ 'scene': sceneid })
+
+		if not isinstance(rv, list):
+			raise huectl.exception.BadResponse(rv)
+
+		if len(rv) != 1:
+			raise huectl.exception.BadResponse(rv)
+
+		if 'success' not in rv[0]:
+			raise huectl.exception.BadResponse(rv)
+
+		return True
+
+	async def get_all_accessories(self, sensors=None):
+		if sensors is None:
+			sensors= await self.get_all_sensors()
+
+		return HueAccessory.collate(sensors)
+
+	async def timezones(self):
+		if self.api_version() > '1.15':
+			return await self.call('info/timezones')
+		else:
+			return await self.call('capabilities/timezones')
+
+	async def rename(self, newname):
+		await self.modify_configuration(name=newname)
+
+	async def touchlink(self):
+		await self.modify_configuration(touchlink=True)
+
+	async def capture_scene(self, name, groupscene=None, lightids=None):
+		if not isinstance(name, str):
+			raise TypeError('Expected str not '+str(type(name)))
+
+		if groupscene is not None:
+			if lightids is not None:
+				raise huectl.exception.InvalidOperation("Can't mix groupscene with other parameters")
+
+			scene= HueScene(self, name=name, groupid=str(groupscene))
+		else:
+			scene= HueScene(self, name=name)
+			scene.lights.update_fromkeys(lightids)
+
+		rv= await self.call('scenes', method='POST', data=scene.definition())
+
+		return _check_success(rv)['id']
+
+	# There's no cache to update, so these just fetch from the bridge
+
+	async def fetch(self, oclass, oid=None):
+		if oid is None:
+			return await self.call(oclass)
+
+		return await self.call(f'{oclass}/{oid}')
+
+	async def refresh_all(self):
+		data= await self.call(None)
+
+		if 'config' in data:
+			self.config= HueBridgeConfiguration(data['config'])
+
+		return data
+
+	async def prefetch(self, *oclasses):
+		return False
+
+	#------------------------------------------------------------
+	# Bridge API
+	#------------------------------------------------------------
+
+	async def _load_config(self):
+		if self.config is None:
+			self.config= await self.get_configuration()
+
+	# Groups
+	#--------------------
+
+	async def get_group(self, groupid, raw=False, lights=None, sensors=None):
+		data= await self.call(f'groups/{groupid}', raw=raw)
+		if raw:
+			return data
+
+		group= self._build('groups', str(groupid), data)
+		if lights:
+			group.lights.resolve_items(lights, refresh=True)
+		if sensors:
+			group.sensors.resolve_items(sensors, refresh=True)
+
+		return group
+
+	async def get_all_groups(self, raw=False, lights=None, sensors=None):
+		data= await self.call('groups', raw=raw)
+		if raw:
+			return data
+
+		groups= dict()
+		for groupid, groupdata in data.items():
+			group= self._build('groups', groupid, groupdata)
+
+			if lights:
+				group.lights.resolve_items(lights, refresh=True)
+			if sensors:
+				group.sensors.resolve_items(sensors, refresh=True)
+
+			groups[groupid]= group
+
+		self._prune('groups', groups.keys())
+
+		return groups
+
+	async def set_group_attributes(self, groupid, **kwargs):
+		if str(groupid) == '0':
+			raise huectl.exception.InvalidOperation('set_group_attribute', 'group 0')
+
+		attrs= dict()
+		for attr in ('name', 'class', 'lights'):
+			if attr in kwargs:
+				attrs[attr]= kwargs[attr]
+
+		rv= await self.call(f'groups/{groupid}', method='PUT', data=attrs)
+		_check_response(rv)
+
+		return True
+
+	async def create_group(self, groupdef):
+		if not isinstance(groupdef, dict):
+			raise TypeError('groupdef: expected dict not '+str(type(groupdef)))
+
+		apiver= self.api_version()
+
+		if 'type' in groupdef:
+			if apiver < '1.4':
+				raise huectl.exception.APIVersion(need='1.4', have=apiver)
+
+			gtype= groupdef['type']
+			if not HueGroupType.usertype(gtype):
+				raise huectl.exception.InvalidOperation(f"{gtype}: not a user group type")
+
+			if not HueGroupType.supported(gtype, apiver):
+				raise huectl.exception.APIVersion(have=apiver)
+
+		if 'class' in groupdef:
+			if apiver < '1.11':
+				raise huectl.exception.APIVersion(need='1.11', have=apiver)
+
+			if not HueRoom.supported(groupdef['class'], apiver):
+				raise huectl.exception.APIVersion(have=apiver)
+
+		if 'sensors' in groupdef and apiver < '1.27':
+			raise huectl.exception.APIVersion(need='1.27', have=apiver)
+
+		rv= await self.call('groups', method='POST', data=groupdef)
+
+		return _check_success(rv)['id']
+
+	async def delete_group(self, groupid):
+		rv= await self.call(f'groups/{groupid}', method='DELETE')
+		_check_success(rv)
+
+	async def set_group_states(self, changes):
+		return await self._fanout(self.set_group_state, changes)
+
+	async def set_group_state(self, groupid, state):
+		await self.scheduler.acquire_async(HueCommandScheduler.Group)
+		rv= await self.call(f'groups/{groupid}/action', method='PUT', data=state)
+		_check_response(rv)
+
+		return True
+
+	# Lights
+	#--------------------
+
+	async def get_light(self, lightid, raw=False):
+		data= await self.call(f'lights/{lightid}', raw=raw)
+		if raw:
+			return data
+
+		return self._build('lights', lightid, data)
+
+	async def get_all_lights(self, raw=False):
+		data= await self.call('lights', raw=raw)
+		if raw:
+			return data
+
+		lights= dict()
+		for lightid, lightdata in data.items():
+			lights[lightid]= self._build('lights', lightid, lightdata)
+
+		self._prune('lights', lights.keys())
+
+		return lights
+
+	async def set_light_attributes(self, lightid, **kwargs):
+		attrs= dict()
+		if 'name' in kwargs:
+			attrs['name']= kwargs['name']
+
+		rv= await self.call(f'lights/{lightid}', method='PUT', data=attrs)
+		_check_response(rv)
+
+		return True
+
+	async def set_light_states(self, changes):
+		return await self._fanout(self.set_light_state, changes)
+
+	async def set_light_state(self, lightid, state):
+		await self.scheduler.acquire_async(HueCommandScheduler.Light)
+		rv= await self.call(f'lights/{lightid}/state', method='PUT', data=state)
+		_check_response(rv)
+
+		return True
+
+	async def init_light_search(self, serial):
+		if not isinstance(serial, list):
+			raise TypeError('serial: expected list not '+str(type(serial)))
+
+		if len(serial) > 10:
+			raise ValueError('serial: maximum of 10 serial numbers per search')
+		elif len(serial):
+			searchdata= { 'deviceid': serial }
+		else:
+			searchdata= None
+
+		rv= await self.call('lights', method='POST', data=searchdata)
+		_check_success(rv)
+
+		return HueDeviceScanResults(self)
+
+	async def get_new_lights(self, scanresults):
+		if not isinstance(scanresults, HueDeviceScanResults):
+			raise TypeError('scanresults: expected HueDeviceScanResults not '+str(type(scanresults)))
+
+		data= await self.call('lights/new')
+
+		if 'lastscan' in data:
+			if data['lastscan'] == 'none':
+				scanresults.active= False
+			elif data['lastscan'] == 'active':
+				scanresults.active= True
+			else:
+				scanresults.active= False
+				scanresults.lastscan= HueDateTime(data['lastscan'])
+
+	# Send several state changes at once, as HueBridge.set_light_states
+	# does. The scheduler still paces them.
+
+	async def _fanout(self, func, changes):
+		targetids= list(changes.keys())
+		states= list()
+		for state in changes.values():
+			if isinstance(state, HueLightStateChange):
+				state= state.definition()
+			states.append(state)
+
+		rv= await asyncio.gather(*map(func, targetids, states),
+			return_exceptions=True)
+
+		return dict(zip(targetids, rv))
+
+	# Scenes
+	#--------------------
+
+	async def get_all_scenes(self, raw=False, lights=None):
+		if self.api_version() < HueApiVersion('1.1'):
+			raise huectl.exception.APIVersion(have=str(self.api_version()), need='1.1')
+
+		data= await self.call('scenes', raw=raw)
+		if raw:
+			return data
+
+		scenes= dict()
+		for sceneid, scenedata in data.items():
+			scene= self._build('scenes', sceneid, scenedata)
+			if lights is not None:
+				scene.lights.resolve_items(lights, refresh=True)
+			scenes[sceneid]= scene
+
+		self._prune('scenes', scenes.keys())
+		self._prune('scene_attrs', scenes.keys())
+
+		return scenes
+
+	async def get_scene(self, sceneid, raw=False, lights=None):
+		data= await self.call(f'scenes/{sceneid}', raw=raw)
+		if raw:
+			return data
+
+		scene= self._build('scene_attrs', sceneid, data)
+		if lights is not None:
+			scene.lights.resolve_items(lights, refresh=True)
+
+		return scene
+
+	async def delete_scene(self, sceneid):
+		rv= await self.call(f'scenes/{sceneid}', method='DELETE')
+		_check_success(rv)
+
+		return True
+
+	async def modify_scene(self, scenedef, sceneid):
+		if not isinstance(scenedef, dict):
+			raise TypeError('scenedef: expected dict, not '+str(type(scenedef)))
+
+		if not isinstance(sceneid, str):
+			raise TypeError('sceneid: expected str, not '+str(type(sceneid)))
+
+		self._scene_api_version_check(scenedef)
+
+		rv= await self.call(f'scenes/{sceneid}', method='PUT', data=scenedef)
+		_check_success(rv, single=False)
+
+	async def create_scene(self, scenedef, sceneid=None):
+		if not isinstance(scenedef, dict):
+			raise TypeError('scenedef: expected dict, not '+str(type(scenedef)))
+
+		self._scene_api_version_check(scenedef)
+
+		uri= 'scenes'
+		if sceneid is not None:
+			uri= f'scenes/{sceneid}'
+
+		rv= await self.call(uri, method='POST', data=scenedef)
+
+		return _check_success(rv, single=False)['id']
+
+	# Rules
+	#--------------------
+
+	async def get_rule(self, ruleid, raw=False):
+		data= await self.call(f'rules/{ruleid}', raw=raw)
+		if raw:
+			return data
+
+		return self._build('rules', ruleid, data)
+
+	async def get_all_rules(self, raw=False):
+		data= await self.call('rules', raw=raw)
+		if raw:
+			return data
+
+		rules= dict()
+		for ruleid, ruledata in data.items():
+			rules[ruleid]= self._build('rules', ruleid, ruledata)
+
+		self._prune('rules', rules.keys())
+
+		return rules
+
+	# Schedules
+	#--------------------
+
+	async def get_schedule(self, scheduleid, raw=False):
+		data= await self.call(f'schedules/{scheduleid}', raw=raw)
+		if raw:
+			return data
+
+		return self._build('schedules', scheduleid, data)
+
+	async def get_all_schedules(self, raw=False):
+		data= await self.call('schedules', raw=raw)
+		if raw:
+			return data
+
+		schedules= dict()
+		for scheduleid, scheduledata in data.items():
+			schedules[scheduleid]= self._build('schedules', scheduleid,
+				scheduledata)
+
+		self._prune('schedules', schedules.keys())
+
+		return schedules
+
+	async def delete_schedule(self, scheduleid):
+		rv= await self.call(f'schedules/{scheduleid}', method='DELETE')
+		_check_success(rv)
+
+		return True
+
+	# Sensors
+	#--------------------
+
+	async def get_sensor(self, sensorid, raw=False):
+		data= await self.call(f'sensors/{sensorid}', raw=raw)
+		if raw:
+			return data
+
+		return self._build('sensors', sensorid, data)
+
+	async def get_all_sensors(self, raw=False):
+		data= await self.call('sensors', raw=raw)
+		if raw:
+			return data
+
+		sensors= dict()
+		for sensorid, sensordata in data.items():
+			sensors[sensorid]= self._build('sensors', sensorid, sensordata)
+
+		self._prune('sensors', sensors.keys())
+
+		return sensors
+
+	# Configuration
+	#--------------------
+
+	async def get_configuration(self, raw=False):
+		data= await self.call('config', raw=raw)
+		if raw:
+			return data
+
+		self.config= HueBridgeConfiguration(data)
+
+		return self.config
+
+	async def modify_configuration(self, **kwargs):
+		timezones= None
+		if 'timezone' in kwargs:
+			timezones= await self.timezones()
+
+		data= self._configuration_changes(kwargs, timezones)
+		rv= await self.call('config', method='PUT', data=data)
+		_check_success(rv, single=False)
+
+	async def create_user(self, appname='Python', device='CLI', client_key=None):
+		data= {
+			'devicetype': '#'.join([appname, device])
+		}
+		if client_key is not None:
+			data['generate clientkey']= client_key
+
+		rv= await self.call('/api', full_uri=True, method='POST', data=data)
+
+		success= _check_success(rv)
+		if 'username' not in success:
+			raise huectl.exception.BadResponse(json.dumps(rv))
+
+		return success['username']
+
+	async def get_datastore(self):
+		return await self.call(None, raw=True)
+
+	# Resourcelinks
+	#--------------------
+
+	async def get_all_resourcelinks(self, raw=False):
+		data= await self.call('resourcelinks', raw=raw)
+		if raw:
+			return data
+
+		raise NotImplementedError
+
+	async def get_resourcelink(self, reslinkid, raw=False):
+		data= await self.call(f'resourcelinks/{reslinkid}', raw=raw)
+		if raw:
+			return data
+
+		raise NotImplementedError
+
+	# Internal calls
+	#--------------------
+
+	# Open a TLS connection to the bridge. If that works, use https and
+	# remember the certificate fingerprint. If not, fall back to http.
+
+	async def determine_protocol(self):
+		try:
+			fingerprint= await self._tls_fingerprint()
+		except (OSError, asyncio.TimeoutError):
+			self._set_protocol('http')
+			return
+
+		self._set_protocol('https', fingerprint)
+
+	def _set_protocol(self, proto, fingerprint=None):
+		if proto not in ('http', 'https'):
+			raise ValueError(f'proto: expected http or https not {proto}')
+
+		self.proto= proto
+		if proto == 'https':
+			self.fingerprint= fingerprint
+		else:
+			self.fingerprint= None
+
+	async def _tls_fingerprint(self):
+		ctx= ssl.create_default_context()
+		ctx.check_hostname= False
+		ctx.verify_mode= ssl.CERT_NONE
+
+		reader, writer= await asyncio.wait_for(
+			asyncio.open_connection(self.address, 443, ssl=ctx),
+			self.timeout.sock_connect)
+
+		try:
+			cert= writer.get_extra_info('ssl_object').getpeercert(binary_form=True)
+		finally:
+			writer.close()
+
+		return hashlib.sha256(cert).hexdigest()
+
+	# TLS settings for a request. The bridge uses a self-signed
+	# certificate, so pin it if we know its fingerprint.
+
+	def _ssl(self):
+		if self.proto != 'https':
+			return None
+
+		if self.fingerprint is None:
+			return False
+
+		return aiohttp.Fingerprint(bytes.fromhex(self.fingerprint))
+
+	# Raw HTTP calls
+	#--------------------
+
+	# Call hooks are run as they are for HueBridge.call
+
+	async def call(self, endpoint, full_uri=False, method='GET', data=None, raw=False,
+		sample=None):
+		if sample is None:
+			sample= dict()
+
+		if not len(self.call_hooks):
+			return await self._call(endpoint, full_uri, method, data, raw, sample)
+
+		t= time.perf_counter()
+		try:
+			return await self._call(endpoint, full_uri, method, data, raw, sample)
+		finally:
+			self._run_call_hooks(endpoint, method, sample,
+				time.perf_counter() - t)
+
+	async def _call(self, endpoint, full_uri, method, data, raw, sample):
+		if self.proto is None:
+			with self._phase('protocol probe'):
+				await self.determine_protocol()
+
+		try:
+			status, reply= await self._request(endpoint, full_uri, method, data)
+		except (aiohttp.ServerFingerprintMismatch, aiohttp.ClientSSLError):
+			raise
+		except aiohttp.ClientConnectionError:
+			# We were handed a saved protocol that may no longer be
+			# right. Probe the bridge once and try again.
+			if not self.reprobe:
+				raise
+
+			self.reprobe= False
+			with self._phase('protocol probe'):
+				await self.determine_protocol()
+			status, reply= await self._request(endpoint, full_uri, method, data)
+
+		sample['status']= status
+		if status != 200:
+			raise huectl.exception.BadHTTPResponse(status)
+
+		sample['bytes']= len(reply)
+		if raw:
+			return reply
+
+		t= time.perf_counter()
+		try:
+			obj= json.loads(reply)
+
+			if isinstance(obj, list):
+				for item in obj:
+					if 'error' in item:
+						self._error(item['error'])
+		finally:
+			sample['parse_time']= time.perf_counter() - t
+
+		return obj
+
+	async def _request(self, endpoint, full_uri, method, data):
+		kwargs= dict()
+		if data is not None:
+			kwargs['data']= bytes(json.dumps(data), 'utf-8')
+
+		url= self._url(endpoint, full_uri)
+
+		async with self._session().request(method, url, ssl=self._ssl(),
+			timeout=self.timeout, **kwargs) as response:
+
+			return response.status, await response.text()
+
+# Check the response to a PUT for errors
+
+def _check_response(rv):
+	if not isinstance(rv, list):
+		raise huectl.exception.BadResponse(rv)
+
+	if not len(rv):
+		raise huectl.exception.BadResponse(rv)
+
+	errors= []
+	for elem in rv:
+		if 'error' in elem:
+			errors.append(elem['error']['address'])
+
+	if len(errors):
+		raise huectl.exception.AttrsNotSet(errors)
+
+# Check the response to a POST, DELETE or anything else that answers with
+# a single success, and return it. Some answer with one entry per
+# attribute, so only the first is checked unless single is set.
+
+def _check_success(rv, single=True):
+	if not isinstance(rv, list):
+		raise huectl.exception.BadResponse(rv)
+
+	if not len(rv) or (single and len(rv) != 1):
+		raise huectl.exception.BadResponse(rv)
+
+	if 'success' not in rv[0]:
+		raise huectl.exception.BadResponse(rv)
+
+	return rv[0]['success']
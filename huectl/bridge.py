@@ -1,13 +1,22 @@
 import urllib3
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import hashlib
 import ssdp
 import asyncio
+import atexit
+from contextlib import nullcontext
+from functools import partial
 import huectl.exception
 import socket
 import ssl
+import threading
+import time
+import weakref
 import xml.etree.ElementTree as ET
-from huectl.light import HueLight
+from concurrent.futures import ThreadPoolExecutor
+from huectl.light import HueLight, HueLightStateChange
 from huectl.group import HueGroup, HueGroupType
 from huectl.scene import HueScene
 from huectl.accessory import HueAccessory
@@ -16,7 +25,9 @@ from huectl.schedule import HueSchedule
 from huectl.time import HueDateTime
 from huectl.version import HueApiVersion
 from huectl.rule import HueRule
-from huectl.cache import HueCache
+from huectl.cache import HueCache, HueObjectCache
+from huectl.ratelimit import HueCommandScheduler
+from huectl.transport import HueTransport
 
 class HueBridgeConfiguration:
 	def __init__(self, data):
@@ -127,6 +138,20 @@ class HueBridgeUserlist:
 		for user in self._users.values():
 			yield user
 
+# An HTTP adapter that can pin the bridge's self-signed TLS certificate
+# to a known SHA-256 fingerprint.
+
+class HueHTTPAdapter(HTTPAdapter):
+	def __init__(self, fingerprint=None, **kwargs):
+		# Must be set before the parent constructor creates the pool
+		self.fingerprint= fingerprint
+		super().__init__(**kwargs)
+
+	def init_poolmanager(self, *args, **kwargs):
+		if self.fingerprint is not None:
+			kwargs['assert_fingerprint']= self.fingerprint
+		super().init_poolmanager(*args, **kwargs)
+
 class HueDeviceScanResults():
 	def __init__(self, bridge):
 		self.bridge= bridge
@@ -193,21 +218,150 @@ class HueBridge:
 	# succession.
 	ShortCacheRefreshInterval= 5
 
-	def __init__(self, address, user_id=None, serial=None, cache_file=None):
+	# How often to refresh the bridge configuration and resourcelinks in
+	# the cache (in seconds). These rarely change, and the configuration
+	# is read every time we connect.
+	LongCacheRefreshInterval= 60
+
+	# The maximum number of keep-alive connections held open to the
+	# bridge. The bridge is a small embedded device that only handles a
+	# handful of simultaneous connections, so keep this modest. Threads
+	# that need a connection when the pool is exhausted wait for one to
+	# be returned rather than opening a new one.
+	PoolSize= 10
+
+	# Request timeouts in seconds, as a (connect, read) tuple.
+	Timeout= (5, 30)
+
+	# The maximum number of commands that set_light_states and
+	# set_group_states have in flight at once. This is capped by the
+	# connection pool size, and the commands are still paced by the
+	# scheduler.
+	FanoutWorkers= 8
+
+	# Object classes that are returned in the full datastore
+	DatastoreObjs= ('lights', 'groups', 'scenes', 'sensors', 'rules',
+		'schedules', 'config', 'resourcelinks')
+
+	# Object classes that use the short cache refresh interval
+	ShortRefreshObjs= ('lights', 'sensors')
+
+	# Object classes that use the long cache refresh interval
+	LongRefreshObjs= ('config', 'resourcelinks')
+
+	# (min, max) TTLs, in seconds, for object classes whose cache
+	# lifetimes are learned from how often they change. The configuration
+	# has the bridge's clock in it, so it changes every time.
+	AdaptiveTTLBounds= {
+		'lights': (5, 60),
+		'sensors': (5, 60),
+		'groups': (5, 120),
+		'scenes': (10, 600),
+		'rules': (10, 600),
+		'schedules': (10, 600),
+		'resourcelinks': (60, 3600)
+	}
+
+	# The most stale objects in a class that are fetched one at a time
+	# before it's cheaper to fetch the whole class.
+	MaxOidRefresh= 4
+
+	# The color mode a light is left in by setting each color attribute.
+	# Used when writing state changes through to the cache.
+	ColorModes= { 'xy': 'xy', 'ct': 'ct', 'hue': 'hs', 'sat': 'hs' }
+
+	def __init__(self, address, user_id=None, serial=None, cache_file=None,
+		pool_size=None, timeout=None, proto=None, fingerprint=None,
+		scheduler=None, object_cache=False, max_stale=None,
+		adaptive_ttl=False, metrics=None, profiler=None, transport=None):
 		self.user_id= '0'
 		self.address= address
 		self.config= None
 		self.proto= None
+		self.fingerprint= None
 		self.request_defaults= dict()
 		self.cache= None
+		self._exit_hook= None
+
+		# Keep the objects we build and reuse them while their data
+		# doesn't change. Worthwhile for processes that poll the bridge.
+		self.objects= HueObjectCache() if object_cache else None
 		self.refresh= HueBridge.CacheRefreshInterval
 		self.short_refresh= HueBridge.ShortCacheRefreshInterval
+		self.long_refresh= HueBridge.LongCacheRefreshInterval
+
+		# Learn cache lifetimes from how often objects change. This can
+		# be True, or a dict of bounds that overrides AdaptiveTTLBounds.
+		self.adaptive_ttl= adaptive_ttl
+
+		# If set, cached objects that have expired are still returned for
+		# up to max_stale seconds, and refreshed in the background.
+		self.max_stale= max_stale
+		self.refresh_errors= list()
+		self._refreshing= dict()
+		self._refresh_lock= threading.Lock()
+
+		# Light and group state changes are paced so we don't flood the
+		# ZigBee network.
+		if scheduler is None:
+			scheduler= HueCommandScheduler()
+		self.scheduler= scheduler
+
+		# Functions run after every call to the bridge, e.g. to record
+		# metrics (see huectl.metrics.HueMetrics).
+		self.call_hooks= list()
+		if metrics is not None:
+			metrics.attach(self)
+
+		# Time spent in each phase of startup and in network calls (see
+		# huectl.profiler.HueProfiler)
+		self.profiler= profiler
+		if profiler is not None:
+			profiler.attach(self)
+
+		if pool_size is None:
+			pool_size= HueBridge.PoolSize
+		if timeout is None:
+			timeout= HueBridge.Timeout
+
+		# All calls, from all threads, share one session so that
+		# connections to the bridge are pooled and kept alive instead
+		# of being set up and torn down on every request.
+
+		self.session= requests.Session()
+		self.pool_size= pool_size
+
+		# How requests are sent. Can record or replay traffic (see
+		# huectl.transport).
+		if transport is None:
+			transport= HueTransport()
+		self.transport= transport
+		self.request_defaults['timeout']= timeout
+
+		# If the caller remembers how we talked to this bridge last time,
+		# skip the protocol probe. We'll probe again if a call can't
+		# connect.
+
+		self.reprobe= False
+		if proto is not None:
+			self.reprobe= True
+			self._set_protocol(proto, fingerprint)
+		else:
+			self._mount_adapters()
+
+		# A pinned certificate already proves we're talking to the bridge
+		# we saw last time, so the serial number can be checked against
+		# the full configuration below instead of making a separate call.
+
+		pinned= self.proto == 'https' and self.fingerprint is not None
 
 		# If we were sent a serial number, verify that we are talking to the
 		# correct bridge before we send a user id.
 
-		if serial is not None:
-			bserial= self.serial_number()
+		checked= serial is not None and not pinned
+		if checked:
+			with self._phase('serial check'):
+				bserial= self.serial_number()
 			if serial != bserial:
 				raise ValueError(f'Bridge serial number {bserial} does not match expected serial number {serial}')
 
@@ -219,15 +373,81 @@ class HueBridge:
 		if user_id is not None:
 			self.set_user_id(user_id)
 
-		self._load_config()
+		# Load the cache first so the configuration can come from it
 
 		if cache_file is not None:
 			self.cache= HueCache(cache_file)
-			self.cache.load()
+			with self._phase('cache load'):
+				self.cache.load()
+			self.set_cache_refresh(self.refresh, self.short_refresh)
+
+			# The objects we build refer back to us, so we may not be
+			# garbage collected before the interpreter shuts down, by
+			# which time it's too late to save the cache. Save it at
+			# exit if close() hasn't been called by then.
+			self._exit_hook= partial(_save_at_exit, weakref.ref(self))
+			atexit.register(self._exit_hook)
+
+		# Once the serial number check has reached the bridge, the full
+		# configuration can come from the cache, as long as it's current
+		# and it's for the same bridge. Otherwise always ask the bridge,
+		# since it's how we find out that the bridge is still at this
+		# address (and, with a pinned certificate, that it's the one we
+		# expect).
+
+		with self._phase('load config'):
+			if checked:
+				self.get_configuration()
+				if self.cache and self.serial_number() != serial:
+					self.cache.mark_dirty('config')
+					self.get_configuration()
+			else:
+				self.get_configuration(refresh=True)
+
+		if serial is not None and pinned:
+			with self._phase('serial check'):
+				bserial= self.serial_number()
+			if serial != bserial:
+				raise ValueError(f'Bridge serial number {bserial} does not match expected serial number {serial}')
 		
+	# __init__ may not have got as far as setting _exit_hook
+
 	def __del__(self):
+		if getattr(self, '_exit_hook', None) is not None:
+			self._detach()
+			self.save_cache()
+
+	# Write the cache back, if anything in it changed. close() does this,
+	# as does garbage collection or interpreter exit for bridges that
+	# aren't closed.
+
+	def save_cache(self):
 		if self.cache:
-			self.cache.save()
+			with self._phase('cache save'):
+				self.cache.save()
+
+	def _detach(self):
+		atexit.unregister(self._exit_hook)
+		self._exit_hook= None
+
+	# Time a phase of work if we have a profiler
+
+	def _phase(self, name):
+		if self.profiler is None:
+			return nullcontext()
+
+		return self.profiler.phase(name)
+
+	# Save the cache and close any pooled connections to the bridge
+
+	def close(self):
+		self.wait_refresh()
+		if self._exit_hook is not None:
+			self._detach()
+			self.save_cache()
+
+		self.transport.close()
+		self.session.close()
 
 	def set_user_id(self, user_id):
 		self.user_id= user_id
@@ -284,6 +504,7 @@ class HueBridge:
 			'scene': sceneid
 		}
 
+		self.scheduler.acquire(HueCommandScheduler.Group)
 		rv= self.call(f'groups/{groupid}/action', method='PUT', data=data)
 		if not isinstance(rv, list):
 			raise huectl.exception.BadResponse(rv)
@@ -291,9 +512,12 @@ class HueBridge:
 		if len(rv) != 1:
 			raise huectl.exception.BadResponse(rv)
 
-		if 'success' not in rv:
+		if 'success' not in rv[0]:
 			raise huectl.exception.BadResponse(rv)
 
+		if self.cache:
+			self._write_through_group(str(groupid), rv)
+
 		return True
 
 	# Capture current light states into a scene
@@ -328,6 +552,9 @@ class HueBridge:
 		if 'success' not in rv[0]:
 			raise huectl.exception.BadResponse(rv)
 
+		if self.cache:
+			self.cache.mark_dirty('scenes')
+
 		return rv[0]['success']['id']
 
 	# Perform a touchlink operation. This addes the closest
@@ -350,13 +577,344 @@ class HueBridge:
 
 		return accessories
 
-	def cache_ok(self, oclass, short=False):
+	# The number of light and/or group commands waiting to be sent, and
+	# how long a new one would have to wait. See HueCommandScheduler.
+
+	def queue_depth(self, kind=None):
+		return self.scheduler.queue_depth(kind)
+
+	def command_wait_time(self, kind):
+		return self.scheduler.wait_time(kind)
+
+	# Set the cache lifetimes for the object classes that use the normal
+	# and short refresh intervals.
+
+	def set_cache_refresh(self, refresh, short_refresh, long_refresh=None):
+		self.refresh= refresh
+		self.short_refresh= short_refresh
+		if long_refresh is not None:
+			self.long_refresh= long_refresh
+
+		if not self.cache:
+			return
+
+		for oclass in HueCache.ValidObjs:
+			if oclass in HueBridge.ShortRefreshObjs:
+				self.cache.set_ttl(oclass, short_refresh)
+			elif oclass in HueBridge.LongRefreshObjs:
+				self.cache.set_ttl(oclass, self.long_refresh)
+			else:
+				self.cache.set_ttl(oclass, refresh)
+
+		if self.adaptive_ttl:
+			bounds= dict(HueBridge.AdaptiveTTLBounds)
+			if isinstance(self.adaptive_ttl, dict):
+				bounds.update(self.adaptive_ttl)
+
+			for oclass, (min_ttl, max_ttl) in bounds.items():
+				self.cache.set_adaptive_ttl(oclass, min_ttl, max_ttl)
+
+	# Is the cache current for a class, or for one object in it?
+
+	def cache_ok(self, oclass, oid=None):
+		if not self.cache:
+			return False
+
+		return self.cache.is_current(oclass, oid=oid)
+
+	# The attributes of a cached object that were written through after a
+	# state change and haven't been confirmed by the bridge since.
+
+	def optimistic(self, oclass, oid):
+		if not self.cache:
+			return list()
+
+		return self.cache.optimistic(oclass, oid)
+
+	# Return the cached objects in a class. A few objects that have gone
+	# stale on their own are refreshed individually. Returns None if the
+	# whole class needs to be fetched.
+
+	def _cached_class(self, oclass):
+		if not self.cache_ok(oclass):
+			if not self._stale_ok(oclass):
+				self.cache.count(oclass, misses=1)
+				return None
+
+			# Serve what we have while the class is fetched again
+			self._refresh_later(oclass)
+			data= dict(getattr(self.cache, oclass))
+			self._cache_hit(oclass, len(data), stale=True)
+			return data
+
+		stale= self.cache.stale_oids(oclass)
+		if len(stale) > HueBridge.MaxOidRefresh:
+			self.cache.count(oclass, misses=1)
+			return None
+
+		for oid in stale:
+			if self._stale_ok(oclass, oid):
+				self._refresh_later(oclass, oid)
+				continue
+
+			try:
+				self._refresh_oid(oclass, oid)
+			except huectl.exception.ResourceUnavailable:
+				# It's gone, so the class has changed
+				self.cache.count(oclass, misses=1)
+				return None
+
+		data= dict(getattr(self.cache, oclass))
+		self._cache_hit(oclass, len(data))
+		return data
+
+	# Return one cached object, or None if it has to be fetched
+
+	def _cached_oid(self, oclass, oid):
+		oid= str(oid)
+		stale= False
+		if not self.cache_ok(oclass, oid=oid):
+			if not self._stale_ok(oclass, oid):
+				self.cache.count(oclass, misses=1)
+				return None
+
+			self._refresh_later(oclass, oid)
+			stale= True
+
+		data= getattr(self.cache, oclass).get(oid)
+		if data is None:
+			self.cache.count(oclass, misses=1)
+		else:
+			self._cache_hit(oclass, 1, stale=stale)
+
+		return data
+
+	#--------------------
+	# Cache statistics
+	#--------------------
+
+	# Count a hit on n cached objects, and the bytes we didn't have to
+	# fetch because of it.
+
+	def _cache_hit(self, oclass, n, stale=False):
+		size= self.cache.object_size(oclass) or 0
+		if stale:
+			self.cache.count(oclass, stale_hits=1, bytes_saved=int(size*n))
+		else:
+			self.cache.count(oclass, hits=1, bytes_saved=int(size*n))
+
+	# Fetch an object class (or one object, or anything else) for the
+	# cache, and record how long it took and how big it was. The endpoint
+	# defaults to the class, except for the datastore, which is the root.
+
+	def _fetch(self, oclass, endpoint=None, raw=False):
+		if endpoint is None and oclass != 'datastore':
+			endpoint= oclass
+
+		sample= dict()
+		t= time.perf_counter()
+		data= self.call(endpoint, raw=raw, sample=sample)
+		elapsed= time.perf_counter() - t
+
+		if self.cache:
+			nbytes= sample.get('bytes', 0)
+			self.cache.count(oclass, fetches=1, fetch_time=elapsed,
+				fetch_bytes=nbytes)
+
+			if oclass in HueCache.ValidObjs and not raw and isinstance(data, dict):
+				if endpoint == oclass:
+					if len(data):
+						self.cache.set_object_size(oclass, nbytes/len(data))
+				else:
+					self.cache.set_object_size(oclass, nbytes)
+			elif oclass == 'datastore' and not raw and isinstance(data, dict):
+				self._set_datastore_sizes(data, nbytes)
+
+		return data
+
+	# The datastore comes in one response, so share its size out among
+	# the classes in it by how much of it each one takes up.
+
+	def _set_datastore_sizes(self, data, nbytes):
+		sizes= dict()
+		for oclass in HueBridge.DatastoreObjs:
+			objs= data.get(oclass)
+			if isinstance(objs, dict) and len(objs):
+				sizes[oclass]= len(json.dumps(objs))
+
+		total= sum(sizes.values())
+		if not total:
+			return
+
+		for oclass, size in sizes.items():
+			self.cache.set_object_size(oclass,
+				nbytes*size/total/len(data[oclass]))
+
+	# Statistics from the cache, as { class: { counter: value } }. See
+	# HueCache.stats.
+
+	def cache_stats(self):
+		if not self.cache:
+			return dict()
+
+		return self.cache.stats()
+
+	#--------------------
+	# Stale-while-revalidate
+	#--------------------
+
+	# Can an expired class (or object) still be served? Only if max_stale
+	# is set and it expired less than max_stale seconds ago. Objects that
+	# were marked dirty are never served.
+
+	def _stale_ok(self, oclass, oid=None):
+		if self.max_stale is None:
+			return False
+
+		interval= self.cache.ttl(oclass, oid) + self.max_stale
+		return self.cache.is_current(oclass, interval=interval, oid=oid)
+
+	# Refresh a class, or one object, from a background thread. Only one
+	# refresh of each is run at a time.
+
+	def _refresh_later(self, oclass, oid=None):
+		key= (oclass, oid)
+
+		with self._refresh_lock:
+			if key in self._refreshing:
+				return
+
+			thread= threading.Thread(target=self._background_refresh,
+				args=key, daemon=True)
+			self._refreshing[key]= thread
+
+		thread.start()
+
+	# Errors can't be raised to the caller, so they're collected in
+	# refresh_errors as (oclass, oid, exception).
+
+	def _background_refresh(self, oclass, oid):
+		try:
+			if oid is None:
+				self._refresh_class(oclass)
+			else:
+				self._refresh_oid(oclass, oid)
+		except Exception as e:
+			self.refresh_errors.append((oclass, oid, e))
+		finally:
+			with self._refresh_lock:
+				del self._refreshing[(oclass, oid)]
+
+	# Wait for background refreshes to finish
+
+	def wait_refresh(self, timeout=None):
+		with self._refresh_lock:
+			threads= list(self._refreshing.values())
+
+		for thread in threads:
+			thread.join(timeout)
+
+	def _refresh_class(self, oclass):
+		data= self._fetch(oclass)
+		self.cache.update({oclass: data})
+		if oclass == 'scenes':
+			self._expire_scene_attrs(data)
+
+		return data
+
+	# Get a class, or one object, from the cache if we can and from the
+	# bridge if we can't. For classes that don't need any special
+	# handling. Raw results always come from the bridge, and are never
+	# stored.
+
+	def _get_class(self, oclass, raw=False, use_cache=True):
+		data= None
+
+		if use_cache and self.cache and not raw:
+			data= self._cached_class(oclass)
+
+		if data is None:
+			data= self._fetch(oclass, raw=raw)
+
+			if use_cache and self.cache and not raw:
+				self.cache.update({oclass: data})
+
+		return data
+
+	def _get_oid(self, oclass, oid, raw=False, use_cache=True):
+		data= None
+
+		if use_cache and self.cache and not raw:
+			data= self._cached_oid(oclass, oid)
+			if data is None:
+				data= self._refresh_oid(oclass, oid)
+
+		if data is None:
+			data= self.call(f'{oclass}/{oid}', raw=raw)
+
+		return data
+
+	def _refresh_oid(self, oclass, oid):
+		data= self._fetch(oclass, f'{oclass}/{oid}')
+		self.cache.update_oid(oclass, {str(oid): data})
+
+		return data
+
+	# Fetch a class, or one object in it, from the bridge now and update
+	# the cache if there is one. Returns the data as the bridge sent it,
+	# which may be the copy the cache holds, so callers that keep it
+	# should copy it first.
+
+	def fetch(self, oclass, oid=None):
+		if oid is None:
+			if self.cache:
+				return self._refresh_class(oclass)
+			return self._fetch(oclass)
+
+		if self.cache:
+			return self._refresh_oid(oclass, oid)
+		return self._fetch(oclass, f'{oclass}/{oid}')
+
+	# Refresh the cache for every object class from a single request for
+	# the full datastore. Returns the datastore as a dict.
+
+	def refresh_all(self):
+		data= self._fetch('datastore', None)
+
+		if 'config' in data:
+			self.config= HueBridgeConfiguration(data['config'])
+
+		if self.cache:
+			objs= dict()
+			for oclass in HueBridge.DatastoreObjs:
+				objs[oclass]= data.get(oclass, dict())
+
+			self.cache.update(objs)
+			self._expire_scene_attrs(objs['scenes'])
+
+		return data
+
+	# Make sure the cache is current for the given object classes before
+	# running something that needs all of them. If more than one is
+	# stale, it's cheaper to refresh everything from the datastore in one
+	# request than to fetch each class separately.
+	#
+	# Returns True if the datastore was fetched.
+
+	def prefetch(self, *oclasses):
 		if not self.cache:
 			return False
 
-		if short:
-			return self.cache.is_current(oclass, self.short_refresh)
-		return self.cache.is_current(oclass, self.refresh)
+		stale= 0
+		for oclass in oclasses:
+			if not self.cache_ok(oclass):
+				stale+= 1
+
+		if stale < 2:
+			return False
+
+		self.refresh_all()
+		return True
 
 	#------------------------------------------------------------
 	# Bridge API
@@ -372,9 +930,12 @@ class HueBridge:
 	def get_group(self, groupid, raw=False, lights=None, sensors=None, use_cache=True):
 		data= None
 
-		if use_cache and self.cache:
-			if self.cache_ok('groups'):
-				data= self.cache.groups[groupid]
+		# Group 0 (all lights) isn't in the list of groups, so don't
+		# add it to the cache.
+		if use_cache and self.cache and not raw and str(groupid) != '0':
+			data= self._cached_oid('groups', groupid)
+			if data is None:
+				data= self._refresh_oid('groups', groupid)
 		
 		if data is None:
 			data= self.call(f'groups/{groupid}', raw=raw)
@@ -382,42 +943,41 @@ class HueBridge:
 		if raw:
 			return data 
 
-		group= HueGroup.parse_definition(data, groupid=groupid, bridge=self)
+		group= self._build('groups', groupid, data)
 		if lights:
-			group.lights.resolve_items(lights)
+			group.lights.resolve_items(lights, refresh=True)
 		if sensors:
-			group.sensors.resolve_items(sensors)
+			group.sensors.resolve_items(sensors, refresh=True)
 
 		return group
 
 	def get_all_groups(self, raw=False, lights=None, sensors=None, use_cache=True):
 		data= None
 
-		if use_cache and self.cache:
-			if self.cache_ok('groups'):
-				data= self.cache.groups
+		if use_cache and self.cache and not raw:
+			data= self._cached_class('groups')
 
 		if not data:
-			data= self.call('groups', raw=raw)
+			data= self._fetch('groups', raw=raw)
 
-		if use_cache and self.cache and data is not None:
-			self.cache.update({'groups': data})
+			if use_cache and self.cache and not raw:
+				self.cache.update({'groups': data})
 
 		if raw:
 			return data 
 
 		groups= dict()
 		for groupid, groupdata in data.items():
-			group= HueGroup.parse_definition(groupdata, groupid=groupid,
-				bridge=self)
+			group= self._build('groups', groupid, groupdata)
 
 			if lights:
-				group.lights.resolve_items(lights)
+				group.lights.resolve_items(lights, refresh=True)
 			if sensors:
-				group.sensors.resolve_items(sensors)
+				group.sensors.resolve_items(sensors, refresh=True)
 
 			groups[groupid]= group
 
+		self._prune('groups', groups.keys())
 
 		return groups
 
@@ -449,7 +1009,7 @@ class HueBridge:
 			raise huectl.exception.AttrsNotSet(errors)
 
 		if self.cache:
-			self.cache.mark_dirty('groups')
+			self.cache.mark_dirty('groups', groupid)
 
 		return True
 
@@ -535,7 +1095,14 @@ class HueBridge:
 		if self.cache:
 			self.cache.mark_dirty('groups')
 
+	# Change the state of several groups at once. changes is a dict of
+	# { groupid: state }. See set_light_states.
+
+	def set_group_states(self, changes):
+		return self._fanout(self.set_group_state, changes)
+
 	def set_group_state(self, groupid, state):
+		self.scheduler.acquire(HueCommandScheduler.Group)
 		rv= self.call(f'groups/{groupid}/action', method='PUT', data=state)
 
 		if not isinstance(rv, list):
@@ -551,7 +1118,10 @@ class HueBridge:
 
 		if len(errors):
 			raise huectl.exception.AttrsNotSet(errors)
-				
+
+		if self.cache:
+			self._write_through_group(str(groupid), rv)
+
 		return True
 
 	# Lights
@@ -584,7 +1154,7 @@ class HueBridge:
 			raise huectl.exception.BadResponse(rv)
 
 		if self.cache:
-			self.cache.mark_dirty()
+			self.cache.mark_dirty('lights')
 
 		return HueDeviceScanResults(self)
 
@@ -611,10 +1181,10 @@ class HueBridge:
 	def get_light(self, lightid, raw=False, use_cache=True):
 		data= None
 
-		if use_cache and self.cache:
-			# Use the short refresh interval for lights
-			if self.cache_ok('lights', short=True):
-				data= self.cache.lights[lightid]
+		if use_cache and self.cache and not raw:
+			data= self._cached_oid('lights', lightid)
+			if data is None:
+				data= self._refresh_oid('lights', lightid)
 
 		if data is None:
 			data= self.call(f'lights/{lightid}', raw=raw)
@@ -622,29 +1192,28 @@ class HueBridge:
 		if raw:
 			return data
 
-		return HueLight.parse_definition(data, lightid=lightid, bridge=self)
+		return self._build('lights', lightid, data)
 		
 	def get_all_lights(self, raw=False, use_cache=True):
 		data= None
 
-		if use_cache and self.cache:
-			# Use the short refresh interval for lights
-			if self.cache_ok('lights', short=True):
-				data= self.cache.lights
+		if use_cache and self.cache and not raw:
+			data= self._cached_class('lights')
 
 		if not data:
-			data= self.call('lights', raw=raw)
+			data= self._fetch('lights', raw=raw)
 
-		if use_cache and self.cache and data is not None:
-			self.cache.update({'lights': data})
+			if use_cache and self.cache and not raw:
+				self.cache.update({'lights': data})
 
 		if raw:
 			return data 
 
 		lights= dict()
 		for lightid, lightdata in data.items():
-			lights[lightid]= HueLight.parse_definition(lightdata,
-				lightid=lightid, bridge=self)
+			lights[lightid]= self._build('lights', lightid, lightdata)
+
+		self._prune('lights', lights.keys())
 
 		return lights
 
@@ -669,12 +1238,24 @@ class HueBridge:
 		if len(errors):
 			raise huectl.exception.AttrsNotSet(errors)
 
-		if self.cahce:
-			self.cache.mark_drty('lights')
+		if self.cache:
+			self.cache.mark_dirty('lights', lightid)
 
 		return True
 
+	# Change the state of several lights at once. changes is a dict of
+	# { lightid: state } where each state is a HueLightStateChange or a
+	# raw state dict. The commands are sent concurrently so the lights
+	# change together rather than one after another.
+	#
+	# Returns a dict of { lightid: result }, where the result is True
+	# or the exception raised for that light.
+
+	def set_light_states(self, changes):
+		return self._fanout(self.set_light_state, changes)
+
 	def set_light_state(self, lightid, state):
+		self.scheduler.acquire(HueCommandScheduler.Light)
 		rv= self.call(f'lights/{lightid}/state', method='PUT', data=state)
 
 		if not isinstance(rv, list):
@@ -692,11 +1273,125 @@ class HueBridge:
 			raise huectl.exception.AttrsNotSet(errors)
 				
 		if self.cache:
-			self.cache.mark_dirty('lights')
+			changes= self._state_changes('lights', lightid, rv)
+			self._write_through('lights', str(lightid), changes)
 
 		return True
 
 
+	#--------------------
+	# Write-through
+	#--------------------
+
+	# Turn the success entries from a state change into cache patches of
+	# { (section, attr): value }. Returns None if the result can't be
+	# known without reading the object back, e.g. for relative changes
+	# (bri_inc and friends) or a scene recall.
+
+	def _state_changes(self, oclass, oid, rv):
+		changes= dict()
+
+		for elem in rv:
+			for path, value in elem.get('success', dict()).items():
+				parts= path.strip('/').split('/')
+				if len(parts) != 4 or parts[0] != oclass or parts[1] != str(oid):
+					return None
+
+				section, attr= parts[2:]
+				if attr == 'transitiontime':
+					continue
+
+				if attr.endswith('_inc') or attr == 'scene':
+					return None
+
+				changes[(section, attr)]= value
+				if attr in HueBridge.ColorModes:
+					changes[(section, 'colormode')]= HueBridge.ColorModes[attr]
+
+		return changes
+
+	# Apply a state change to a cached object. If it can't be applied,
+	# the object is marked dirty so it's fetched when next needed.
+
+	def _write_through(self, oclass, oid, changes):
+		if changes is None or not self.cache.patch_oid(oclass, oid, changes):
+			self.cache.mark_dirty(oclass, oid)
+
+	# A group action is applied to the group and to each of its lights.
+	# Group 0 isn't cached, but it covers every light.
+
+	def _write_through_group(self, groupid, rv):
+		changes= self._state_changes('groups', groupid, rv)
+
+		if groupid == '0':
+			lightids= self.cache.lights.keys()
+		else:
+			group= self.cache.groups.get(groupid)
+			lightids= None if group is None else group.get('lights')
+
+			patch= changes
+			if changes is not None and ('action', 'on') in changes:
+				patch= dict(changes)
+				on= changes[('action', 'on')]
+				patch[('state', 'all_on')]= on
+				patch[('state', 'any_on')]= on
+
+			self._write_through('groups', groupid, patch)
+
+		if changes is None or lightids is None:
+			self.cache.mark_dirty('lights')
+			return
+
+		lightchanges= dict(map(lambda x: (('state', x[0][1]), x[1]), changes.items()))
+		for lightid in list(lightids):
+			self._write_through('lights', lightid,
+				self._light_changes(lightid, lightchanges))
+
+	# The part of a group action that can be written through to one of its
+	# lights. Lights don't all have the same capabilities, so a change is
+	# only applied to attributes the light already has, and colormode is
+	# dropped for lights without one. Returns None if the light has to be
+	# fetched instead.
+
+	def _light_changes(self, lightid, changes):
+		light= self.cache.lights.get(str(lightid))
+		state= light.get('state') if isinstance(light, dict) else None
+		if not isinstance(state, dict):
+			return None
+
+		rv= dict()
+		for (section, attr), value in changes.items():
+			if attr not in state:
+				if attr == 'colormode':
+					continue
+				return None
+
+			rv[(section, attr)]= value
+
+		return rv
+
+	def _fanout(self, func, changes):
+		results= dict()
+		if not len(changes):
+			return results
+
+		workers= min(HueBridge.FanoutWorkers, self.pool_size, len(changes))
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures= dict()
+			for targetid, state in changes.items():
+				if isinstance(state, HueLightStateChange):
+					state= state.definition()
+				futures[targetid]= executor.submit(func, targetid, state)
+
+			for targetid, future in futures.items():
+				try:
+					results[targetid]= future.result()
+				except Exception as e:
+					results[targetid]= e
+
+		return results
+
 	# Scenes
 	#--------------------
 
@@ -706,45 +1401,84 @@ class HueBridge:
 		if self.api_version() < HueApiVersion('1.1'):
 			raise huectl.exception.APIVersion(have=str(self.api_version()), need='1.1')
 
-		if use_cache and self.cache:
-			if self.cache_ok('scenes'):
-				data= self.cache.scenes
+		if use_cache and self.cache and not raw:
+			data= self._cached_class('scenes')
 
 		if data is None:
-			data= self.call('scenes', raw=raw)
+			data= self._fetch('scenes', raw=raw)
+
+			if use_cache and self.cache and not raw:
+				self.cache.update({'scenes': data})
+				self._expire_scene_attrs(data)
 
 		if raw:
 			return data
 
-		if use_cache and self.cache and data is not None:
-			self.cache.update({'scenes': data})
-
-			refresh= list()
-
-			# Now find all the scenes that have changed. Scene attrs are cached
-			# individually, so delete from the cache those that have expired.
-			for sceneid,scenedef in data.items():
-				attr= self.cache.scene_attrs
-				try:
-					if attr[sceneid]['lastupdate'] < scenedef['lastupdate']:
-						# Delete our cached object
-						del attr[sceneid]
-				except KeyError:
-					pass
-
 		scenes= dict()
 		for sceneid, scenedata in data.items():
-			scene= HueScene.parse_definition(scenedata, bridge=self, sceneid=sceneid)
+			scene= self._build('scenes', sceneid, scenedata)
 			if lights is not None:
-				scene.lights.resolve_items(lights)
+				scene.lights.resolve_items(lights, refresh=True)
 			scenes[sceneid]= scene
 
+		self._prune('scenes', scenes.keys())
+		self._prune('scene_attrs', scenes.keys())
+
 		return scenes
 
+	# Build a Hue object from its definition, or reuse the one we built
+	# last time if the definition hasn't changed.
+
+	def _build(self, oclass, oid, data):
+		if self.objects is None:
+			return self._parse(oclass, oid, data)
+
+		return self.objects.get(oclass, oid, data,
+			lambda: self._parse(oclass, oid, data))
+
+	def _parse(self, oclass, oid, data):
+		with self._phase('parse_definition'):
+			return self._parse_definition(oclass, oid, data)
+
+	def _parse_definition(self, oclass, oid, data):
+		if oclass == 'lights':
+			return HueLight.parse_definition(data, lightid=oid, bridge=self)
+		elif oclass == 'groups':
+			return HueGroup.parse_definition(data, groupid=oid, bridge=self)
+		elif oclass in ('scenes', 'scene_attrs'):
+			return HueScene.parse_definition(data, bridge=self, sceneid=oid)
+		elif oclass == 'sensors':
+			return HueSensor.parse_definition(data, sensorid=oid, bridge=self)
+		elif oclass == 'rules':
+			return HueRule.parse_definition(data, bridge=self, ruleid=oid)
+		elif oclass == 'schedules':
+			return HueSchedule.parse_definition(data, scheduleid=oid, bridge=self)
+
+		raise ValueError(f'unknown object class {oclass}')
+
+	# Forget objects that are no longer on the bridge
+
+	def _prune(self, oclass, oids):
+		if self.objects is not None:
+			self.objects.prune(oclass, oids)
+
+	# Scene attrs are cached individually, so delete from the cache
+	# those that have changed since they were fetched.
+
+	def _expire_scene_attrs(self, scenes):
+		attr= self.cache.scene_attrs
+		for sceneid, scenedef in scenes.items():
+			try:
+				if attr[sceneid]['lastupdate'] < scenedef['lastupdate']:
+					# Delete our cached object
+					self.cache.delete_oid('scene_attrs', sceneid)
+			except (KeyError, TypeError):
+				pass
+
 	def get_scene(self, sceneid, raw=False, lights=None, use_cache=True):
 		data= None
 
-		if use_cache and self.cache:
+		if use_cache and self.cache and not raw:
 			# First, update our scenes cache to fine out which scene_attr objs
 			# have expired.
 
@@ -752,19 +1486,22 @@ class HueBridge:
 
 			if sceneid in self.cache.scene_attrs:
 				data= self.cache.scene_attrs[sceneid]
+				self._cache_hit('scene_attrs', 1)
+			else:
+				self.cache.count('scene_attrs', misses=1)
 
 		if data is None:
-			data= self.call(f'scenes/{sceneid}', raw=raw)
+			data= self._fetch('scene_attrs', f'scenes/{sceneid}', raw=raw)
 
-		if use_cache and self.cache and data is not None:
-			self.cache.update_oid('scene_attrs', {sceneid: data})
+			if use_cache and self.cache and not raw:
+				self.cache.update_oid('scene_attrs', {sceneid: data})
 
 		if raw:
 			return data
 
-		scene= HueScene.parse_definition(data, bridge=self, sceneid=sceneid)
+		scene= self._build('scene_attrs', sceneid, data)
 		if lights is not None:
-			scene.lights.resolve_items(lights)
+			scene.lights.resolve_items(lights, refresh=True)
 
 		return scene
 
@@ -853,46 +1590,49 @@ class HueBridge:
 	# Rules
 	#--------------------
 
-	def get_rule(self, ruleid, raw=False):
-		data= self.call(f'rules/{ruleid}')
+	def get_rule(self, ruleid, raw=False, use_cache=True):
+		data= self._get_oid('rules', ruleid, raw, use_cache)
 		if raw:
 			return data
 
-		return HueRule.parse_definition(data, bridge=self, ruleid=ruleid)
+		return self._build('rules', ruleid, data)
 
-	def get_all_rules(self, raw=False):
-		data= self.call('rules', raw=raw)
-		print(data)
+	def get_all_rules(self, raw=False, use_cache=True):
+		data= self._get_class('rules', raw, use_cache)
 		if raw:
 			return data
 
 		rules= dict()
 		for ruleid, ruledata in data.items():
-			rule= HueRule.parse_definition(ruledata, ruleid=ruleid, bridge=self)
+			rule= self._build('rules', ruleid, ruledata)
 			rules[ruleid]= rule
 
+		self._prune('rules', rules.keys())
+
 		return rules
 
 	# Schedules
 	#--------------------
 
-	def get_schedule(self, scheduleid, raw=False):
-		data= self.call(f'schedules/{scheduleid}', raw=raw)
+	def get_schedule(self, scheduleid, raw=False, use_cache=True):
+		data= self._get_oid('schedules', scheduleid, raw, use_cache)
 		if raw:
 			return data
 
-		return HueSchedule.parse_definition(data, scheduleid=scheduleid, bridge=self)
+		return self._build('schedules', scheduleid, data)
 
-	def get_all_schedules(self, raw=False):
-		data= self.call('schedules', raw=raw)
+	def get_all_schedules(self, raw=False, use_cache=True):
+		data= self._get_class('schedules', raw, use_cache)
 		if raw:
 			return data
 
 		schedules= dict()
 		for scheduleid, scheduledata in data.items():
-			sched= HueSchedule.parse_definition(scheduledata, scheduleid=scheduleid, bridge=self)
+			sched= self._build('schedules', scheduleid, scheduledata)
 			schedules[scheduleid]= sched
 
+		self._prune('schedules', schedules.keys())
+
 		return schedules
 
 	def delete_schedule(self, scheduleid):
@@ -904,6 +1644,8 @@ class HueBridge:
 			raise huectl.exception.BadResponse(str(rv))
 
 		if 'success' in rv[0]:
+			if self.cache:
+				self.cache.mark_dirty('schedules')
 			return True
 
 		raise huectl.exception.BadResponse(str(rv[0]))
@@ -911,29 +1653,48 @@ class HueBridge:
 	# Sensors
 	#--------------------
 
-	def get_sensor(self, sensorid, raw=False):
-		data= self.call(f'sensors/{sensorid}', raw=raw)
+	def get_sensor(self, sensorid, raw=False, use_cache=True):
+		data= self._get_oid('sensors', sensorid, raw, use_cache)
 		if raw:
 			return data
 
-		return HueSensor.parse_definition(data, sensorid=sensorid, bridge=self)
+		return self._build('sensors', sensorid, data)
 
-	def get_all_sensors (self, raw=False):
-		data= self.call('sensors', raw=raw)
+	def get_all_sensors (self, raw=False, use_cache=True):
+		data= self._get_class('sensors', raw, use_cache)
 		if raw:
 			return data
 
 		sensors= dict()
 		for sensorid, sensordata in data.items():
-			sensors[sensorid]= HueSensor.parse_definition(sensordata, sensorid=sensorid, bridge=self)
+			sensors[sensorid]= self._build('sensors', sensorid, sensordata)
+
+		self._prune('sensors', sensors.keys())
 
 		return sensors
 
 	# Configuration
 	#--------------------
 
-	def get_configuration(self, raw=False):
-		data= self.call('config', raw=raw)
+	# refresh skips the cached copy. The new one only replaces a cached
+	# copy that has expired, so that connecting, which always refreshes,
+	# doesn't leave the cache needing to be saved every time.
+
+	def get_configuration(self, raw=False, use_cache=True, refresh=False):
+		data= None
+
+		if use_cache and self.cache and not raw and not refresh:
+			data= self._cached_class('config')
+
+		if not data:
+			data= self._fetch('config', raw=raw)
+
+			# Only the full configuration is cached. Users that aren't
+			# whitelisted just get the public part.
+			if use_cache and self.cache and not raw and 'whitelist' in data:
+				if not (refresh and self.cache_ok('config')):
+					self.cache.update({'config': data})
+
 		if raw:
 			return data
 
@@ -942,9 +1703,30 @@ class HueBridge:
 		return self.config
 
 	def modify_configuration(self, **kwargs):
-		attrs= dict(**kwargs)
-		apiver= self.api_version()
+		timezones= None
+		if 'timezone' in kwargs:
+			timezones= self.timezones()
 
+		data= self._configuration_changes(kwargs, timezones)
+		rv= self.call('config', method='PUT', data=data)
+
+		if not isinstance(rv, list):
+			raise huectl.exception.BadResponse(rv)
+
+		if len(rv) != 1:
+			raise huectl.exception.BadResponse(rv)
+
+		if 'success' not in rv[0]:
+			raise huectl.exception.BadResponse(rv)
+
+		if self.cache:
+			self.cache.mark_dirty('config')
+
+	# Check the attributes for modify_configuration, and return the data
+	# to send. timezones is the bridge's list of timezones, which is only
+	# needed when setting the timezone.
+
+	def _configuration_changes(self, attrs, timezones=None):
 		data= dict()
 
 		for k,v in attrs.items():
@@ -980,7 +1762,7 @@ class HueBridge:
 				if not isinstance(v, str):
 					raise TypeError(f'{k}: expected str not '+str(type(v)))
 
-				if v not in self.timezones():
+				if v not in timezones:
 					raise ValueError('{k}: not a known timezone')
 
 			elif k in ('ipaddress', 'netmask', 'gateway', 'UTC'):
@@ -995,16 +1777,7 @@ class HueBridge:
 
 			data[k]= v
 
-		rv= self.call('config', method='PUT', data=data)
-
-		if not isinstance(rv, list):
-			raise huectl.exception.BadResponse(rv)
-
-		if len(rv) != 1:
-			raise huectl.exception.BadResponse(rv)
-
-		if 'success' not in rv[0]:
-			raise huectl.exception.BadResponse(rv)
+		return data
 
 	def create_user(self, appname='Python', device='CLI', client_key=None):
 		data= { 
@@ -1016,6 +1789,10 @@ class HueBridge:
 
 		item= rv[0]
 		if 'success' in item:
+			if self.cache:
+				# The whitelist has changed
+				self.cache.mark_dirty('config')
+
 			if 'username' in item['success']:
 				return item['success']['username']
 
@@ -1027,15 +1804,15 @@ class HueBridge:
 	# Resourcelinks
 	#--------------------
 
-	def get_all_resourcelinks(self, raw=False):
-		data= self.call('resourcelinks', raw=raw)
+	def get_all_resourcelinks(self, raw=False, use_cache=True):
+		data= self._get_class('resourcelinks', raw, use_cache)
 		if raw:
 			return data
 
 		raise NotImplementedError
 
-	def get_resourcelink(self, reslinkid, raw=False):
-		data= self.call(f'resourcelinks/{reslinkid}', raw=raw)
+	def get_resourcelink(self, reslinkid, raw=False, use_cache=True):
+		data= self._get_oid('resourcelinks', reslinkid, raw, use_cache)
 		if raw:
 			return data
 
@@ -1047,49 +1824,151 @@ class HueBridge:
 	def determine_protocol(self):
 		urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+		# Don't let an old certificate pin get in the way of the probe
+		self.fingerprint= None
+		self._mount_adapters()
+
 		try:
-			response= requests.request('HEAD', f'https://{self.address}/',
-				verify=False)
-			self.proto= 'https'
-			self.request_defaults['verify']= False
+			response= self.transport.request(self.session, 'HEAD',
+				f'https://{self.address}/', verify=False,
+				timeout=self.request_defaults['timeout'])
+		except:
+			self._set_protocol('http')
 			return
+
+		try:
+			fingerprint= self._tls_fingerprint()
 		except:
-			pass
+			fingerprint= None
+
+		self._set_protocol('https', fingerprint)
+
+	def _set_protocol(self, proto, fingerprint=None):
+		if proto not in ('http', 'https'):
+			raise ValueError(f'proto: expected http or https not {proto}')
+
+		self.proto= proto
+		if proto == 'https':
+			# The bridge uses a self-signed certificate
+			urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+			self.request_defaults['verify']= False
+			self.fingerprint= fingerprint
+		else:
+			self.request_defaults.pop('verify', None)
+			self.fingerprint= None
+
+		self._mount_adapters()
+
+	def _mount_adapters(self):
+		adapter= HueHTTPAdapter(pool_connections=1,
+			pool_maxsize=self.pool_size, pool_block=True)
+		self.session.mount('http://', adapter)
 
-		self.proto= 'http'
+		adapter= HueHTTPAdapter(fingerprint=self.fingerprint,
+			pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+		self.session.mount('https://', adapter)
+
+	# Get the SHA-256 fingerprint of the bridge's TLS certificate
+
+	def _tls_fingerprint(self):
+		ctx= ssl.create_default_context()
+		ctx.check_hostname= False
+		ctx.verify_mode= ssl.CERT_NONE
+
+		timeout= self.request_defaults['timeout']
+		if isinstance(timeout, tuple):
+			timeout= timeout[0]
+
+		with socket.create_connection((self.address, 443), timeout=timeout) as sock:
+			with ctx.wrap_socket(sock) as tls:
+				cert= tls.getpeercert(binary_form=True)
+
+		return hashlib.sha256(cert).hexdigest()
 
 	# Raw HTTP calls
 	#--------------------
 
-	def call(self, endpoint, full_uri=False, method='GET', data=None, raw=False):
-		# First, see if the bridge will do TLS. If so, remember that. If
-		# not, fall back to HTTP.
-		if self.proto is None:
-			self.determine_protocol()
+	# Make a call to the bridge. If sample is a dict, the HTTP status,
+	# response size in bytes, and parse time are put in it. Call hooks are
+	# run after every call, whether or not it succeeded.
 
-		defaults= self.request_defaults
+	def call(self, endpoint, full_uri=False, method='GET', data=None, raw=False,
+		sample=None):
+		if sample is None:
+			sample= dict()
 
-		if full_uri:
-			# Don't prepend /api/USERNAME to the endpoint
-			url= f'{self.proto}://{self.address}{endpoint}'
-		else:
-			if endpoint is None:
-				url= f'{self.proto}://{self.address}/api/{self.user_id}'
-			else:
-				url= f'{self.proto}://{self.address}/api/{self.user_id}/{endpoint}'
+		if not len(self.call_hooks):
+			return self._call(endpoint, full_uri, method, data, raw, sample)
 
-		if data is None:
-			response= requests.request(method, url, **defaults)
-		else:
-			response= requests.request(method, url, data=bytes(json.dumps(data), 'utf-8'), **defaults)
+		t= time.perf_counter()
+		try:
+			return self._call(endpoint, full_uri, method, data, raw, sample)
+		finally:
+			self._run_call_hooks(endpoint, method, sample,
+				time.perf_counter() - t)
+
+	# Add a function to be called after every call to the bridge, as
+	# hook(endpoint, method, status, nbytes, parse_time, latency). See
+	# huectl.metrics.
+
+	def add_call_hook(self, hook):
+		self.call_hooks.append(hook)
+
+	def remove_call_hook(self, hook):
+		self.call_hooks.remove(hook)
+
+	def _run_call_hooks(self, endpoint, method, sample, latency):
+		for hook in self.call_hooks:
+			try:
+				hook(endpoint, method, sample.get('status'),
+					sample.get('bytes', 0), sample.get('parse_time', 0),
+					latency)
+			except Exception:
+				# Instrumentation mustn't break calls
+				pass
+
+	def _call(self, endpoint, full_uri, method, data, raw, sample):
+		# First, see if the bridge will do TLS. If so, remember that. If
+		# not, fall back to HTTP.
+		if self.proto is None:
+			with self._phase('protocol probe'):
+				self.determine_protocol()
 
+		try:
+			response= self._request(endpoint, full_uri, method, data)
+		except requests.exceptions.SSLError:
+			# Includes a certificate that doesn't match the pinned
+			# fingerprint. Don't paper over that with a new probe.
+			raise
+		except requests.exceptions.ConnectionError:
+			# We were handed a saved protocol that may no longer be
+			# right. Probe the bridge once and try again.
+			if not self.reprobe:
+				raise
+
+			self.reprobe= False
+			with self._phase('protocol probe'):
+				self.determine_protocol()
+			response= self._request(endpoint, full_uri, method, data)
+
+		sample['status']= response.status_code
 		if response.status_code != 200:
 			raise huectl.exception.BadHTTPResponse(response.status_code)
 
 		reply= response.text
+		sample['bytes']= len(reply)
 		if raw:
 			return reply
 
+		t= time.perf_counter()
+		try:
+			return self._decode(reply)
+		finally:
+			sample['parse_time']= time.perf_counter() - t
+
+	# Parse a reply, raising an exception for any errors in it
+
+	def _decode(self, reply):
 		obj= json.loads(reply)
 
 		if isinstance(obj, list):
@@ -1104,6 +1983,26 @@ class HueBridge:
 		return obj
 
 
+	def _url(self, endpoint, full_uri=False):
+		if full_uri:
+			# Don't prepend /api/USERNAME to the endpoint
+			return f'{self.proto}://{self.address}{endpoint}'
+
+		if endpoint is None:
+			return f'{self.proto}://{self.address}/api/{self.user_id}'
+
+		return f'{self.proto}://{self.address}/api/{self.user_id}/{endpoint}'
+
+	def _request(self, endpoint, full_uri, method, data):
+		defaults= self.request_defaults
+		url= self._url(endpoint, full_uri)
+
+		if data is None:
+			return self.transport.request(self.session, method, url, **defaults)
+
+		return self.transport.request(self.session, method, url,
+			data=bytes(json.dumps(data), 'utf-8'), **defaults)
+
 	def _error(self, item):
 		code= item['type']
 		msg= item['description']
@@ -1132,6 +2031,12 @@ class HueBridge:
 			raise huectl.exception.HueGenericException(f'{code} {msg}')
 
 
+def _save_at_exit(ref):
+	bridge= ref()
+	if bridge is not None and bridge._exit_hook is not None:
+		bridge._detach()
+		bridge.save_cache()
+
 #===========================================================================
 # Bridge discovery
 #===========================================================================
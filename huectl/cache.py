@@ -1,114 +1,979 @@
+from contextlib import contextmanager
 from datetime import datetime as dt
+from urllib.parse import quote, unquote
+import copy
+import marshal
+import threading
 import time
 import json
 import tempfile
-import random
 import os
 import os.path
 
+# fcntl is POSIX only. Without it we fall back to unlocked access.
+try:
+	import fcntl
+except ImportError:
+	fcntl= None
+
 #============================================================================
 # A class for caching Hue objects. For objects like lights and sensors,
 # this is really to prevent rapid-fire requests to the bridge so a short
 # cache life is in order. For schedules, rules, and groups, the cache life
 # can be a little longer.
 #
-# For scene attributes, we rely on the lastupdate property. Scene 
+# For scene attributes, we rely on the lastupdate property. Scene
 # attributes are cached individually, not as a whole, since they must be
 # fetched individually.
 #
-# Note that this class is not MP or MT safe. A process can read the cache and
-# write a new one while another process or thread has a stale copy.
+# The cache is a directory with one segment file per object class, plus
+# a _control segment holding the update times of each class and of any
+# objects that were updated (or marked dirty) on their own. Scene attributes get one
+# file per scene under scene_attrs/. Segments are read the first time
+# they're used, and only the segments that have changed are written back
+# on save. An old single-file cache is migrated on the first save.
+#
+# Segments are JSON unless the cache path ends in .bin, in which case
+# they are written with marshal, which is considerably faster to load.
+# marshal only handles plain data, so unlike pickle, loading a segment
+# can't run code even if someone else has written it. A binary cache
+# that doesn't exist yet is seeded from the JSON cache at the same path
+# without the .bin suffix, if there is one.
+#
+# Objects stay current for a TTL that is set per class (see set_ttl) and
+# can be overridden per object. A class is current if it was refreshed
+# as a whole within its TTL. Individual objects can be refreshed or
+# invalidated without touching the rest of the class, and stale_oids()
+# lists the ones that need fetching again.
+#
+# A state change that the bridge accepted can be written through to the
+# cached object with patch_oid, so reading it back doesn't cost a fetch.
+# Patched objects are flagged as optimistic until they are next fetched
+# from the bridge, at which point the bridge's copy replaces ours.
+#
+# TTLs can also be learned (see set_adaptive_ttl). Each refresh is
+# compared with the copy it replaces, and a moving average of the time
+# between changes is kept for each class and object. The TTL is a
+# fraction of that, within bounds, so objects that change often are
+# refreshed often and objects that never change are left alone.
 #
-# TODO: This can (mostly) be addressed by checking the mod time on the cache.
+# Usage statistics (hits, misses, fetch times, bytes saved and disk I/O)
+# are counted with count() and kept in a _stats segment, which each save
+# adds our counts to. See stats().
+#
+# Several processes can share a cache. Loads take a shared lock and
+# saves an exclusive lock on a lock file next to the cache. When saving,
+# an object class (or object) is only written if our copy was updated
+# (or marked dirty) more recently than the one on disk.
 #============================================================================
 
 class HueCache:
-	ValidObjs= ('lights', 'groups', 'rules', 'scenes', 'scene_attrs', 'schedules', 'sensors', '_control')
-	DefCache= {
-		'_control': {
-			'lastupdated': {}
-		}
+	ValidObjs= ('lights', 'groups', 'rules', 'scenes', 'scene_attrs', 'schedules', 'sensors', 'config', 'resourcelinks', '_control')
+	# Object classes that are stored one object per file
+	SplitObjs= ('scene_attrs',)
+	DefControl= {
+		'lastupdated': {},
+		'oids': {},
+		'optimistic': {},
+		'rates': {},
+		'classrates': {},
+		'sizes': {}
 	}
+	# Per-class and per-object entries in the control segment
+	ClassMeta= ('lastupdated', 'classrates', 'sizes')
+	OidMeta= ('oids', 'optimistic', 'rates')
 	MinLifetime= 5
 
+	# Default time to live for cached objects, in seconds
+	DefaultTTL= 10
+
+	# Binary segments start with a magic number and a format version.
+	# Segments with a different version are ignored and refetched.
+	# Version 1 was pickled.
+	BinarySuffix= '.bin'
+	BinaryMagic= b'HUEC'
+	BinaryVersion= 2
+
+	# The marshal format version
+	MarshalVersion= 4
+
+	# Usage statistics are kept in their own segment. They're saved along
+	# with any other changes, but on their own at most once every
+	# StatsInterval seconds, so that a run which is nothing but cache
+	# hits doesn't have to lock and rewrite the cache. The runs in
+	# between append their counts to StatsPending, one line each, and
+	# the next save adds them in.
+	StatsSegment= '_stats'
+	StatsPending= '_stats.pending'
+	StatsInterval= 60
+
+	# For adaptive TTLs: the weight given to each new observation of the
+	# time between changes, and the fraction of that time an object is
+	# considered current.
+	AdaptiveWeight= 0.3
+	AdaptiveFactor= 0.5
+
 	def __init__(self, filename):
-		self._cache_file= os.path.expanduser(filename)
-		self._cache= dict(HueCache.DefCache)
+		self._cache_dir= os.path.expanduser(filename)
+		self._lock_file= self._cache_dir + '.lock'
+
+		self.binary= self._cache_dir.endswith(HueCache.BinarySuffix)
+		self._suffix= HueCache.BinarySuffix if self.binary else '.json'
+
+		self._cache= { '_control': copy.deepcopy(HueCache.DefControl) }
+		self._lock= threading.RLock()
+
+		# True if we loaded an old single-file cache
+		self._legacy= False
+
+		# The identity of the segment files we last read or wrote, so we
+		# can tell if another process has replaced them.
+		self._stamps= dict()
+
+		# Time to live per object class, and per object
+		self._ttls= dict()
+		self._oid_ttls= dict()
+
+		# (min, max) TTL bounds for classes with adaptive TTLs
+		self._adaptive= dict()
+
+		# Statistics counted since the last save
+		self._stats= dict()
+
+		# Object classes we have changed since the last load or save,
+		# and when. Individually changed objects are tracked by id.
+		self._reset_changes()
+
+	# Object classes are read from disk the first time they're used
 
 	def __getattr__(self, attr):
 		if attr in HueCache.ValidObjs:
-			if attr not in self._cache:
-				self._cache[attr]= dict()
+			with self._lock:
+				if attr not in self._cache:
+					self._cache[attr]= self._read_segment(attr)
 
-			return self._cache[attr]
+				return self._cache[attr]
 
-	# Load the cache file
+		raise AttributeError(attr)
 
-	def load(self):
+	# Hold the in-process lock, and an advisory lock on the cache's lock
+	# file. If the lock file can't be created, carry on without it.
+
+	@contextmanager
+	def _locked(self, exclusive=False):
+		with self._lock:
+			fp= None
+			if fcntl is not None:
+				try:
+					fp= open(self._lock_file, 'a')
+				except OSError:
+					pass
+
+			if fp is None:
+				yield
+				return
+
+			try:
+				fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+				yield
+			finally:
+				# Closing the file releases the lock
+				fp.close()
+
+	#------------------------------------------------------------
+	# On-disk layout
+	#------------------------------------------------------------
+
+	def _segment_path(self, oclass, oid=None, root=None, suffix=None):
+		if root is None:
+			root= self._cache_dir
+		if suffix is None:
+			suffix= self._suffix
+
+		if oid is None:
+			if oclass in HueCache.SplitObjs:
+				return os.path.join(root, oclass)
+
+			return os.path.join(root, oclass + suffix)
+
+		return os.path.join(root, oclass, quote(oid, safe='') + suffix)
+
+	def _file_stamp(self, path):
 		try:
-			if os.path.exists(self._cache_file):
-				c= dict(HueCache.DefCache)
-				with open(self._cache_file) as fp:
-					c.update(json.load(fp))
+			st= os.stat(path)
+		except FileNotFoundError:
+			return None
 
-				self._cache= c
-		except Exception as e:
-			raise(e)
+		return (st.st_ino, st.st_size, st.st_mtime_ns)
 
-		self._sanitize()
+	# Read one file. Every file holds a dict. Returns None if it's missing,
+	# unreadable or holds anything else, in which case the data will just
+	# be fetched from the bridge again.
 
-	# Save the cache file. Make this an atomic operation. 
+	def _read_file(self, path, count=True):
+		t= time.perf_counter()
+
+		try:
+			if path.endswith(HueCache.BinarySuffix):
+				with open(path, 'rb') as fp:
+					raw= fp.read()
+				data= self._read_binary(raw)
+			else:
+				with open(path) as fp:
+					raw= fp.read()
+				data= json.loads(raw)
+		except (OSError, ValueError):
+			return None
+
+		if not isinstance(data, dict):
+			return None
+
+		if count:
+			self._count_disk('read', time.perf_counter()-t, len(raw))
+
+		return data
+
+	def _read_binary(self, raw):
+		n= len(HueCache.BinaryMagic)+1
+		if raw[:n] != HueCache.BinaryMagic + bytes([HueCache.BinaryVersion]):
+			return None
 
-	def save(self):
-		self._sanitize()
 		try:
-			newfile= '{:s}{:08x}'.format(
-				os.path.join(tempfile.gettempdir(), '.huecache'),
-				random.getrandbits(64))
-			with open(newfile, 'w') as fp:
-				json.dump(self._cache, fp)
+			return marshal.loads(memoryview(raw)[n:])
+		except (EOFError, ValueError, TypeError):
+			return None
+
+	# Write one file atomically. The temporary file must be in the same
+	# directory for the rename to be atomic.
+
+	def _write_file(self, path, obj, count=True):
+		t= time.perf_counter()
+		fd, newfile= tempfile.mkstemp(dir=os.path.dirname(path), prefix='.',
+			suffix='.tmp')
+		try:
+			if self.binary:
+				with os.fdopen(fd, 'wb') as fp:
+					fp.write(HueCache.BinaryMagic + bytes([HueCache.BinaryVersion]))
+					marshal.dump(obj, fp, HueCache.MarshalVersion)
+			else:
+				with os.fdopen(fd, 'w') as fp:
+					json.dump(obj, fp)
+
+			os.replace(newfile, path)
+		except:
+			try:
+				os.unlink(newfile)
+			except OSError:
+				pass
+			raise
+
+		if count:
+			self._count_disk('write', time.perf_counter()-t,
+				os.path.getsize(path))
+
+	def _read_segment(self, oclass, root=None, suffix=None):
+		# Everything was read from the old single-file cache
+		if self._legacy:
+			return dict()
+
+		if suffix is None:
+			suffix= self._suffix
+
+		path= self._segment_path(oclass, root=root, suffix=suffix)
+
+		if oclass not in HueCache.SplitObjs:
+			data= self._read_file(path)
+			return dict() if data is None else data
+
+		if root is None:
+			self._stamps[oclass]= self._file_stamp(path)
+
+		data= dict()
+		try:
+			names= os.listdir(path)
+		except OSError:
+			return data
+
+		for name in names:
+			# Skip temporary files
+			if name.startswith('.') or not name.endswith(suffix):
+				continue
+
+			obj= self._read_file(os.path.join(path, name))
+			if obj is not None:
+				data[unquote(name[:-len(suffix)])]= obj
+
+		return data
+
+	def _write_segment(self, oclass):
+		data= self._cache.get(oclass, dict())
+
+		if oclass not in HueCache.SplitObjs:
+			self._write_file(self._segment_path(oclass), data)
+			return
+
+		path= self._segment_path(oclass)
+		os.makedirs(path, exist_ok=True)
+
+		# Remove objects we no longer have
+		names= set(map(lambda x: quote(x, safe='') + self._suffix, data.keys()))
+		for name in os.listdir(path):
+			if name.endswith(self._suffix) and name not in names:
+				self._unlink(os.path.join(path, name))
+
+		for oid in data.keys():
+			self._write_oid(oclass, oid)
+
+	def _write_oid(self, oclass, oid):
+		path= self._segment_path(oclass, oid)
+		data= self._cache.get(oclass, dict())
+
+		if oid in data:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			self._write_file(path, data[oid])
+		else:
+			self._unlink(path)
+
+	def _unlink(self, path):
+		try:
+			os.unlink(path)
+		except FileNotFoundError:
+			pass
+
+	#------------------------------------------------------------
+	# Loading and saving
+	#------------------------------------------------------------
+
+	# Load the cache. Only the control segment is read now.
+
+	def load(self):
+		with self._locked():
+			self._reset_changes()
+			self._stamps= dict()
+
+			if os.path.isfile(self._cache_dir):
+				self._load_legacy(self._cache_dir)
+				return
+
+			if self.binary and not os.path.exists(self._cache_dir):
+				if self._migrate_json():
+					return
+
+			self._legacy= False
+			path= self._segment_path('_control')
+			stamp= self._file_stamp(path)
+			control= self._read_file(path)
+			self._cache= { '_control': self._repair_control(control) }
+			self._stamps['_control']= stamp
+
+	# Read an old single-file cache. Everything in it is marked as changed
+	# (as of when it was fetched) so the next save writes it all out in
+	# the new layout.
+
+	def _load_legacy(self, path):
+		c= self._read_file(path)
+		if not isinstance(c, dict):
+			c= dict()
+
+		self._sanitize(obj=c)
+		c['_control']= self._repair_control(c.get('_control'))
+		self._cache= c
+		self._legacy= True
+
+		lastupdated= c['_control']['lastupdated']
+		for oclass in c.keys():
+			if oclass != '_control':
+				self._mark_changed(oclass, when=lastupdated.get(oclass) or 0)
+
+	# Seed a new binary cache from the JSON cache at the same path without
+	# the .bin suffix. Everything is read now and marked as changed so the
+	# first save writes it all out. The JSON cache is left in place.
+
+	def _migrate_json(self):
+		root= self._cache_dir[:-len(HueCache.BinarySuffix)]
+
+		if os.path.isfile(root):
+			self._load_legacy(root)
+			return True
+
+		if not os.path.isdir(root):
+			return False
+
+		control= self._read_file(self._segment_path('_control', root=root,
+			suffix='.json'))
+		if control is None:
+			return False
+
+		self._cache= { '_control': self._repair_control(control) }
+		lastupdated= self._cache['_control']['lastupdated']
+
+		for oclass in HueCache.ValidObjs:
+			if oclass == '_control':
+				continue
+
+			self._cache[oclass]= self._read_segment(oclass, root=root,
+				suffix='.json')
+			self._mark_changed(oclass, when=lastupdated.get(oclass) or 0)
+
+		# Nothing left to read from disk
+		self._legacy= True
+		return True
+
+	def _repair_control(self, control):
+		if not isinstance(control, dict):
+			control= copy.deepcopy(HueCache.DefControl)
+
+		for k in HueCache.DefControl.keys():
+			if not isinstance(control.get(k), dict):
+				control[k]= dict()
+
+		return control
+
+	# Have we changed anything since the last load or save? With stats,
+	# count unsaved statistics as a change if they're due to be saved on
+	# their own.
+
+	def dirty(self, stats=False):
+		if self._changed or self._changed_oids:
+			return True
+
+		if not stats:
+			return False
+
+		if not len(self._stats) and not os.path.exists(self._pending_path()):
+			return False
+
+		return self._stats_due()
+
+	def _pending_path(self):
+		return os.path.join(self._cache_dir, HueCache.StatsPending)
+
+	# Have the statistics gone unsaved for long enough to be saved on
+	# their own?
+
+	def _stats_due(self):
+		try:
+			st= os.stat(self._segment_path(HueCache.StatsSegment))
+		except OSError:
+			return True
+
+		return time.time() - st.st_mtime >= HueCache.StatsInterval
+
+	# Write the segments that have changed, then the control segment, then
+	# the statistics (last, so they include this save). If there's nothing
+	# to save but statistics that aren't due yet, they're only appended to
+	# the pending statistics.
+
+	def save(self):
+		if not self.dirty(stats=True):
+			if len(self._stats) and not self._legacy:
+				self._append_stats()
+			return
+
+		with self._locked(exclusive=True):
+			if not self.dirty(stats=True):
+				return
+
+			if self._legacy:
+				# Replace an old single-file cache
+				if os.path.isfile(self._cache_dir):
+					os.unlink(self._cache_dir)
+				self._legacy= False
+
+			os.makedirs(self._cache_dir, exist_ok=True)
+
+			if self.dirty():
+				self._save_changes()
+
+			self._save_stats()
+
+	# The caller holds the exclusive lock
+
+	def _save_changes(self):
+		path= self._segment_path('_control')
+		control= self._repair_control(self._read_file(path))
+		lu_disk= control['lastupdated']
+
+		for oclass, when in list(self._changed.items()):
+			t= lu_disk.get(oclass)
+			if t is not None and t > when:
+				# Another process refreshed this after our change,
+				# so theirs stands. Read it again when next needed.
+				del self._changed[oclass]
+				self._cache.pop(oclass, None)
+				continue
+
+			# A class that was only marked dirty may never have
+			# been read. Leave its data on disk alone.
+			if oclass in self._cache:
+				self._write_segment(oclass)
+
+			_copy_meta(self._cache['_control'], control, oclass)
+
+		for oclass, changes in list(self._changed_oids.items()):
+			if oclass in self._changed:
+				continue
+
+			self._save_oids(oclass, changes, control)
+
+		self._write_file(path, control)
+		self._adopt_control(control)
+		self._stamps['_control']= self._file_stamp(path)
+		for oclass in HueCache.SplitObjs:
+			if oclass in self._cache:
+				self._stamps[oclass]= self._file_stamp(self._segment_path(oclass))
+
+		self._reset_changes()
+
+	# Save individually changed objects. An object is only written if our
+	# change is newer than the copy on disk.
+
+	def _save_oids(self, oclass, changes, control):
+		lu_disk= control['lastupdated']
+		stamps_disk= control['oids'].get(oclass, dict())
+		flags_disk= control['optimistic'].get(oclass, dict())
+		changed_data= self._changed_data.get(oclass, set())
+
+		winners= list()
+		stale= False
+		for oid, when in list(changes.items()):
+			t= stamps_disk.get(oid, lu_disk.get(oclass))
+			# A patch counts as a change too
+			patched= flags_disk.get(oid, dict()).values()
+			if len(patched):
+				t= max(t or 0, max(patched))
+
+			if t is not None and t > when:
+				# Theirs is newer, so forget our change
+				del changes[oid]
+				changed_data.discard(oid)
+				stale= True
+				continue
+
+			winners.append(oid)
+			_copy_meta(self._cache['_control'], control, oclass, oid)
+
+		winners= list(filter(lambda x: x in changed_data, winners))
+		if oclass in self._cache and len(winners):
+			self._write_oids(oclass, winners)
+
+		if stale:
+			# Our copy of some objects is out of date. Read the class
+			# again when next needed.
+			self._cache.pop(oclass, None)
+
+	def _write_oids(self, oclass, oids):
+
+		if oclass in HueCache.SplitObjs:
+			for oid in oids:
+				self._write_oid(oclass, oid)
+			return
+
+		# Merge our objects into the copy on disk
+		ours= self._cache[oclass]
+		data= self._read_file(self._segment_path(oclass))
+		if not isinstance(data, dict):
+			data= dict()
+
+		for oid in oids:
+			_copy_key(ours, data, oid)
+
+		self._write_file(self._segment_path(oclass), data)
+
+	# Pick up changes that other processes have saved since we loaded.
+	# Returns True if anything had changed.
+
+	def revalidate(self):
+		with self._locked():
+			if self._legacy:
+				return False
+
+			changed= False
+
+			path= self._segment_path('_control')
+			stamp= self._file_stamp(path)
+			if stamp is not None and stamp != self._stamps.get('_control'):
+				control= self._read_file(path)
+				if control is not None:
+					self._adopt_control(self._repair_control(control))
+					self._stamps['_control']= stamp
+					changed= True
+
+			for oclass in HueCache.SplitObjs:
+				if oclass not in self._cache or oclass in self._changed:
+					continue
+
+				stamp= self._file_stamp(self._segment_path(oclass))
+				if stamp == self._stamps.get(oclass):
+					continue
+
+				self._reload_segment(oclass)
+				changed= True
+
+			return changed
+
+	# Read a segment again, keeping the objects we've changed
+
+	def _reload_segment(self, oclass):
+		ours= self._cache.get(oclass, dict())
+		data= self._read_segment(oclass)
+		for oid in self._changed_data.get(oclass, ()):
+			_copy_key(ours, data, oid)
+
+		self._cache[oclass]= data
+
+	# Take the update times from a control segment read from disk. Any
+	# object class we have loaded, and whose update times are different on
+	# disk, is read again (or dropped, so it gets read when next used).
+	# Update times for our unsaved changes are kept.
+
+	def _adopt_control(self, control):
+		lu_ours= self._cache['_control']['lastupdated']
+		oids_ours= self._cache['_control']['oids']
+		lu_disk= control['lastupdated']
+		oids_disk= control['oids']
+		opt_ours= self._cache['_control']['optimistic']
+		opt_disk= control['optimistic']
+
+		for oclass in list(self._cache.keys()):
+			if oclass == '_control' or oclass in self._changed:
+				continue
+
+			if oclass in HueCache.SplitObjs:
+				continue
+
+			mine= self._changed_oids.get(oclass, dict())
+			stamps_ours= dict(filter(lambda x: x[0] not in mine,
+				oids_ours.get(oclass, dict()).items()))
+			stamps_disk= dict(filter(lambda x: x[0] not in mine,
+				oids_disk.get(oclass, dict()).items()))
+
+			if lu_ours.get(oclass) == lu_disk.get(oclass) and stamps_ours == stamps_disk:
+				# Objects can also be patched without a new update time
+				flags_ours= dict(filter(lambda x: x[0] not in mine,
+					opt_ours.get(oclass, dict()).items()))
+				flags_disk= dict(filter(lambda x: x[0] not in mine,
+					opt_disk.get(oclass, dict()).items()))
+				if flags_ours == flags_disk:
+					continue
+
+			if oclass in self._changed_data:
+				self._reload_segment(oclass)
+			else:
+				del self._cache[oclass]
+
+		for oclass in self._changed.keys():
+			_copy_meta(self._cache['_control'], control, oclass)
+
+		for oclass, changes in self._changed_oids.items():
+			if oclass in self._changed:
+				continue
+
+			for oid in changes.keys():
+				_copy_meta(self._cache['_control'], control, oclass, oid)
+
+		self._cache['_control']= control
 
-			os.rename(newfile, self._cache_file)
-		except Exception as e:
-			raise(e)
+	# Record a change to a whole object class, or to one object. data is
+	# False when only the object's update time changed.
+
+	def _mark_changed(self, oclass, oid=None, when=None, data=True):
+		if when is None:
+			when= time.time()
+
+		if oid is None:
+			self._changed[oclass]= when
+			return
+
+		self._changed_oids.setdefault(oclass, dict())[oid]= when
+		if data:
+			self._changed_data.setdefault(oclass, set()).add(oid)
+
+	def _reset_changes(self):
+		self._changed= dict()
+		self._changed_oids= dict()
+		self._changed_data= dict()
 
 	# Remove objects that we don't recognize
 
 	def _sanitize(self, obj=None):
 		if obj is None:
 			obj= self._cache
-			
+
 		objlist= list(obj.keys())
 
 		for k in objlist:
 			if k not in HueCache.ValidObjs:
 				del obj[k]
 
-	# Get the last time objects of type objclass (lights, sensors, etc.) were updated
+	#------------------------------------------------------------
+	# Statistics
+	#------------------------------------------------------------
+
+	# Add to the statistics for an object class, or for something else
+	# like 'disk'. Counts are given as keyword arguments, e.g.
+	# count('lights', hits=1, bytes_saved=2048).
+
+	def count(self, key, **counts):
+		with self._lock:
+			stats= self._stats.setdefault(key, dict())
+			for k, v in counts.items():
+				stats[k]= stats.get(k, 0) + v
+
+	# Disk I/O is counted often enough that it's worth doing cheaply. It
+	# always happens under the lock.
+
+	def _count_disk(self, op, elapsed, size):
+		disk= self._stats.get('disk')
+		if disk is None:
+			disk= self._stats['disk']= dict()
+
+		n= op + 's'
+		disk[n]= disk.get(n, 0) + 1
+		n= op + '_time'
+		disk[n]= disk.get(n, 0) + elapsed
+		n= op + '_bytes'
+		disk[n]= disk.get(n, 0) + size
+
+	# The statistics saved by every process that has used the cache,
+	# plus our own unsaved counts, as { key: { counter: value } }.
+
+	def stats(self):
+		with self._locked():
+			stats= None
+			if not self._legacy:
+				stats= self._read_file(self._segment_path(HueCache.StatsSegment),
+					count=False)
+
+			if not isinstance(stats, dict):
+				stats= dict()
+
+			if not self._legacy:
+				self._add_pending_stats(stats)
+
+			_add_stats(stats, self._stats)
+			return stats
+
+	def reset_stats(self):
+		with self._locked(exclusive=True):
+			self._unlink(self._segment_path(HueCache.StatsSegment))
+			self._unlink(self._pending_path())
+			self._stats= dict()
+
+	# Add our counts, and any pending ones, to the saved statistics. The
+	# caller holds the exclusive lock. Reading and writing the statistics
+	# isn't counted, or there would always be something left to save.
+
+	def _save_stats(self):
+		pending= self._pending_path()
+		if not len(self._stats) and not os.path.exists(pending):
+			return
+
+		path= self._segment_path(HueCache.StatsSegment)
+		stats= self._read_file(path, count=False)
+		if not isinstance(stats, dict):
+			stats= dict()
+
+		self._add_pending_stats(stats)
+		_add_stats(stats, self._stats)
+		self._write_file(path, stats, count=False)
+		self._unlink(pending)
+		self._stats= dict()
+
+	# Append our counts to the pending statistics as one line of JSON. A
+	# shared lock is enough, since appends don't overwrite each other,
+	# and it keeps a save from adding them in while we write.
+
+	def _append_stats(self):
+		line= json.dumps(self._stats) + '\n'
+
+		with self._locked():
+			try:
+				with open(self._pending_path(), 'a') as fp:
+					fp.write(line)
+			except OSError:
+				return
+
+		self._stats= dict()
+
+	# Add the pending statistics to stats. A line that can't be read,
+	# e.g. from a write that was cut short, is skipped.
+
+	def _add_pending_stats(self, stats):
+		try:
+			with open(self._pending_path()) as fp:
+				lines= fp.readlines()
+		except OSError:
+			return
+
+		for line in lines:
+			try:
+				counts= json.loads(line)
+			except ValueError:
+				continue
+
+			if isinstance(counts, dict):
+				_add_stats(stats, counts)
+
+	# The average size of an object in a class when fetched from the
+	# bridge, in bytes, or None if we don't know. This is what a cache
+	# hit saves. The size is saved along with the class.
 
-	def lastupdate(self, oclass):
+	def object_size(self, oclass):
+		return self._cache['_control']['sizes'].get(oclass)
+
+	def set_object_size(self, oclass, size):
 		if oclass not in HueCache.ValidObjs:
 			raise ValueError(f"unknown object class {oclass}")
 
-		c= self._cache
+		with self._lock:
+			self._cache['_control']['sizes'][oclass]= size
 
-		try:
-			return c['_control']['lastupdated'][oclass]
-		except KeyError:
-			pass
+	#------------------------------------------------------------
+	# Time to live
+	#------------------------------------------------------------
 
-		return None
+	# Set how long objects stay current, in seconds. With an oid, this
+	# overrides the class default for just that object.
 
-	# Is our cache less than interval seconds old?
-	def is_current(self, oclass, interval):
-		# Our minimum interval 
-		if interval < HueCache.MinLifetime:
-			interval= HueCache.MinLifetime
+	def set_ttl(self, oclass, ttl, oid=None):
+		if oclass not in HueCache.ValidObjs:
+			raise ValueError(f"unknown object class {oclass}")
+
+		if oid is None:
+			self._ttls[oclass]= ttl
+		elif ttl is None:
+			self._oid_ttls.pop((oclass, str(oid)), None)
+		else:
+			self._oid_ttls[(oclass, str(oid))]= ttl
+
+	def ttl(self, oclass, oid=None):
+		ttl= None
+		if oid is not None:
+			ttl= self._oid_ttls.get((oclass, str(oid)))
+
+		if ttl is None and oclass in self._adaptive:
+			ttl= self._adaptive_ttl(oclass, oid)
 
+		if ttl is None:
+			ttl= self._ttls.get(oclass, HueCache.DefaultTTL)
+
+		return max(ttl, HueCache.MinLifetime)
+
+	# Learn the TTL for a class, and the objects in it, from how often
+	# they change, between min_ttl and max_ttl seconds. Until something
+	# has been learned, the class TTL is used. A min_ttl of None turns
+	# this off.
+
+	def set_adaptive_ttl(self, oclass, min_ttl, max_ttl):
 		if oclass not in HueCache.ValidObjs:
 			raise ValueError(f"unknown object class {oclass}")
 
-		lastupdate= self.lastupdate(oclass)
+		if min_ttl is None:
+			self._adaptive.pop(oclass, None)
+		else:
+			self._adaptive[oclass]= (min_ttl, max_ttl)
+
+	# The average time between changes to a class, or to one object, in
+	# seconds. None if we don't know yet. An object we don't know about
+	# gets its class's.
+
+	def change_interval(self, oclass, oid=None):
+		c= self._cache['_control']
+
+		if oid is not None:
+			rate= c['rates'].get(oclass, dict()).get(str(oid))
+			if rate is not None and rate[1] is not None:
+				return rate[1]
+
+		rate= c['classrates'].get(oclass)
+		if rate is None:
+			return None
+
+		return rate[1]
+
+	def _adaptive_ttl(self, oclass, oid=None):
+		interval= self.change_interval(oclass, oid)
+		if interval is None:
+			return None
+
+		min_ttl, max_ttl= self._adaptive[oclass]
+		return min(max(interval*HueCache.AdaptiveFactor, min_ttl), max_ttl)
+
+	# Compare a refresh with the copy it replaces. old and new are dicts
+	# of { oid: data }. With whole set to True, new is the entire class.
+
+	def _observe(self, oclass, old, new, now, whole=False):
+		rates= self._cache['_control']['rates'].setdefault(oclass, dict())
+		floor= self._ttls.get(oclass, HueCache.DefaultTTL)/HueCache.AdaptiveFactor
+		changed= False
+
+		for oid, data in new.items():
+			if oid not in old:
+				changed= True
+				rates[oid]= [now, None]
+				continue
+
+			hit= old[oid] != data
+			changed= changed or hit
+			rates[oid]= _observe_rate(rates.get(oid), hit, now, floor)
+
+		if not whole:
+			return
+
+		for oid in list(rates.keys()):
+			if oid not in new:
+				changed= True
+				del rates[oid]
+
+		classrates= self._cache['_control']['classrates']
+		classrates[oclass]= _observe_rate(classrates.get(oclass), changed,
+			now, floor)
+
+	#------------------------------------------------------------
+	# Cache queries and updates
+	#------------------------------------------------------------
+
+	# Get the last time objects of type objclass (lights, sensors, etc.) were
+	# updated. With an oid, the last time that object was updated, which
+	# may have been on its own.
+
+	def lastupdate(self, oclass, oid=None):
+		if oclass not in HueCache.ValidObjs:
+			raise ValueError(f"unknown object class {oclass}")
+
+		c= self._cache['_control']
+
+		if oid is not None:
+			stamps= c['oids'].get(oclass, dict())
+			if str(oid) in stamps:
+				return stamps[str(oid)]
+
+		return c['lastupdated'].get(oclass)
+
+	# Is our cache of the class (or of one object) current? If not, see if
+	# another process has saved a newer copy. interval overrides the TTL.
+
+	def is_current(self, oclass, interval=None, oid=None):
+		if oclass not in HueCache.ValidObjs:
+			raise ValueError(f"unknown object class {oclass}")
+
+		if interval is None:
+			interval= self.ttl(oclass, oid)
+		elif interval < HueCache.MinLifetime:
+			# Our minimum interval
+			interval= HueCache.MinLifetime
+
+		if self._is_current(oclass, interval, oid):
+			return True
+
+		if self.revalidate():
+			return self._is_current(oclass, interval, oid)
+
+		return False
+
+	def _is_current(self, oclass, interval, oid=None):
+		lastupdate= self.lastupdate(oclass, oid)
 		if lastupdate is None:
 			return False
 
@@ -117,55 +982,317 @@ class HueCache:
 
 		return True
 
-	def mark_dirty(self, oclass):
+	# The objects in a class that have been marked dirty or have outlived
+	# their TTL since they were last updated on their own. Objects that
+	# were only ever updated with their class aren't included: they are
+	# current if the class is.
+
+	def stale_oids(self, oclass):
+		if oclass not in HueCache.ValidObjs:
+			raise ValueError(f"unknown object class {oclass}")
+
+		stale= list()
+		now= time.time()
+
+		with self._lock:
+			stamps= self._cache['_control']['oids'].get(oclass, dict())
+			for oid, t in stamps.items():
+				if t is None or now - t >= self.ttl(oclass, oid):
+					stale.append(oid)
+
+		return stale
+
+	# Mark a class, or just one object in it, as needing a refresh
+
+	def mark_dirty(self, oclass, oid=None):
 		if oclass not in HueCache.ValidObjs:
 			raise ValueError(f"unknown object class {oclass}")
 
-		self._cache['_control']['lastupdate']= None
+		with self._lock:
+			if oid is None:
+				self._cache['_control']['lastupdated'][oclass]= None
+				self._clear_meta(oclass)
+				self._mark_changed(oclass)
+				return
+
+			oid= str(oid)
+			stamps= self._cache['_control']['oids'].setdefault(oclass, dict())
+			stamps[oid]= None
+			self._clear_optimistic(oclass, oid)
+			self._mark_changed(oclass, oid, data=False)
 
 	def delete_oid(self, oclass, oid):
 		if oclass not in HueCache.ValidObjs:
 			raise ValueError(f"unknown object class {oclass}")
-		try:
-			del self._cache[oclass][oid]
-		except KeyError:
-			pass
 
-		return
+		with self._lock:
+			try:
+				del getattr(self, oclass)[oid]
+			except KeyError:
+				return
+
+			stamps= self._cache['_control']['oids'].get(oclass, dict())
+			stamps.pop(oid, None)
+			self._clear_optimistic(oclass, oid)
+			self._mark_changed(oclass, oid)
+
+	# Update individual objects. obj is a dict of { oid: data }. Their
+	# update times are set without touching the rest of the class.
 
-	def update_oid(self, oclass, obj):
+	def update_oid(self, oclass, obj, timestamp=None):
 		if isinstance(obj, str):
 			data= json.loads(obj)
 		else:
 			data= obj
 
-		try:
-			c= self._cache[oclass]
-		except KeyError:
+		if oclass not in HueCache.ValidObjs:
 			return
 
-		c.update(data)
+		if timestamp is None:
+			timestamp= time.time()
+
+		with self._lock:
+			c= getattr(self, oclass)
+			if oclass in self._adaptive:
+				self._observe(oclass, c, data, timestamp)
+			c.update(data)
+
+			stamps= self._cache['_control']['oids'].setdefault(oclass, dict())
+			for oid in data.keys():
+				stamps[oid]= timestamp
+				self._clear_optimistic(oclass, oid)
+				self._mark_changed(oclass, oid, when=timestamp)
+
+	# Write a change through to a cached object without fetching it. changes
+	# maps (section, attribute) to the new value, e.g. ('state', 'bri'),
+	# or (None, attribute) for top-level attributes. The object keeps its
+	# update time, but is flagged as optimistic until it's next fetched.
+	# Returns False if the object isn't cached.
+
+	def patch_oid(self, oclass, oid, changes):
+		if oclass not in HueCache.ValidObjs:
+			raise ValueError(f"unknown object class {oclass}")
+
+		oid= str(oid)
+
+		with self._lock:
+			obj= getattr(self, oclass).get(oid)
+			if not isinstance(obj, dict):
+				return False
+
+			now= time.time()
+			flags= self._cache['_control']['optimistic'].setdefault(oclass, dict())
+			paths= flags.setdefault(oid, dict())
+			for (section, attr), value in changes.items():
+				if section is None:
+					obj[attr]= value
+				else:
+					target= obj.get(section)
+					if not isinstance(target, dict):
+						return False
+					target[attr]= value
+
+				paths[attr if section is None else f'{section}/{attr}']= now
+
+			self._mark_changed(oclass, oid, when=now)
+
+			return True
+
+	# The attributes of an object that were written through and haven't
+	# been confirmed by a fetch since, or an empty list.
+
+	def optimistic(self, oclass, oid):
+		flags= self._cache['_control']['optimistic'].get(oclass, dict())
+		return sorted(flags.get(str(oid), dict()).keys())
+
+	def _clear_optimistic(self, oclass, oid):
+		flags= self._cache['_control']['optimistic'].get(oclass)
+		if flags is None:
+			return
+
+		flags.pop(oid, None)
+		if not len(flags):
+			del self._cache['_control']['optimistic'][oclass]
+
+	# Forget per-object update times and flags. Change rates are kept.
+
+	def _clear_meta(self, oclass):
+		for k in ('oids', 'optimistic'):
+			self._cache['_control'][k].pop(oclass, None)
 
-	def update(self, obj):
+	# Update one or more object classes. All of them are stamped with the
+	# same update time, which defaults to now.
+
+	def update(self, obj, timestamp=None):
 		if isinstance(obj, str):
 			data= json.loads(obj)
 		else:
 			data= obj
 
+		if timestamp is None:
+			timestamp= time.time()
+
 		self._sanitize(obj=data)
+		data.pop('_control', None)
 
-		c= self._cache
-		c.update(data)
-		for k in data.keys():
-			try:
-				c['_control']['lastupdated'][k]= time.time()
-			except KeyError:
-				# Repair the cache
-				c['_control']['lastupdated']= dict()
+		with self._lock:
+			c= self._cache
+			for k in data.keys():
+				if k in self._adaptive:
+					self._observe(k, getattr(self, k), data[k], timestamp,
+						whole=True)
+
+			c.update(data)
+
+			for k in data.keys():
+				c['_control']['lastupdated'][k]= timestamp
+				self._clear_meta(k)
+				self._mark_changed(k, when=timestamp)
 
 	def clear(self, oclass):
 		if oclass not in HueCache.ValidObjs:
 			raise ValueError(f"unknown object class {oclass}")
-		self._cache[oclass]= {}
-		self._cache['lastupdated'][oclass]= None
 
+		with self._lock:
+			self._cache[oclass]= {}
+			self._cache['_control']['lastupdated'][oclass]= None
+			self._clear_meta(oclass)
+			self._mark_changed(oclass)
+
+# Copy d[key] from src to dst, or remove it from dst if it's not in src
+
+def _copy_key(src, dst, key):
+	if key in src:
+		dst[key]= src[key]
+	else:
+		dst.pop(key, None)
+
+# Copy the control entries (update times, optimistic flags and change
+# rates) for a class, or for one object in it, from one control segment
+# to another
+
+def _copy_meta(src, dst, oclass, oid=None):
+	if oid is None:
+		for k in HueCache.ClassMeta:
+			_copy_key(src[k], dst[k], oclass)
+
+	for k in HueCache.OidMeta:
+		if oid is None:
+			_copy_key(src[k], dst[k], oclass)
+			continue
+
+		d= dst[k].setdefault(oclass, dict())
+		_copy_key(src[k].get(oclass, dict()), d, oid)
+		if not len(d):
+			del dst[k][oclass]
+
+# Add the counters in one set of statistics to another
+
+def _add_stats(dst, src):
+	for key, counts in src.items():
+		d= dst.setdefault(key, dict())
+		for k, v in counts.items():
+			d[k]= d.get(k, 0) + v
+
+# Fold one observation into a change rate, which is a list of [ the time
+# of the last change, the average time between changes ]. When nothing
+# has changed, the time since the last change is only a lower bound on
+# the average, so it can raise the average but never lower it. Until a
+# change is seen, it only sets the average once it's longer than floor,
+# the interval the static TTL already assumes, so quiet classes can
+# learn a longer TTL but never a shorter one.
+
+def _observe_rate(rate, changed, now, floor=None):
+	if rate is None:
+		return [now, None]
+
+	last, mean= rate
+	elapsed= now - last
+	if elapsed <= 0:
+		return rate
+
+	if changed:
+		last= now
+	elif mean is None:
+		if floor is None or elapsed <= floor:
+			return rate
+	elif elapsed <= mean:
+		return rate
+
+	if mean is None:
+		mean= elapsed
+	else:
+		w= HueCache.AdaptiveWeight
+		mean= w*elapsed + (1-w)*mean
+
+	return [last, mean]
+
+#============================================================================
+# Parsed Hue objects, so that data which hasn't changed isn't parsed
+# again every time it's read. Each object is kept by object class and id
+# along with a snapshot of the data it was built from, and is only
+# rebuilt when the data no longer matches. Comparing dicts is far cheaper
+# than serializing them to compute a hash.
+#
+# The objects are shared between calls, so callers should treat them as
+# read-only.
+#============================================================================
+
+class HueObjectCache:
+	def __init__(self):
+		self._objs= dict()
+		self._lock= threading.Lock()
+
+		# Statistics
+		self.hits= 0
+		self.misses= 0
+
+	# Return the object for oclass/oid built from data. build() is
+	# called to make a new one if data has changed.
+
+	def get(self, oclass, oid, data, build):
+		key= (oclass, str(oid))
+
+		with self._lock:
+			entry= self._objs.get(key)
+			if entry is not None and entry[0] == data:
+				self.hits+= 1
+				return entry[1]
+
+		# Take a copy, since the caller's data may be changed in place.
+		# A marshal round trip is a quick deep copy of JSON data.
+		snapshot= marshal.loads(marshal.dumps(data))
+		obj= build()
+
+		with self._lock:
+			self._objs[key]= (snapshot, obj)
+			self.misses+= 1
+
+		return obj
+
+	# Drop objects of class oclass whose ids aren't in oids
+
+	def prune(self, oclass, oids):
+		keep= set(map(lambda x: str(x), oids))
+
+		with self._lock:
+			for key in list(self._objs.keys()):
+				if key[0] == oclass and key[1] not in keep:
+					del self._objs[key]
+
+	def discard(self, oclass, oid=None):
+		with self._lock:
+			if oid is not None:
+				self._objs.pop((oclass, str(oid)), None)
+				return
+
+			for key in list(self._objs.keys()):
+				if key[0] == oclass:
+					del self._objs[key]
+
+	def clear(self):
+		with self._lock:
+			self._objs= dict()
+
+	def __len__(self):
+		return len(self._objs)
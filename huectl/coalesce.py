@@ -0,0 +1,121 @@
+import threading
+# Work around circular import
+import huectl.bridge
+from huectl.light import HueLightStateChange
+
+#============================================================================
+# Coalesce light and group state changes.
+#
+# Interactive controls (dimmer drags, sensor bursts) tend to produce many
+# state changes for the same light in quick succession, and only the end
+# result matters. HueStateCoalescer sits in front of a bridge and holds
+# changes for a short window. Changes for the same light or group that
+# arrive within the window are merged (see HueLightStateChange.merge), and
+# a single command is sent when the window closes.
+#
+#   coalescer= HueStateCoalescer(bridge, window=0.2)
+#   coalescer.set_light_state('5', change)
+#   ...
+#   coalescer.close()
+#
+# Commands are sent from a timer thread, so errors can't be raised to the
+# caller. They are passed to on_error(kind, targetid, change, exception)
+# if given, and otherwise collected in the errors list.
+#============================================================================
+
+class HueStateCoalescer:
+	# Seconds to hold a change before sending it
+	Window= 0.2
+
+	def __init__(self, bridge, window=Window, on_error=None):
+		self.bridge= bridge
+		self.window= window
+		self.on_error= on_error
+		self.errors= list()
+
+		self._lock= threading.Lock()
+		self._pending= dict()
+		self._timers= dict()
+
+		# Statistics
+		self.submitted= 0
+		self.sent= 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def set_light_state(self, lightid, state):
+		self._submit('light', str(lightid), state)
+
+	def set_group_state(self, groupid, state):
+		self._submit('group', str(groupid), state)
+
+	# The number of lights and groups with changes waiting to be sent
+
+	def pending(self):
+		with self._lock:
+			return len(self._pending)
+
+	# Send everything that's waiting now
+
+	def flush(self):
+		with self._lock:
+			pending= self._pending
+			self._pending= dict()
+
+			for timer in self._timers.values():
+				timer.cancel()
+			self._timers= dict()
+
+		for key, change in pending.items():
+			self._send(key, change)
+
+	def close(self):
+		self.flush()
+
+	def _submit(self, kind, targetid, state):
+		key= (kind, targetid)
+
+		with self._lock:
+			self.submitted+= 1
+
+			if key in self._pending:
+				self._pending[key].merge(state)
+				return
+
+			# Start a new window for this light or group
+			self._pending[key]= HueLightStateChange().merge(state)
+
+			timer= threading.Timer(self.window, self._expire, args=(key,))
+			timer.daemon= True
+			self._timers[key]= timer
+			timer.start()
+
+	def _expire(self, key):
+		with self._lock:
+			change= self._pending.pop(key, None)
+			self._timers.pop(key, None)
+
+		if change is not None:
+			self._send(key, change)
+
+	def _send(self, key, change):
+		kind, targetid= key
+
+		try:
+			if kind == 'light':
+				self.bridge.set_light_state(targetid, change.definition())
+			else:
+				self.bridge.set_group_state(targetid, change.definition())
+		except Exception as e:
+			if self.on_error is None:
+				self.errors.append((kind, targetid, e))
+			else:
+				self.on_error(kind, targetid, change, e)
+			return
+
+		with self._lock:
+			self.sent+= 1
@@ -100,10 +100,18 @@ class HueCollection:
 
 		raise KeyError(skey)
 
-	def resolve_items(self, cache):
+	# Resolve item ID's from a dict of { id: obj }. If refresh is True,
+	# items that were already resolved are looked up again, so a
+	# collection can be pointed at newer objects.
+
+	def resolve_items(self, cache, refresh=False):
 		if not isinstance(cache, dict):
 			raise TypeError
 
+		if refresh:
+			self.unresolved_item_ids|= set(self.resolved_items.keys())
+			self.resolved_items= dict()
+
 		# Store our old set
 		need= set(self.unresolved_item_ids)
 
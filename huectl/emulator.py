@@ -0,0 +1,787 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import copy
+import json
+import random
+import secrets
+import threading
+import time
+from huectl.metrics import endpoint_template
+from huectl.ratelimit import HueTokenBucket
+
+#============================================================================
+# A fake Hue bridge, for benchmarks and offline testing.
+#
+# HueEmulator serves the v1 REST API (/api/<user>/...) that HueBridge
+# uses, from a datastore snapshot: the JSON that GET /api/<user> returns,
+# which is what `huemgr bridge-config -r` and friends are built from.
+# Objects are changed by PUT, POST and DELETE as the bridge would, so a
+# state change is seen by later reads.
+#
+#   with HueEmulator.load('datastore.json', latency=0.02) as emu:
+#       bridge= HueBridge(emu.address, user_id=emu.user_id, proto='http')
+#       ...
+#
+# To make it behave more like a real bridge:
+#
+#   latency     seconds to wait before answering. Either a number for
+#               every call, or a dict keyed by endpoint template as in
+#               huectl.metrics (e.g. 'scenes/{id}'), optionally prefixed
+#               with a method ('PUT lights/{id}/state'), with '*' as the
+#               default. A value can be a (min, max) tuple for a uniform
+#               random latency.
+#
+#   light_rate, group_rate, light_burst, group_burst
+#               ZigBee-like limits on light state and group action
+#               commands. Commands that arrive when the bridge's buffer
+#               is full are refused with error 901 (InternalError), as a
+#               real bridge does. A rate of 0 or None turns the limit off.
+#
+# Errors can be injected with inject_error(). The emulator runs on
+# 127.0.0.1 and a free port unless told otherwise. It can also be run on
+# its own:
+#
+#   python3 -m huectl.emulator datastore.json --port 8080
+#============================================================================
+
+# Error types, named after the exceptions HueBridge raises for them
+
+ErrorTypes= {
+	'UnauthorizedUser': 1,
+	'InvalidJSON': 2,
+	'ResourceUnavailable': 3,
+	'MethodNotAvailable': 4,
+	'MissingParameters': 5,
+	'ParameterUnavailable': 6,
+	'ParameterReadOnly': 7,
+	'TooMany': 8,
+	'PortalRequired': 9,
+	'InternalError': 901
+}
+
+# Object classes in the datastore
+Resources= ('lights', 'groups', 'scenes', 'sensors', 'rules', 'schedules',
+	'resourcelinks')
+
+# Configuration that's returned to users who aren't whitelisted
+PublicConfig= ('name', 'datastoreversion', 'swversion', 'apiversion', 'mac',
+	'bridgeid', 'factorynew', 'replacesbridgeid', 'modelid', 'starterkitid')
+
+# Light state attributes, and the color mode that setting them leaves a
+# light in
+LightStateAttrs= ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect')
+ColorModes= { 'xy': 'xy', 'ct': 'ct', 'hue': 'hs', 'sat': 'hs' }
+
+# Ranges for the *_inc attributes
+IncRanges= { 'bri': (1, 254), 'sat': (0, 254), 'hue': (0, 65535),
+	'ct': (153, 500) }
+
+#----------------------------------------------------------------------------
+# An error to send back to the client. status is the HTTP status, for
+# errors that don't come from the API itself.
+#----------------------------------------------------------------------------
+
+class HueEmulatorError(Exception):
+	def __init__(self, code, address, description, status=200):
+		super().__init__(description)
+		self.code= code
+		self.address= address
+		self.description= description
+		self.status= status
+
+	def response(self):
+		return [{ 'error': { 'type': self.code, 'address': self.address,
+			'description': self.description } }]
+
+#----------------------------------------------------------------------------
+# The emulator
+#----------------------------------------------------------------------------
+
+class HueEmulator:
+	UserId= 'emulator'
+
+	# Commands per second, and commands the bridge will buffer
+	LightRate= 10
+	GroupRate= 1
+	LightBurst= 20
+	GroupBurst= 2
+
+	def __init__(self, datastore=None, user_id=UserId, host='127.0.0.1',
+		port=0, latency=None, light_rate=LightRate, group_rate=GroupRate,
+		light_burst=LightBurst, group_burst=GroupBurst, seed=None):
+
+		self.user_id= user_id
+		self.host= host
+		self.port= port
+		self.latency= latency
+		self.random= random.Random(seed)
+		self.server= None
+		self.thread= None
+		self.link_button= False
+
+		self.datastore= _new_datastore(datastore)
+		self.datastore['config']['whitelist'].setdefault(user_id,
+			_whitelist_entry('emulator#huectl'))
+
+		self.buckets= {
+			'light': HueTokenBucket(light_rate, burst=light_burst) if light_rate else None,
+			'group': HueTokenBucket(group_rate, burst=group_burst) if group_rate else None
+		}
+
+		# Injected errors, and the number of calls by method and endpoint
+		self.errors= list()
+		self.counts= dict()
+
+		self._lock= threading.RLock()
+
+	@classmethod
+	def load(cls, path, **kwargs):
+		with open(path) as fp:
+			return cls(json.load(fp), **kwargs)
+
+	#------------------------------------------------------------
+	# Server
+	#------------------------------------------------------------
+
+	def start(self):
+		self.server= ThreadingHTTPServer((self.host, self.port),
+			_handler_class(self))
+		self.server.daemon_threads= True
+		self.port= self.server.server_address[1]
+
+		self.thread= threading.Thread(target=self.server.serve_forever,
+			name='HueEmulator', daemon=True)
+		self.thread.start()
+
+		return self
+
+	def stop(self):
+		if self.server is None:
+			return
+
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+		self.server= None
+		self.thread= None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+	# What to pass to HueBridge as the address
+
+	@property
+	def address(self):
+		return f'{self.host}:{self.port}'
+
+	def press_link_button(self):
+		self.link_button= True
+
+	#------------------------------------------------------------
+	# Error injection
+	#------------------------------------------------------------
+
+	# Answer calls to endpoint (a template as in latency, or '*' for all
+	# calls) with an error: a name from ErrorTypes, or an int HTTP
+	# status. Each matching call fails with probability rate, up to
+	# count times in all. Returns the rule, for remove_error().
+
+	def inject_error(self, error, endpoint='*', method=None, rate=1.0,
+		count=None):
+
+		if isinstance(error, str):
+			if error not in ErrorTypes:
+				raise ValueError(f'error: unknown error type {error}')
+		elif not isinstance(error, int):
+			raise TypeError(f'error: expected str or int not {type(error)}')
+
+		rule= {
+			'error': error,
+			'endpoint': endpoint,
+			'method': method,
+			'rate': rate,
+			'count': count
+		}
+
+		with self._lock:
+			self.errors.append(rule)
+
+		return rule
+
+	def remove_error(self, rule):
+		with self._lock:
+			self.errors.remove(rule)
+
+	def clear_errors(self):
+		with self._lock:
+			self.errors= list()
+
+	def _injected_error(self, method, template, address):
+		with self._lock:
+			for rule in self.errors:
+				if rule['endpoint'] not in ('*', template):
+					continue
+				if rule['method'] is not None and rule['method'] != method:
+					continue
+				if rule['count'] is not None and rule['count'] <= 0:
+					continue
+				if self.random.random() >= rule['rate']:
+					continue
+
+				if rule['count'] is not None:
+					rule['count']-= 1
+
+				error= rule['error']
+				if isinstance(error, int):
+					return HueEmulatorError(None, address, 'Injected error',
+						status=error)
+
+				return HueEmulatorError(ErrorTypes[error], address,
+					f'Injected error {error}')
+
+		return None
+
+	#------------------------------------------------------------
+	# Requests
+	#------------------------------------------------------------
+
+	# Handle one call, and return the HTTP status and the reply
+
+	def handle(self, method, path, body):
+		parts= list(filter(None, path.split('?')[0].split('/')))
+		address= '/' + '/'.join(parts[2:])
+
+		if len(parts) < 2:
+			template= '/'.join(parts)
+		else:
+			template= endpoint_template('/'.join(parts[2:]) or None)
+
+		with self._lock:
+			key= f'{method} {template}'
+			self.counts[key]= self.counts.get(key, 0) + 1
+
+		self._delay(method, template)
+
+		try:
+			if not len(parts) or parts[0] != 'api':
+				raise HueEmulatorError(4, path,
+					f'method, {method}, not available for resource, {path}',
+					status=404)
+
+			error= self._injected_error(method, template, address)
+			if error is not None:
+				raise error
+
+			data= None
+			if body:
+				try:
+					data= json.loads(body)
+				except ValueError:
+					raise HueEmulatorError(2, address,
+						'body contains invalid json')
+
+			with self._lock:
+				return 200, self._dispatch(method, parts[1:], data)
+		except HueEmulatorError as e:
+			if e.code is None:
+				return e.status, ''
+
+			return e.status, e.response()
+
+	def _delay(self, method, template):
+		latency= self.latency
+		if isinstance(latency, dict):
+			for key in (f'{method} {template}', template, '*'):
+				if key in latency:
+					latency= latency[key]
+					break
+			else:
+				latency= None
+
+		if latency is None:
+			return
+
+		if isinstance(latency, tuple):
+			latency= self.random.uniform(*latency)
+
+		if latency > 0:
+			time.sleep(latency)
+
+	def _dispatch(self, method, parts, data):
+		# Creating a user
+		if not len(parts):
+			if method != 'POST':
+				raise HueEmulatorError(4, '/',
+					f'method, {method}, not available for resource, /')
+			return self._create_user(data)
+
+		user= parts[0]
+		path= parts[1:]
+		address= '/' + '/'.join(path)
+		ds= self.datastore
+
+		if user not in ds['config']['whitelist']:
+			# Anyone can see the public configuration
+			if method == 'GET' and path == ['config']:
+				return dict(map(lambda x: (x, ds['config'].get(x)),
+					PublicConfig))
+
+			raise HueEmulatorError(1, address, 'unauthorized user')
+
+		if method == 'GET':
+			return self._get(path, address)
+		elif method == 'PUT':
+			return self._put(path, address, data)
+		elif method == 'POST':
+			return self._post(path, address, data)
+		elif method == 'DELETE':
+			return self._delete(path, address)
+
+		raise HueEmulatorError(4, address,
+			f'method, {method}, not available for resource, {address}')
+
+	def _create_user(self, data):
+		if not isinstance(data, dict) or 'devicetype' not in data:
+			raise HueEmulatorError(5, '/', 'invalid value for parameter, devicetype')
+
+		if not self.link_button:
+			raise HueEmulatorError(101, '', 'link button not pressed')
+
+		user_id= secrets.token_hex(20)
+		self.datastore['config']['whitelist'][user_id]= _whitelist_entry(
+			data['devicetype'])
+
+		rv= { 'username': user_id }
+		# As HueBridge.create_user sends it
+		if data.get('generate clientkey'):
+			rv['clientkey']= secrets.token_hex(16).upper()
+
+		return [{ 'success': rv }]
+
+	def _get(self, path, address):
+		ds= self.datastore
+
+		if not len(path):
+			rv= dict(map(lambda x: (x, ds[x]), ('config',) + Resources))
+			rv['scenes']= self._scene_list()
+			return rv
+
+		if path == ['scenes']:
+			return self._scene_list()
+
+		if len(path) == 2 and path[0] == 'scenes':
+			return self._scene(path[1], address)
+
+		return _walk(ds, path, address)
+
+	# Scenes are listed without their light states
+
+	def _scene_list(self):
+		return dict(map(lambda x: (x[0], _without(x[1], 'lightstates')),
+			self.datastore['scenes'].items()))
+
+	# A scene in full. If the snapshot didn't have its light states, use
+	# the lights' current states.
+
+	def _scene(self, sceneid, address):
+		scene= _walk(self.datastore, ['scenes', sceneid], address)
+		if 'lightstates' not in scene:
+			lights= self.datastore['lights']
+			scene['lightstates']= dict(map(lambda x: (x, _scene_state(
+				lights.get(x, dict()).get('state', dict()))), scene['lights']))
+
+		return scene
+
+	def _put(self, path, address, data):
+		if not isinstance(data, dict):
+			raise HueEmulatorError(2, address, 'body contains invalid json')
+
+		if len(path) == 3 and path[0] == 'lights' and path[2] == 'state':
+			_find(self.datastore, path, address)
+			self._limit('light', address)
+			return self._set_light(path[1], data, address)
+
+		if len(path) == 3 and path[0] == 'groups' and path[2] == 'action':
+			if path[1] != '0':
+				_find(self.datastore, path, address)
+			self._limit('group', address)
+			return self._group_action(path[1], data, address)
+
+		target= _find(self.datastore, path, address)
+		if not isinstance(target, dict):
+			raise HueEmulatorError(4, address,
+				f'method, PUT, not available for resource, {address}')
+
+		rv= list()
+		for attr, value in data.items():
+			target[attr]= value
+			rv.append({ 'success': { f'{address}/{attr}': value } })
+
+		if len(path) > 1 and path[0] == 'scenes':
+			self.datastore['scenes'][path[1]]['lastupdated']= _now()
+
+		return rv
+
+	def _post(self, path, address, data):
+		if len(path) != 1 or path[0] not in Resources:
+			raise HueEmulatorError(4, address,
+				f'method, POST, not available for resource, {address}')
+
+		oclass= path[0]
+
+		# Searching for new lights and sensors never finds anything
+		if oclass in ('lights', 'sensors'):
+			return [{ 'success': { address: 'Searching for new devices' } }]
+
+		if not isinstance(data, dict):
+			raise HueEmulatorError(2, address, 'body contains invalid json')
+
+		objects= self.datastore[oclass]
+		if oclass == 'scenes':
+			oid= secrets.token_hex(8)[:15]
+		else:
+			oid= str(max(map(int, filter(str.isdigit, objects.keys())),
+				default=0) + 1)
+
+		obj= copy.deepcopy(data)
+		now= _now()
+
+		if oclass == 'groups':
+			obj.setdefault('type', 'LightGroup')
+			obj.setdefault('lights', list())
+			obj.setdefault('sensors', list())
+			obj.setdefault('recycle', False)
+			obj.setdefault('action', { 'on': False })
+		elif oclass == 'scenes':
+			obj.setdefault('type', 'LightScene')
+			obj.setdefault('lights', list())
+			obj.setdefault('owner', self.user_id)
+			obj.setdefault('recycle', False)
+			obj.setdefault('locked', False)
+			obj.setdefault('version', 2)
+			obj['lastupdated']= now
+			if 'lightstates' not in obj:
+				lights= self.datastore['lights']
+				obj['lightstates']= dict(map(lambda x: (x, _scene_state(
+					lights.get(x, dict()).get('state', dict()))), obj['lights']))
+		elif oclass == 'schedules':
+			obj.setdefault('status', 'enabled')
+			obj['created']= now
+		elif oclass == 'rules':
+			obj.setdefault('status', 'enabled')
+			obj['owner']= self.user_id
+			obj['created']= now
+			obj['lasttriggered']= 'none'
+			obj['timestriggered']= 0
+
+		objects[oid]= obj
+		if oclass == 'groups':
+			self._update_groups()
+
+		return [{ 'success': { 'id': oid } }]
+
+	def _delete(self, path, address):
+		if len(path) != 2 or path[0] not in Resources:
+			raise HueEmulatorError(4, address,
+				f'method, DELETE, not available for resource, {address}')
+
+		_find(self.datastore, path, address)
+		del self.datastore[path[0]][path[1]]
+
+		return [{ 'success': f'{address} deleted' }]
+
+	# Refuse a command if the ZigBee buffer is full
+
+	def _limit(self, kind, address):
+		bucket= self.buckets[kind]
+		if bucket is None:
+			return
+
+		if bucket.wait_time() > 0:
+			raise HueEmulatorError(901, address, 'Internal error, 503')
+
+		bucket.reserve()
+
+	#------------------------------------------------------------
+	# Light state
+	#------------------------------------------------------------
+
+	def _set_light(self, lightid, data, address):
+		state= self.datastore['lights'][lightid]['state']
+		rv= _apply_state(state, data, address)
+		self._update_groups()
+
+		return rv
+
+	def _group_action(self, groupid, data, address):
+		ds= self.datastore
+		if groupid == '0':
+			lightids= list(ds['lights'].keys())
+			action= None
+		else:
+			lightids= ds['groups'][groupid]['lights']
+			action= ds['groups'][groupid].setdefault('action', dict())
+
+		data= dict(data)
+		rv= list()
+
+		sceneid= data.pop('scene', None)
+		if sceneid is not None:
+			scene= self._scene(sceneid, f'/scenes/{sceneid}')
+			for lightid, lstate in scene['lightstates'].items():
+				if lightid in lightids and lightid in ds['lights']:
+					_apply_state(ds['lights'][lightid]['state'], lstate, address)
+			rv.append({ 'success': { f'{address}/scene': sceneid } })
+
+		if len(data):
+			# Each light only takes the attributes it supports, as on a
+			# real bridge
+			for lightid in lightids:
+				if lightid in ds['lights']:
+					state= ds['lights'][lightid]['state']
+					_apply_state(state, dict(filter(lambda x:
+						_supports(state, x[0]), data.items())), address)
+
+			if action is not None:
+				rv+= _apply_state(action, data, address)
+			else:
+				rv+= list(map(lambda x: { 'success': { f'{address}/{x[0]}': x[1] } },
+					filter(lambda x: x[0] != 'transitiontime', data.items())))
+
+		self._update_groups()
+
+		return rv
+
+	def _update_groups(self):
+		lights= self.datastore['lights']
+		for group in self.datastore['groups'].values():
+			on= list(map(lambda x: lights[x]['state'].get('on', False),
+				filter(lambda x: x in lights, group.get('lights', list()))))
+			group['state']= { 'all_on': len(on) > 0 and all(on),
+				'any_on': any(on) }
+
+#----------------------------------------------------------------------------
+# HTTP request handler
+#----------------------------------------------------------------------------
+
+def _handler_class(emulator):
+	class HueEmulatorHandler(BaseHTTPRequestHandler):
+		# Keep connections alive, so connection pooling works
+		protocol_version= 'HTTP/1.1'
+
+		# Headers and body are written separately. Without this, Nagle's
+		# algorithm holds the body back until the client's delayed ACK.
+		disable_nagle_algorithm= True
+
+		def _handle(self):
+			length= int(self.headers.get('Content-Length', 0))
+			body= self.rfile.read(length) if length else None
+
+			status, reply= emulator.handle(self.command, self.path, body)
+			if self.command == 'HEAD':
+				data= b''
+			else:
+				data= bytes(reply if isinstance(reply, str) else json.dumps(reply), 'utf-8')
+
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		do_GET= _handle
+		do_PUT= _handle
+		do_POST= _handle
+		do_DELETE= _handle
+		do_HEAD= _handle
+
+		def log_message(self, *args):
+			pass
+
+	return HueEmulatorHandler
+
+#----------------------------------------------------------------------------
+# Datastore helpers
+#----------------------------------------------------------------------------
+
+def _new_datastore(datastore):
+	ds= copy.deepcopy(datastore) if datastore is not None else dict()
+
+	for oclass in Resources:
+		ds.setdefault(oclass, dict())
+
+	config= ds.setdefault('config', dict())
+	for attr, value in _default_config().items():
+		config.setdefault(attr, value)
+
+	return ds
+
+def _default_config():
+	now= _now()
+	return {
+		'name': 'Hue Emulator',
+		'datastoreversion': '98',
+		'swversion': '1941132080',
+		'apiversion': '1.41.0',
+		'mac': '00:17:88:00:00:00',
+		'bridgeid': '001788FFFE000000',
+		'factorynew': False,
+		'replacesbridgeid': None,
+		'modelid': 'BSB002',
+		'starterkitid': '',
+		'ipaddress': '127.0.0.1',
+		'netmask': '255.0.0.0',
+		'gateway': '127.0.0.1',
+		'dhcp': False,
+		'proxyaddress': 'none',
+		'proxyport': 0,
+		'zigbeechannel': 15,
+		'UTC': now,
+		'localtime': now,
+		'timezone': 'UTC',
+		'linkbutton': False,
+		'portalservices': False,
+		'portalconnection': 'disconnected',
+		'portalstate': { 'signedon': False, 'incoming': False,
+			'outgoing': False, 'communication': 'disconnected' },
+		'internetservices': { 'internet': 'disconnected',
+			'remoteaccess': 'disconnected', 'time': 'disconnected',
+			'swupdate': 'disconnected' },
+		'backup': { 'status': 'idle', 'errorcode': 0 },
+		'swupdate2': dict(),
+		'whitelist': dict()
+	}
+
+def _whitelist_entry(name):
+	now= _now()
+	return { 'name': name, 'create date': now, 'last use date': now }
+
+def _now():
+	return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+# Follow a path into the datastore
+
+def _find(ds, path, address):
+	obj= ds
+	for part in path:
+		if not isinstance(obj, dict) or part not in obj:
+			raise HueEmulatorError(3, address,
+				f'resource, {address}, not available')
+		obj= obj[part]
+
+	return obj
+
+# The same, but return a copy that's safe to hand out
+
+def _walk(ds, path, address):
+	return copy.deepcopy(_find(ds, path, address))
+
+def _without(d, attr):
+	return dict(filter(lambda x: x[0] != attr, d.items()))
+
+def _scene_state(state):
+	rv= { 'on': state.get('on', False) }
+	if 'bri' in state:
+		rv['bri']= state['bri']
+
+	mode= state.get('colormode')
+	if mode == 'xy' and 'xy' in state:
+		rv['xy']= state['xy']
+	elif mode == 'ct' and 'ct' in state:
+		rv['ct']= state['ct']
+	elif mode == 'hs' and 'hue' in state:
+		rv['hue']= state['hue']
+		rv['sat']= state['sat']
+
+	return rv
+
+# Apply a light state change, as the bridge would, and return the
+# success responses.
+
+def _supports(state, attr):
+	if attr == 'transitiontime':
+		return True
+	if attr.endswith('_inc'):
+		attr= attr[:-4]
+
+	return attr in state or attr not in LightStateAttrs
+
+def _apply_state(state, data, address):
+	rv= list()
+
+	for attr, value in data.items():
+		if attr == 'transitiontime':
+			continue
+
+		if attr.endswith('_inc'):
+			base= attr[:-4]
+			if base == 'xy':
+				value= list(map(lambda x: min(max(x[0] + x[1], 0), 1),
+					zip(state.get('xy', [0, 0]), value)))
+			elif base in IncRanges:
+				lo, hi= IncRanges[base]
+				if base == 'hue':
+					value= (state.get(base, 0) + value) % (hi+1)
+				else:
+					value= min(max(state.get(base, lo) + value, lo), hi)
+			else:
+				raise HueEmulatorError(6, f'{address}/{attr}',
+					f'parameter, {attr}, not available')
+			attr= base
+		elif attr not in LightStateAttrs:
+			raise HueEmulatorError(6, f'{address}/{attr}',
+				f'parameter, {attr}, not available')
+
+		state[attr]= value
+		if attr in ColorModes and 'colormode' in state:
+			state['colormode']= ColorModes[attr]
+
+		rv.append({ 'success': { f'{address}/{attr}': value } })
+
+	return rv
+
+#----------------------------------------------------------------------------
+# Run the emulator on its own
+#----------------------------------------------------------------------------
+
+def main():
+	parser= ArgumentParser(description='Run a fake Hue bridge')
+	parser.add_argument('datastore', nargs='?',
+		help='JSON datastore snapshot, as returned by GET /api/<user>')
+	parser.add_argument('-H', '--host', default='127.0.0.1',
+		help='Address to listen on')
+	parser.add_argument('-p', '--port', type=int, default=8080,
+		help='Port to listen on')
+	parser.add_argument('-u', '--user-id', default=HueEmulator.UserId,
+		help='User id to whitelist')
+	parser.add_argument('-l', '--latency', type=float,
+		help='Seconds to wait before answering each call')
+	parser.add_argument('-L', '--link-button', action='store_true',
+		help='Press the link button, so new users can be registered')
+	args= parser.parse_args()
+
+	kwargs= dict(user_id=args.user_id, host=args.host, port=args.port,
+		latency=args.latency)
+
+	if args.datastore is None:
+		emu= HueEmulator(**kwargs)
+	else:
+		emu= HueEmulator.load(args.datastore, **kwargs)
+
+	if args.link_button:
+		emu.press_link_button()
+
+	emu.start()
+	print(f'Emulating a bridge at {emu.address} for user {emu.user_id}')
+
+	try:
+		emu.thread.join()
+	except KeyboardInterrupt:
+		emu.stop()
+
+if __name__ == '__main__':
+	main()
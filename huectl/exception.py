@@ -71,3 +71,8 @@ class PortalRequired(HueGenericException):
 class InternalError(HueGenericException):
 	pass
 
+
+# Record/replay (see huectl.transport)
+
+class NotRecorded(Exception):
+	pass
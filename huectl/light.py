@@ -484,12 +484,89 @@ class HueLightStateChange:
 
 		self.change['effect']= effect
 
+	# Fold another state change (or a raw change dict) into this one, as
+	# if it had been sent after us. Later values override earlier ones,
+	# except for increments: two increments add together, and an
+	# increment applied after an absolute value adjusts that value.
+
+	def merge(self, other):
+		if isinstance(other, HueLightStateChange):
+			change= other.change
+		elif isinstance(other, dict):
+			change= other
+		else:
+			raise TypeError('other: expected HueLightStateChange or dict not '+str(type(other)))
+
+		for k, v in change.items():
+			if k.endswith('_inc'):
+				attr= k[:-4]
+				if attr in self.change:
+					self.change[attr]= _apply_increment(attr, self.change[attr], v)
+				elif k in self.change:
+					self.change[k]= _add_increments(attr, self.change[k], v)
+				else:
+					self.change[k]= _copy_value(v)
+			else:
+				self.change[k]= _copy_value(v)
+				if k+'_inc' in self.change:
+					del self.change[k+'_inc']
+
+		return self
+
 	def definition(self):
 		return self.change
 
 	def __str__(self):
 		return json.dumps(self.change)
 
+# Ranges, in bridge units, for attributes that can be changed by
+# increments: the valid values, and the largest allowed increment.
+
+_increment_ranges= {
+	'bri': (HueColor.range_bri, 254),
+	'sat': (HueColorHSB.range_sat, 254),
+	'hue': (HueColorHSB.range_hue, 65534),
+	'ct': ((153, 500), 65534),
+	'xy': ((0, 1), 0.5)
+}
+
+def _clamp(val, lo, hi):
+	return max(lo, min(hi, val))
+
+def _copy_value(v):
+	if isinstance(v, list):
+		return list(v)
+	return v
+
+def _apply_increment(attr, val, inc):
+	lo, hi= _increment_ranges[attr][0]
+
+	if attr == 'xy':
+		return [ round(_clamp(a+b, lo, hi), 4) for a,b in zip(val, inc) ]
+
+	# Hue wraps around, like the bridge does for hue_inc
+	if attr == 'hue':
+		return (val+inc) % (hi+1)
+
+	return _clamp(val+inc, lo, hi)
+
+def _add_increments(attr, inc1, inc2):
+	limit= _increment_ranges[attr][1]
+
+	if attr == 'xy':
+		return [ round(_clamp(a+b, -limit, limit), 4) for a,b in zip(inc1, inc2) ]
+
+	# More than a full turn of hue is the same as a partial one
+	if attr == 'hue':
+		inc= inc1+inc2
+		if inc > limit:
+			inc-= limit+2
+		elif inc < -limit:
+			inc+= limit+2
+		return inc
+
+	return _clamp(inc1+inc2, -limit, limit)
+
 #============================================================================
 # A Hue light
 #
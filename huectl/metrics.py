@@ -0,0 +1,296 @@
+from bisect import bisect_left
+import json
+import os
+import os.path
+import tempfile
+import threading
+
+#============================================================================
+# Request-level metrics for bridge calls.
+#
+# HueMetrics records every call a bridge makes: the endpoint, with object
+# ids replaced by {id} so that calls to the same API are grouped together,
+# the method and HTTP status, the size of the response, how long it took
+# to parse, and the end-to-end latency. Latency, parse time and response
+# size are kept in histograms.
+#
+#   metrics= HueMetrics()
+#   bridge= HueBridge(addr, user_id=user_id, metrics=metrics)
+#   ...
+#   metrics.write_prometheus('/var/lib/node_exporter/hue.prom')
+#
+# Comparing latency with parse time tells our own JSON handling apart
+# from the bridge. The command scheduler's statistics are exported
+# alongside, since time spent waiting to send light and group commands
+# (to avoid saturating the ZigBee network) doesn't show up in latency.
+#
+# Any function can be added to a bridge with add_call_hook. It's called
+# as hook(endpoint, method, status, nbytes, parse_time, latency) after
+# every call, including ones that fail. status is None if the bridge
+# couldn't be reached.
+#============================================================================
+
+# Resource classes whose second path element is an object id
+IdResources= ('lights', 'groups', 'scenes', 'sensors', 'rules', 'schedules',
+	'resourcelinks')
+
+# Turn an endpoint into a template, e.g. lights/5/state becomes
+# lights/{id}/state. The full datastore is '/'.
+
+def endpoint_template(endpoint):
+	if endpoint is None:
+		return '/'
+
+	parts= endpoint.strip('/').split('/')
+	if len(parts) > 1 and parts[0] in IdResources and parts[1] != 'new':
+		parts[1]= '{id}'
+
+	return '/'.join(parts)
+
+#----------------------------------------------------------------------------
+# A histogram with fixed bucket upper bounds, as in Prometheus. Bucket
+# counts are not cumulative here; they're made cumulative on export.
+#----------------------------------------------------------------------------
+
+class HueHistogram:
+	def __init__(self, buckets):
+		self.buckets= tuple(sorted(buckets))
+		self.counts= [0]*(len(self.buckets)+1)
+		self.sum= 0
+		self.count= 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)]+= 1
+		self.sum+= value
+		self.count+= 1
+
+	# Estimate a quantile by interpolating within its bucket. Values in
+	# the overflow bucket are reported as the largest bound.
+
+	def quantile(self, q):
+		if not self.count:
+			return None
+
+		rank= q*self.count
+		seen= 0
+		lower= 0
+		for i, n in enumerate(self.counts):
+			if i == len(self.buckets):
+				return self.buckets[-1]
+
+			upper= self.buckets[i]
+			if seen + n >= rank and n:
+				return lower + (upper-lower)*(rank-seen)/n
+
+			seen+= n
+			lower= upper
+
+		return self.buckets[-1]
+
+	def cumulative(self):
+		total= 0
+		rv= list()
+		for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+			total+= n
+			rv.append((bound, total))
+
+		return rv
+
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'p50': self.quantile(0.5),
+			'p95': self.quantile(0.95),
+			'p99': self.quantile(0.99),
+			'buckets': dict(map(lambda x: (_format_bound(x[0]), x[1]),
+				self.cumulative()))
+		}
+
+#----------------------------------------------------------------------------
+# Metrics for one endpoint template and method
+#----------------------------------------------------------------------------
+
+class HueEndpointMetrics:
+	def __init__(self, endpoint, method):
+		self.endpoint= endpoint
+		self.method= method
+		self.statuses= dict()
+		self.latency= HueHistogram(HueMetrics.LatencyBuckets)
+		self.parse_time= HueHistogram(HueMetrics.ParseBuckets)
+		self.size= HueHistogram(HueMetrics.SizeBuckets)
+
+	def record(self, status, nbytes, parse_time, latency):
+		key= 'error' if status is None else str(status)
+		self.statuses[key]= self.statuses.get(key, 0) + 1
+
+		self.latency.observe(latency)
+		if status is not None:
+			self.parse_time.observe(parse_time)
+			self.size.observe(nbytes)
+
+	def as_dict(self):
+		return {
+			'endpoint': self.endpoint,
+			'method': self.method,
+			'statuses': dict(self.statuses),
+			'latency': self.latency.as_dict(),
+			'parse_time': self.parse_time.as_dict(),
+			'size': self.size.as_dict()
+		}
+
+#----------------------------------------------------------------------------
+# Metrics for all of a bridge's calls
+#----------------------------------------------------------------------------
+
+class HueMetrics:
+	# Histogram bucket bounds: seconds for latency and parse time, and
+	# bytes for response size.
+	LatencyBuckets= (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+	ParseBuckets= (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+	SizeBuckets= (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+	# Prefix for exported metric names
+	Prefix= 'hue'
+
+	def __init__(self):
+		self.endpoints= dict()
+		self.scheduler= None
+		self._lock= threading.Lock()
+
+	# Start recording a bridge's calls
+
+	def attach(self, bridge):
+		bridge.add_call_hook(self.record)
+		self.scheduler= bridge.scheduler
+
+	def record(self, endpoint, method, status, nbytes, parse_time, latency):
+		key= (endpoint_template(endpoint), method)
+
+		with self._lock:
+			m= self.endpoints.get(key)
+			if m is None:
+				m= self.endpoints[key]= HueEndpointMetrics(*key)
+
+			m.record(status, nbytes, parse_time, latency)
+
+	def clear(self):
+		with self._lock:
+			self.endpoints= dict()
+
+	#------------------------------------------------------------
+	# Export
+	#------------------------------------------------------------
+
+	def as_dict(self):
+		with self._lock:
+			d= {
+				'endpoints': list(map(lambda x: x.as_dict(),
+					self.endpoints.values()))
+			}
+
+		if self.scheduler is not None:
+			d['scheduler']= self.scheduler.stats()
+
+		return d
+
+	def json(self, indent=None):
+		return json.dumps(self.as_dict(), indent=indent)
+
+	# The Prometheus text exposition format
+
+	def prometheus(self):
+		p= HueMetrics.Prefix
+		lines= list()
+
+		with self._lock:
+			endpoints= list(self.endpoints.values())
+
+			_prom_header(lines, f'{p}_requests_total', 'counter',
+				'Calls to the bridge by endpoint, method and HTTP status')
+			for m in endpoints:
+				for status, n in m.statuses.items():
+					labels= _prom_labels(endpoint=m.endpoint, method=m.method,
+						status=status)
+					lines.append(f'{p}_requests_total{{{labels}}} {n}')
+
+			for attr, name, desc in (
+				('latency', 'request_duration_seconds',
+					'End-to-end call latency, including parsing'),
+				('parse_time', 'response_parse_seconds',
+					'Time spent parsing responses'),
+				('size', 'response_bytes', 'Response size')
+			):
+				_prom_header(lines, f'{p}_{name}', 'histogram', desc)
+				for m in endpoints:
+					_prom_histogram(lines, f'{p}_{name}', getattr(m, attr),
+						endpoint=m.endpoint, method=m.method)
+
+		if self.scheduler is not None:
+			stats= self.scheduler.stats()
+			for key, name, mtype, desc in (
+				('commands', 'commands_total', 'counter',
+					'Light and group commands sent'),
+				('delayed', 'commands_delayed_total', 'counter',
+					'Commands held back by the scheduler'),
+				('total_wait', 'command_wait_seconds_total', 'counter',
+					'Time commands spent waiting to be sent'),
+				('queued', 'command_queue_depth', 'gauge',
+					'Commands waiting to be sent')
+			):
+				_prom_header(lines, f'{p}_{name}', mtype, desc)
+				for kind, st in stats.items():
+					lines.append(f'{p}_{name}{{{_prom_labels(kind=kind)}}} {st[key]}')
+
+		return '\n'.join(lines) + '\n'
+
+	# Write the metrics to a file, atomically so a collector never sees
+	# a partial file.
+
+	def write_prometheus(self, path):
+		_write_atomic(path, self.prometheus())
+
+	def write_json(self, path, indent=None):
+		_write_atomic(path, self.json(indent=indent))
+
+def _format_bound(bound):
+	if bound == float('inf'):
+		return '+Inf'
+
+	return repr(bound)
+
+def _prom_header(lines, name, mtype, desc):
+	lines.append(f'# HELP {name} {desc}')
+	lines.append(f'# TYPE {name} {mtype}')
+
+def _prom_labels(**labels):
+	return ','.join(map(lambda x: f'{x[0]}="{_prom_escape(x[1])}"',
+		labels.items()))
+
+def _prom_escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _prom_histogram(lines, name, hist, **labels):
+	for bound, n in hist.cumulative():
+		l= _prom_labels(**labels, le=_format_bound(bound))
+		lines.append(f'{name}_bucket{{{l}}} {n}')
+
+	l= _prom_labels(**labels)
+	lines.append(f'{name}_sum{{{l}}} {hist.sum}')
+	lines.append(f'{name}_count{{{l}}} {hist.count}')
+
+def _write_atomic(path, text):
+	path= os.path.expanduser(path)
+	fd, newfile= tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+		prefix='.', suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'w') as fp:
+			fp.write(text)
+
+		os.replace(newfile, path)
+	except:
+		try:
+			os.unlink(newfile)
+		except OSError:
+			pass
+		raise
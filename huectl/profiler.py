@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+import sys
+import threading
+import time
+
+#============================================================================
+# Time spent in each phase of a run, e.g. loading the cache, probing the
+# bridge's protocol, network calls and parsing objects.
+#
+#   profiler= HueProfiler()
+#   bridge= HueBridge(addr, user_id=user_id, profiler=profiler)
+#   with profiler.phase('my phase'):
+#       ...
+#   profiler.report()
+#
+# Phases nest and can overlap. Network calls happen inside most of the
+# other phases, for example, so the phase times don't add up to the
+# total run time. Network time is taken from the bridge's call hooks, and
+# excludes parsing the response, which is reported as "json parse".
+#============================================================================
+
+class HueProfiler:
+	def __init__(self):
+		self.started= time.perf_counter()
+
+		# { phase: [ calls, seconds ] }, in the order they were first seen
+		self.phases= dict()
+		self._lock= threading.Lock()
+
+	@contextmanager
+	def phase(self, name):
+		t= time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - t)
+
+	def add(self, name, seconds, calls=1):
+		with self._lock:
+			p= self.phases.get(name)
+			if p is None:
+				self.phases[name]= [calls, seconds]
+			else:
+				p[0]+= calls
+				p[1]+= seconds
+
+	# Start timing a bridge's network calls
+
+	def attach(self, bridge):
+		bridge.add_call_hook(self._record_call)
+
+	def _record_call(self, endpoint, method, status, nbytes, parse_time, latency):
+		self.add('network', latency - parse_time)
+		if parse_time:
+			self.add('json parse', parse_time)
+
+	def elapsed(self):
+		return time.perf_counter() - self.started
+
+	def as_dict(self):
+		with self._lock:
+			phases= dict(map(lambda x: (x[0], { 'calls': x[1][0],
+				'seconds': x[1][1] }), self.phases.items()))
+
+		return { 'total': self.elapsed(), 'phases': phases }
+
+	def report(self, fp=None):
+		if fp is None:
+			fp= sys.stderr
+
+		total= self.elapsed()
+
+		print(f'{"Phase":<20}{"Calls":>7}{"Total ms":>11}{"% of run":>10}', file=fp)
+		with self._lock:
+			for name, (calls, seconds) in self.phases.items():
+				pct= 100*seconds/total if total else 0
+				print(f'{name:<20}{calls:>7}{1000*seconds:>11.2f}{pct:>10.1f}',
+					file=fp)
+
+		print(f'{"run":<20}{"":>7}{1000*total:>11.2f}', file=fp)
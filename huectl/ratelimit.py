@@ -0,0 +1,193 @@
+import asyncio
+import threading
+import time
+
+#============================================================================
+# Rate limiting for commands sent to the bridge.
+#
+# The bridge can only push so much traffic onto the ZigBee network. The
+# Hue API documentation recommends no more than about 10 light commands
+# per second, and about 1 group command per second, since a group command
+# is a broadcast. Commands sent faster than that are queued or dropped
+# by the bridge, which shows up as lights changing one after another (the
+# "popcorn effect") or not at all.
+#============================================================================
+
+#----------------------------------------------------------------------------
+# A token bucket, implemented as a generic cell rate algorithm: rather
+# than counting tokens, keep track of the time at which the bucket will
+# next be empty. Each command reserves the next available slot, so
+# callers are released in the order they arrived.
+#
+# burst commands can be sent back to back before pacing kicks in.
+#----------------------------------------------------------------------------
+
+class HueTokenBucket:
+	def __init__(self, rate, burst=1):
+		if rate <= 0:
+			raise ValueError(f'rate: must be positive not {rate}')
+
+		if burst < 1:
+			raise ValueError(f'burst: must be at least 1 not {burst}')
+
+		self.rate= rate
+		self.burst= burst
+		self._interval= 1/rate
+		self._tat= 0
+		self._lock= threading.Lock()
+
+		# Statistics
+		self.queued= 0
+		self.commands= 0
+		self.delayed= 0
+		self.total_wait= 0.0
+		self.max_wait= 0.0
+
+	# How long a command that was submitted now would have to wait
+
+	def wait_time(self):
+		with self._lock:
+			now= time.monotonic()
+			return self._wait(now, max(self._tat, now))
+
+	def _wait(self, now, tat):
+		return max(0, tat - (self.burst-1)*self._interval - now)
+
+	# Reserve the next slot and return the number of seconds until it
+	# comes up.
+
+	def reserve(self):
+		with self._lock:
+			now= time.monotonic()
+			tat= max(self._tat, now)
+			wait= self._wait(now, tat)
+			self._tat= tat + self._interval
+
+			self.commands+= 1
+			if wait > 0:
+				self.delayed+= 1
+				self.total_wait+= wait
+				self.max_wait= max(self.max_wait, wait)
+
+			return wait
+
+	# Block until a command can be sent. Returns the time spent waiting.
+
+	def acquire(self):
+		wait= self.reserve()
+		if wait > 0:
+			self._enqueue(1)
+			try:
+				time.sleep(wait)
+			finally:
+				self._enqueue(-1)
+
+		return wait
+
+	async def acquire_async(self):
+		wait= self.reserve()
+		if wait > 0:
+			self._enqueue(1)
+			try:
+				await asyncio.sleep(wait)
+			finally:
+				self._enqueue(-1)
+
+		return wait
+
+	def _enqueue(self, n):
+		with self._lock:
+			self.queued+= n
+
+	def stats(self):
+		with self._lock:
+			return {
+				'rate': self.rate,
+				'burst': self.burst,
+				'queued': self.queued,
+				'commands': self.commands,
+				'delayed': self.delayed,
+				'total_wait': self.total_wait,
+				'max_wait': self.max_wait
+			}
+
+#----------------------------------------------------------------------------
+# Paces light and group commands separately. A rate of 0 or None turns
+# off pacing for that kind of command.
+#----------------------------------------------------------------------------
+
+class HueCommandScheduler:
+	Light= 'light'
+	Group= 'group'
+
+	# Commands per second
+	LightRate= 10
+	GroupRate= 1
+
+	# Commands that can be sent back to back
+	LightBurst= 1
+	GroupBurst= 1
+
+	def __init__(self, light_rate=LightRate, group_rate=GroupRate,
+		light_burst=LightBurst, group_burst=GroupBurst):
+
+		self.buckets= {
+			HueCommandScheduler.Light: None,
+			HueCommandScheduler.Group: None
+		}
+
+		if light_rate:
+			self.buckets[HueCommandScheduler.Light]= HueTokenBucket(light_rate,
+				burst=light_burst)
+
+		if group_rate:
+			self.buckets[HueCommandScheduler.Group]= HueTokenBucket(group_rate,
+				burst=group_burst)
+
+	def _bucket(self, kind):
+		if kind not in self.buckets:
+			raise ValueError(f'kind: expected light or group not {kind}')
+
+		return self.buckets[kind]
+
+	def acquire(self, kind):
+		bucket= self._bucket(kind)
+		if bucket is None:
+			return 0
+
+		return bucket.acquire()
+
+	async def acquire_async(self, kind):
+		bucket= self._bucket(kind)
+		if bucket is None:
+			return 0
+
+		return await bucket.acquire_async()
+
+	# The number of commands waiting to be sent. With no kind, the total
+	# for both lights and groups.
+
+	def queue_depth(self, kind=None):
+		if kind is None:
+			return sum(map(lambda x: self.queue_depth(x), self.buckets.keys()))
+
+		bucket= self._bucket(kind)
+		if bucket is None:
+			return 0
+
+		return bucket.queued
+
+	def wait_time(self, kind):
+		bucket= self._bucket(kind)
+		if bucket is None:
+			return 0
+
+		return bucket.wait_time()
+
+	def stats(self):
+		d= dict()
+		for kind, bucket in self.buckets.items():
+			if bucket is not None:
+				d[kind]= bucket.stats()
+
+		return d
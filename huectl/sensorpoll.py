@@ -0,0 +1,266 @@
+import copy
+import threading
+import time
+import huectl.exception
+from huectl.sensor import HueSensorType
+
+#============================================================================
+# Poll sensors at rates that suit them.
+#
+# Switches and motion sensors need to be polled several times a second
+# to respond quickly, but temperature and daylight only change every few
+# minutes. HueSensorScheduler gives each sensor a polling interval based
+# on its type, and stretches it (up to max_backoff times) while the
+# sensor's state.lastupdated doesn't move. As soon as it moves, the
+# sensor goes back to its base interval.
+#
+# Sensors that come due within the same tick are fetched together with
+# one GET /sensors, which also refreshes every other sensor for free. A
+# single sensor that's due on its own is fetched by itself.
+#
+#   scheduler= HueSensorScheduler(bridge)
+#   scheduler.subscribe(on_change)
+#   scheduler.start()
+#
+# callback(sensorid, old, new) is called when a sensor's definition
+# changes. old is None for new sensors, and new is None for sensors that
+# have been deleted.
+#============================================================================
+
+class HueSensorScheduler:
+	# Base seconds between polls, by sensor type
+	Intervals= {
+		HueSensorType.ZLLSwitch: 0.25,
+		HueSensorType.ZGPSwitch: 0.25,
+		HueSensorType.ZLLRelativeRotary: 0.25,
+		HueSensorType.ZLLPresence: 0.5,
+		HueSensorType.CLIPSwitch: 1,
+		HueSensorType.CLIPPresence: 1,
+		HueSensorType.CLIPOpenClose: 1,
+		HueSensorType.CLIPGenericFlag: 2,
+		HueSensorType.CLIPGenericStatus: 2,
+		HueSensorType.ZLLLightlevel: 10,
+		HueSensorType.CLIPLightlevel: 10,
+		HueSensorType.ZLLTemperature: 60,
+		HueSensorType.CLIPTemperature: 60,
+		HueSensorType.CLIPHumidity: 60,
+		HueSensorType.Daylight: 300
+	}
+
+	# For types not listed above
+	DefaultInterval= 5
+
+	# Multiply the interval by Backoff each time a sensor hasn't changed,
+	# up to MaxBackoff times the base interval.
+	Backoff= 1.5
+	MaxBackoff= 8
+
+	# Sensors due within this many seconds of each other are polled
+	# together
+	Tick= 0.1
+
+	def __init__(self, bridge, intervals=None, backoff=Backoff,
+		max_backoff=MaxBackoff, tick=Tick):
+
+		self.bridge= bridge
+		self.intervals= dict(HueSensorScheduler.Intervals)
+		if intervals is not None:
+			self.intervals.update(intervals)
+
+		self.backoff= backoff
+		self.max_backoff= max_backoff
+		self.tick= tick
+
+		# { sensorid: data } as last seen, and each sensor's schedule
+		# as { sensorid: [ next_due, factor ] }
+		self.sensors= None
+		self.schedule= dict()
+
+		self.subscribers= list()
+		self.poll_errors= list()
+		self.callback_errors= list()
+
+		# Statistics
+		self.batch_polls= 0
+		self.single_polls= 0
+		self.changes= 0
+
+		self._lock= threading.Lock()
+		self._stop= threading.Event()
+		self.thread= None
+
+	def subscribe(self, callback):
+		with self._lock:
+			self.subscribers.append(callback)
+
+		return callback
+
+	def unsubscribe(self, callback):
+		with self._lock:
+			self.subscribers.remove(callback)
+
+	# The base interval for a sensor, and the one it's polled at now
+
+	def base_interval(self, sensorid):
+		return self.intervals.get(self.sensors[sensorid].get('type'),
+			HueSensorScheduler.DefaultInterval)
+
+	def interval(self, sensorid):
+		return self.base_interval(sensorid)*self.schedule[sensorid][1]
+
+	#------------------------------------------------------------
+	# Polling
+	#------------------------------------------------------------
+
+	# Poll the sensors that are due. Returns the ids of the sensors that
+	# changed, and the number of seconds until the next one is due.
+
+	def poll_due(self):
+		now= time.monotonic()
+
+		if self.sensors is None:
+			due= None
+		else:
+			due= list(filter(lambda x: x[1][0] <= now + self.tick,
+				self.schedule.items()))
+
+		changed= list()
+		try:
+			if due is None or len(due) > 1:
+				changed= self._poll_all(now)
+			elif len(due) == 1:
+				changed= self._poll_one(due[0][0], now)
+		except Exception as e:
+			self.poll_errors.append(e)
+
+			# Try again at the base interval rather than hammering a
+			# bridge that's having trouble.
+			if due is not None:
+				for sensorid, entry in due:
+					entry[0]= now + self.base_interval(sensorid)
+
+		if not len(self.schedule):
+			return changed, HueSensorScheduler.DefaultInterval
+
+		wait= min(map(lambda x: x[0], self.schedule.values())) - time.monotonic()
+
+		return changed, max(0, wait)
+
+	def _poll_all(self, now):
+		# Copy what the bridge returns, since its cache changes it in
+		# place.
+		data= copy.deepcopy(self.bridge.fetch('sensors'))
+
+		self.batch_polls+= 1
+
+		if self.sensors is None:
+			self.sensors= dict()
+
+		changed= list()
+		for sensorid in self.sensors.keys() - data.keys():
+			self._forget(sensorid)
+			changed.append(sensorid)
+
+		for sensorid, sdata in data.items():
+			if self._observe(sensorid, sdata, now):
+				changed.append(sensorid)
+
+		return changed
+
+	def _poll_one(self, sensorid, now):
+		self.single_polls+= 1
+
+		try:
+			data= copy.deepcopy(self.bridge.fetch('sensors', sensorid))
+		except huectl.exception.ResourceUnavailable:
+			self._forget(sensorid)
+			return [sensorid]
+
+		if self._observe(sensorid, data, now):
+			return [sensorid]
+
+		return list()
+
+	# Record a sensor's new data and schedule its next poll. Returns True
+	# if it changed.
+
+	def _observe(self, sensorid, data, now):
+		old= self.sensors.get(sensorid)
+		self.sensors[sensorid]= data
+
+		entry= self.schedule.get(sensorid)
+		if entry is None:
+			entry= self.schedule[sensorid]= [0, 1]
+		elif _moved(old, data):
+			entry[1]= 1
+		elif entry[0] <= now + self.tick:
+			# Only back off when the sensor was due. Seeing it early,
+			# as part of a batch, doesn't say much about its rate.
+			entry[1]= min(entry[1]*self.backoff, self.max_backoff)
+
+		entry[0]= now + self.interval(sensorid)
+
+		if old == data:
+			return False
+
+		self.changes+= 1
+		self._notify(sensorid, old, data)
+
+		return True
+
+	def _forget(self, sensorid):
+		old= self.sensors.pop(sensorid, None)
+		self.schedule.pop(sensorid, None)
+		self._notify(sensorid, old, None)
+
+	def _notify(self, sensorid, old, new):
+		with self._lock:
+			subscribers= list(self.subscribers)
+
+		for callback in subscribers:
+			try:
+				callback(sensorid, old, new)
+			except Exception as e:
+				self.callback_errors.append(e)
+
+	def run(self):
+		while not self._stop.is_set():
+			changed, wait= self.poll_due()
+			self._stop.wait(wait)
+
+	def start(self):
+		self._stop.clear()
+		self.thread= threading.Thread(target=self.run,
+			name='HueSensorScheduler', daemon=True)
+		self.thread.start()
+
+		return self
+
+	def stop(self):
+		self._stop.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread= None
+
+	def stats(self):
+		return {
+			'sensors': len(self.schedule),
+			'batch_polls': self.batch_polls,
+			'single_polls': self.single_polls,
+			'changes': self.changes
+		}
+
+# Whether a sensor has reported since we last saw it. Sensors without a
+# lastupdated time are compared on their whole state.
+
+def _moved(old, new):
+	if old is None:
+		return True
+
+	ostate= old.get('state', dict())
+	nstate= new.get('state', dict())
+
+	if 'lastupdated' in nstate:
+		return ostate.get('lastupdated') != nstate['lastupdated']
+
+	return ostate != nstate
@@ -0,0 +1,279 @@
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import huectl.exception
+
+#============================================================================
+# How HueBridge sends HTTP requests.
+#
+# A transport has a request(session, method, url, **kwargs) method that
+# returns a response with status_code and text attributes, and raises
+# the requests exceptions on failure. HueTransport, the default, sends
+# the request with the bridge's requests session.
+#
+# HueRecorder wraps another transport and writes every request, its
+# response and how long it took to a file, one JSON object per line.
+# HueReplayer serves a recording back, with the recorded latency or a
+# multiple of it, so that slow traffic seen against a real bridge can be
+# reproduced, and optimizations measured, without the bridge.
+#
+#   bridge= HueBridge(addr, user_id=user_id,
+#       transport=HueRecorder('scenes.rec'))
+#   ...
+#   bridge= HueBridge(addr, user_id=user_id, proto='http',
+#       transport=HueReplayer('scenes.rec', latency_scale=0.5))
+#
+# User ids and client keys are credentials, so they're left out of
+# recordings. The user id in the URL is recorded as {user}, and any other
+# user id that turns up (whitelist entries, the username create_user
+# gets back, scene owners and so on) as {user1}, {user2}, etc. Client
+# keys are recorded as {clientkey}. When replaying, {user} is replaced
+# with the replaying bridge's user id. Pass proto to HueBridge when
+# replaying, since the TLS probe can't be replayed.
+#============================================================================
+
+class HueTransport:
+	def request(self, session, method, url, **kwargs):
+		return session.request(method, url, **kwargs)
+
+	def close(self):
+		pass
+
+#----------------------------------------------------------------------------
+# A recorded response
+#----------------------------------------------------------------------------
+
+class HueReplayResponse:
+	def __init__(self, status_code, text):
+		self.status_code= status_code
+		self.text= text
+
+#----------------------------------------------------------------------------
+# Record requests and responses
+#----------------------------------------------------------------------------
+
+class HueRecorder(HueTransport):
+	def __init__(self, path, transport=None):
+		if transport is None:
+			transport= HueTransport()
+
+		self.transport= transport
+		self.fp= open(path, 'w')
+		self._lock= threading.Lock()
+
+		# User ids seen so far, and what they're recorded as
+		self.users= dict()
+
+	def request(self, session, method, url, **kwargs):
+		users= self._users(_user(url))
+		record= {
+			'method': method,
+			'path': _redact(url, users),
+			'body': _redact_json(_body(kwargs.get('data')), users)
+		}
+
+		t= time.perf_counter()
+		try:
+			response= self.transport.request(session, method, url, **kwargs)
+		except requests.exceptions.RequestException as e:
+			record['error']= type(e).__name__
+			record['elapsed']= time.perf_counter() - t
+			self._write(record)
+			raise
+
+		record['elapsed']= time.perf_counter() - t
+		record['status']= response.status_code
+		record['text']= _redact_json(response.text, self._users(None,
+			response.text))
+		self._write(record)
+
+		return response
+
+	# Add the user id from the URL, and any found in a response, to the
+	# ones we know. Returns a copy to redact with.
+
+	def _users(self, user, text=None):
+		found= list()
+		if text is not None:
+			try:
+				_find_users(json.loads(text), found)
+			except ValueError:
+				pass
+
+		with self._lock:
+			if _is_user(user):
+				self.users[user]= '{user}'
+
+			for user in found:
+				if _is_user(user) and user not in self.users:
+					self.users[user]= '{user%d}' % (len(list(filter(
+						lambda x: x != '{user}', self.users.values()))) + 1)
+
+			return dict(self.users)
+
+	def _write(self, record):
+		with self._lock:
+			if self.fp.closed:
+				return
+
+			self.fp.write(json.dumps(record) + '\n')
+			self.fp.flush()
+
+	def close(self):
+		with self._lock:
+			self.fp.close()
+
+		self.transport.close()
+
+#----------------------------------------------------------------------------
+# Replay a recording. Requests are matched on method, path and body, and
+# answered in the order they were recorded. Once a request's responses
+# run out, the last one is repeated. A request whose body doesn't match
+# falls back to any recording of the same method and path.
+#
+# Latency is the recorded latency times latency_scale: 0 replays as fast
+# as possible.
+#----------------------------------------------------------------------------
+
+class HueReplayer(HueTransport):
+	def __init__(self, path, latency_scale=1.0):
+		self.latency_scale= latency_scale
+
+		# { key: [ records, next ] }
+		self.records= dict()
+		self._lock= threading.Lock()
+
+		with open(path) as fp:
+			for line in fp:
+				if not line.strip():
+					continue
+
+				record= json.loads(line)
+				for key in ((record['method'], record['path'], record['body']),
+					(record['method'], record['path'])):
+
+					self.records.setdefault(key, [list(), 0])[0].append(record)
+
+	def request(self, session, method, url, **kwargs):
+		user= _user(url)
+		users= { user: '{user}' } if _is_user(user) else dict()
+		path= _redact(url, users)
+
+		record= self._next((method, path, _redact_json(_body(kwargs.get('data')),
+			users)))
+		if record is None:
+			record= self._next((method, path))
+		if record is None:
+			raise huectl.exception.NotRecorded(f'{method} {path}')
+
+		if self.latency_scale:
+			time.sleep(record['elapsed']*self.latency_scale)
+
+		if 'error' in record:
+			error= getattr(requests.exceptions, record['error'],
+				requests.exceptions.ConnectionError)
+			raise error(f'Recorded {record["error"]}')
+
+		text= record['text']
+		if len(users):
+			text= text.replace('{user}', user)
+
+		return HueReplayResponse(record['status'], text)
+
+	def _next(self, key):
+		with self._lock:
+			if key not in self.records:
+				return None
+
+			entry= self.records[key]
+			records, n= entry
+			if n < len(records) - 1:
+				entry[1]+= 1
+
+			return records[n]
+
+#----------------------------------------------------------------------------
+# Redaction
+#----------------------------------------------------------------------------
+
+# Short ids, such as the '0' used before a bridge has a user, aren't real
+# user ids and would match far too much
+MinUserLength= 8
+
+def _is_user(user):
+	return user is not None and len(user) >= MinUserLength
+
+# The user id in a URL, if there is one
+
+def _user(url):
+	parts= urlsplit(url).path.split('/')
+	if len(parts) > 2 and parts[1] == 'api':
+		return parts[2]
+
+	return None
+
+# The path of a URL, with user ids replaced
+
+def _redact(url, users):
+	parts= urlsplit(url).path.split('/')
+	if len(parts) > 2 and parts[1] == 'api':
+		parts[2]= '{user}'
+
+	return '/'.join(map(lambda x: users.get(x, x), parts))
+
+# Collect the user ids in a reply: the keys of a whitelist, and the
+# username that creating a user returns
+
+def _find_users(obj, found):
+	if isinstance(obj, dict):
+		for k, v in obj.items():
+			if k == 'whitelist' and isinstance(v, dict):
+				found+= v.keys()
+			elif k == 'username' and isinstance(v, str):
+				found.append(v)
+			else:
+				_find_users(v, found)
+	elif isinstance(obj, list):
+		for v in obj:
+			_find_users(v, found)
+
+# Replace user ids and client keys in a JSON body. User ids are replaced
+# wherever they're a key, a value or part of a path. Bodies that aren't
+# JSON are left alone.
+
+def _redact_json(text, users):
+	if text is None:
+		return None
+
+	try:
+		obj= json.loads(text)
+	except ValueError:
+		return text
+
+	return json.dumps(_replace(obj, users))
+
+def _replace(obj, users):
+	if isinstance(obj, dict):
+		rv= dict()
+		for k, v in obj.items():
+			if k == 'clientkey' and isinstance(v, str):
+				v= '{clientkey}'
+			rv[users.get(k, k)]= _replace(v, users)
+		return rv
+	elif isinstance(obj, list):
+		return list(map(lambda x: _replace(x, users), obj))
+	elif isinstance(obj, str):
+		return '/'.join(map(lambda x: users.get(x, x), obj.split('/')))
+
+	return obj
+
+def _body(data):
+	if data is None:
+		return None
+
+	if isinstance(data, bytes):
+		return data.decode('utf-8')
+
+	return data
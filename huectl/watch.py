@@ -0,0 +1,357 @@
+import copy
+from datetime import datetime, timezone
+import threading
+import time
+
+#============================================================================
+# Watch the bridge for changes.
+#
+# The v1 API has no way to push changes to us, so HueWatcher polls each
+# object class at its own interval, compares each object with what it
+# saw last time, attribute by attribute, and sends an event for every
+# change to the callbacks that want it.
+#
+#   watcher= HueWatcher(bridge, intervals={ 'sensors': 0.25 })
+#   watcher.subscribe(on_button, types=HueEvent.Button)
+#   watcher.start()
+#
+# Known changes get their own event type: lights and groups going on and
+# off, brightness and color, sensors reporting presence and button
+# presses, and things becoming unreachable. Anything else is a Changed
+# event. The first poll of each class only records a baseline, unless
+# initial is True, in which case every object is reported as Added.
+#
+# If the bridge has a cache, the polls keep it up to date, so one watcher
+# can feed every other user of the bridge.
+#
+# Sensors can be polled by a HueSensorScheduler (see huectl.sensorpoll)
+# instead, at rates that suit each one.
+#============================================================================
+
+#----------------------------------------------------------------------------
+# A change to one attribute of one object. attr is a dotted path, e.g.
+# state.bri. For Added and Removed events, attr is None and new or old
+# is the whole object.
+#----------------------------------------------------------------------------
+
+class HueEvent:
+	Added= 'added'
+	Removed= 'removed'
+	Changed= 'changed'
+
+	On= 'on'
+	Off= 'off'
+	Brightness= 'brightness'
+	Color= 'color'
+	Reachable= 'reachable'
+	Unreachable= 'unreachable'
+
+	Presence= 'presence'
+	Button= 'button'
+	SensorState= 'sensor_state'
+
+	def __init__(self, etype, oclass, oid, attr=None, old=None, new=None,
+		timestamp=None):
+		self.type= etype
+		self.oclass= oclass
+		self.oid= oid
+		self.attr= attr
+		self.old= old
+		self.new= new
+		self.time= time.time() if timestamp is None else timestamp
+
+	def __str__(self):
+		s= f'<HueEvent> {self.type} {self.oclass}/{self.oid}'
+		if self.attr is not None:
+			s+= f' {self.attr} {self.old} -> {self.new}'
+
+		return s
+
+	def as_dict(self):
+		return {
+			'time': datetime.fromtimestamp(self.time,
+				timezone.utc).isoformat(timespec='milliseconds'),
+			'type': self.type,
+			'class': self.oclass,
+			'id': self.oid,
+			'attr': self.attr,
+			'old': self.old,
+			'new': self.new
+		}
+
+#----------------------------------------------------------------------------
+# The watcher
+#----------------------------------------------------------------------------
+
+class HueWatcher:
+	# Seconds between polls of each class
+	Intervals= {
+		'lights': 1.0,
+		'groups': 2.0,
+		'sensors': 0.5
+	}
+
+	# Light state attributes that make up its color
+	ColorAttrs= ('hue', 'sat', 'xy', 'ct', 'colormode')
+
+	def __init__(self, bridge, intervals=None, initial=False,
+		sensor_scheduler=None):
+		self.bridge= bridge
+		self.initial= initial
+
+		self.intervals= dict(HueWatcher.Intervals)
+		if intervals is not None:
+			self.intervals.update(intervals)
+			self.intervals= dict(filter(lambda x: x[1],
+				self.intervals.items()))
+
+		self.sensor_scheduler= sensor_scheduler
+		if sensor_scheduler is not None:
+			self.intervals.pop('sensors', None)
+
+		# { oclass: { oid: data } } from the last poll of each class
+		self.snapshot= dict()
+		self.next_poll= dict.fromkeys(self.intervals.keys(), 0)
+
+		self.subscribers= list()
+		self.poll_errors= list()
+		self.callback_errors= list()
+
+		self._lock= threading.Lock()
+		self._stop= threading.Event()
+		self.thread= None
+
+	#------------------------------------------------------------
+	# Callbacks
+	#------------------------------------------------------------
+
+	# Call callback(event) for events of the given types (one type or a
+	# list), classes and object ids. None means all of them. Returns a
+	# handle for unsubscribe().
+
+	def subscribe(self, callback, types=None, oclass=None, oid=None):
+		sub= (callback, _as_set(types), _as_set(oclass), _as_set(oid))
+		with self._lock:
+			self.subscribers.append(sub)
+
+		return sub
+
+	def unsubscribe(self, sub):
+		with self._lock:
+			self.subscribers.remove(sub)
+
+	def _emit(self, events):
+		with self._lock:
+			subscribers= list(self.subscribers)
+
+		for event in events:
+			for callback, types, oclasses, oids in subscribers:
+				if types is not None and event.type not in types:
+					continue
+				if oclasses is not None and event.oclass not in oclasses:
+					continue
+				if oids is not None and event.oid not in oids:
+					continue
+
+				try:
+					callback(event)
+				except Exception as e:
+					# A broken callback mustn't stop the others
+					self.callback_errors.append(e)
+
+	#------------------------------------------------------------
+	# Polling
+	#------------------------------------------------------------
+
+	# Poll one class now, and return the events it produced after
+	# sending them to subscribers.
+
+	def poll(self, oclass):
+		return self._update(oclass, self._fetch(oclass), time.time())
+
+	def _update(self, oclass, data, now):
+		with self._lock:
+			old= self.snapshot.get(oclass)
+			self.snapshot[oclass]= data
+
+		if old is None:
+			if not self.initial:
+				return list()
+			old= dict()
+
+		events= self.diff(oclass, old, data, now)
+		self._emit(events)
+
+		return events
+
+	# The bridge's cache keeps the data it returns, and changes it in
+	# place as changes are written through, so take our own copy to
+	# compare against next time.
+
+	def _fetch(self, oclass):
+		return copy.deepcopy(self.bridge.fetch(oclass))
+
+	# Poll every class that's due. Returns the events, and the number
+	# of seconds until the next poll is due.
+
+	def poll_due(self):
+		events= list()
+		now= time.monotonic()
+
+		for oclass, interval in self.intervals.items():
+			if self.next_poll[oclass] > now:
+				continue
+
+			self.next_poll[oclass]= now + interval
+			try:
+				events+= self.poll(oclass)
+			except Exception as e:
+				self.poll_errors.append(e)
+
+		waits= list(map(lambda x: x - time.monotonic(),
+			self.next_poll.values()))
+
+		sched= self.sensor_scheduler
+		if sched is not None:
+			changed, wait= sched.poll_due()
+			waits.append(wait)
+
+			while len(sched.poll_errors):
+				self.poll_errors.append(sched.poll_errors.pop(0))
+
+			if sched.sensors is not None and (len(changed) or
+				'sensors' not in self.snapshot):
+				events+= self._update('sensors', dict(sched.sensors),
+					time.time())
+
+		return events, max(0, min(waits, default=1))
+
+	# Poll until stop() is called
+
+	def run(self):
+		while not self._stop.is_set():
+			events, wait= self.poll_due()
+			self._stop.wait(wait)
+
+	def start(self):
+		self._stop.clear()
+		self.thread= threading.Thread(target=self.run, name='HueWatcher',
+			daemon=True)
+		self.thread.start()
+
+		return self
+
+	def stop(self):
+		self._stop.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread= None
+
+	#------------------------------------------------------------
+	# Comparing snapshots
+	#------------------------------------------------------------
+
+	def diff(self, oclass, old, new, now=None):
+		if now is None:
+			now= time.time()
+
+		events= list()
+
+		for oid in old.keys() - new.keys():
+			events.append(HueEvent(HueEvent.Removed, oclass, oid,
+				old=old[oid], timestamp=now))
+
+		for oid, data in new.items():
+			if oid not in old:
+				events.append(HueEvent(HueEvent.Added, oclass, oid, new=data,
+					timestamp=now))
+			elif old[oid] != data:
+				events+= self._diff_object(oclass, oid, old[oid], data, now)
+
+		return events
+
+	def _diff_object(self, oclass, oid, old, new, now):
+		events= list()
+		changes= _changes(_flatten(old), _flatten(new))
+
+		# A button pressed twice reports the same buttonevent with a new
+		# lastupdated.
+		if oclass == 'sensors' and 'state.lastupdated' in changes:
+			bstate= new.get('state', dict())
+			if 'buttonevent' in bstate and 'state.buttonevent' not in changes:
+				changes['state.buttonevent']= (bstate['buttonevent'],
+					bstate['buttonevent'])
+
+		for attr, (ov, nv) in changes.items():
+			etype= self._event_type(oclass, attr, nv)
+			if etype is None:
+				continue
+
+			events.append(HueEvent(etype, oclass, oid, attr=attr, old=ov,
+				new=nv, timestamp=now))
+
+		return events
+
+	def _event_type(self, oclass, attr, value):
+		section, sep, name= attr.rpartition('.')
+
+		if attr in ('state.reachable', 'config.reachable'):
+			return HueEvent.Reachable if value else HueEvent.Unreachable
+
+		if oclass == 'lights' and section == 'state':
+			if name == 'on':
+				return HueEvent.On if value else HueEvent.Off
+			elif name == 'bri':
+				return HueEvent.Brightness
+			elif name in HueWatcher.ColorAttrs:
+				return HueEvent.Color
+
+		elif oclass == 'groups':
+			if attr == 'state.any_on':
+				return HueEvent.On if value else HueEvent.Off
+
+		elif oclass == 'sensors' and section == 'state':
+			if name == 'lastupdated':
+				# Reported with the state that changed
+				return None
+			elif name == 'presence':
+				return HueEvent.Presence
+			elif name == 'buttonevent':
+				return HueEvent.Button
+
+			return HueEvent.SensorState
+
+		return HueEvent.Changed
+
+# Flatten an object's definition to { 'section.attr': value }. Lists and
+# anything deeper than one section are compared as a whole.
+
+def _flatten(data):
+	rv= dict()
+	for attr, value in data.items():
+		if isinstance(value, dict):
+			for sattr, svalue in value.items():
+				rv[f'{attr}.{sattr}']= svalue
+		else:
+			rv[attr]= value
+
+	return rv
+
+def _changes(old, new):
+	rv= dict()
+	for attr in list(new.keys()) + list(old.keys() - new.keys()):
+		ov= old.get(attr)
+		nv= new.get(attr)
+		if ov != nv:
+			rv[attr]= (ov, nv)
+
+	return rv
+
+def _as_set(value):
+	if value is None:
+		return None
+
+	if isinstance(value, str):
+		return { value }
+
+	return set(value)
@@ -0,0 +1,197 @@
+import os.path
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from huectl.emulator import HueEmulator
+
+#============================================================================
+# Shared fixtures. Most tests talk to a HueEmulator serving the small
+# datastore below, which has one light of each capability so that code
+# which depends on what a light supports gets exercised.
+#============================================================================
+
+Timestamp= '2020-01-01T00:00:00'
+
+def _light(name, modelid, ltype, state, control):
+	state= dict(state)
+	state.setdefault('alert', 'none')
+	state.setdefault('mode', 'homeautomation')
+	state.setdefault('reachable', True)
+
+	return {
+		'state': state,
+		'swupdate': { 'state': 'noupdates', 'lastinstall': Timestamp },
+		'type': ltype,
+		'name': name,
+		'modelid': modelid,
+		'manufacturername': 'Signify Netherlands B.V.',
+		'productname': ltype,
+		'capabilities': {
+			'certified': True,
+			'control': control,
+			'streaming': { 'renderer': False, 'proxy': False }
+		},
+		'config': { 'archetype': 'classicbulb', 'function': 'mixed',
+			'direction': 'omnidirectional' },
+		'uniqueid': f'00:17:88:01:00:00:00:{len(name):02x}-0b',
+		'swversion': '1.50.2_r30933'
+	}
+
+Gamut= [[0.6915, 0.3083], [0.17, 0.7], [0.1532, 0.0475]]
+
+def datastore():
+	lights= {
+		# Extended color
+		'1': _light('Color', 'LCT016', 'Extended color light',
+			{ 'on': True, 'bri': 254, 'hue': 8418, 'sat': 140,
+				'effect': 'none', 'xy': [0.4573, 0.41], 'ct': 366,
+				'colormode': 'ct' },
+			{ 'mindimlevel': 1000, 'maxlumen': 800, 'colorgamuttype': 'C',
+				'colorgamut': Gamut, 'ct': { 'min': 153, 'max': 500 } }),
+		# Color temperature only
+		'2': _light('Ambiance', 'LTW001', 'Color temperature light',
+			{ 'on': True, 'bri': 200, 'ct': 300, 'colormode': 'ct' },
+			{ 'mindimlevel': 1000, 'maxlumen': 800,
+				'ct': { 'min': 153, 'max': 454 } }),
+		# Dimmable only
+		'3': _light('White', 'LWB010', 'Dimmable light',
+			{ 'on': False, 'bri': 100 },
+			{ 'mindimlevel': 5000, 'maxlumen': 806 })
+	}
+
+	groups= {
+		'1': {
+			'name': 'Living room',
+			'lights': [ '1', '2', '3' ],
+			'sensors': list(),
+			'type': 'Room',
+			'class': 'Living room',
+			'recycle': False,
+			'state': { 'all_on': False, 'any_on': True },
+			'action': { 'on': True, 'bri': 254, 'hue': 8418, 'sat': 140,
+				'effect': 'none', 'xy': [0.4573, 0.41], 'ct': 366,
+				'alert': 'none', 'colormode': 'ct' }
+		}
+	}
+
+	scenes= {
+		'scene00000001': {
+			'name': 'Bright',
+			'type': 'GroupScene',
+			'group': '1',
+			'lights': [ '1', '2', '3' ],
+			'owner': HueEmulator.UserId,
+			'recycle': False,
+			'locked': False,
+			'appdata': dict(),
+			'picture': '',
+			'lastupdated': Timestamp,
+			'version': 2,
+			'lightstates': {
+				'1': { 'on': True, 'bri': 254, 'ct': 233 },
+				'2': { 'on': True, 'bri': 254, 'ct': 233 },
+				'3': { 'on': True, 'bri': 254 }
+			}
+		}
+	}
+
+	sensors= {
+		'1': _sensor('Dimmer', 'ZLLSwitch', { 'buttonevent': 1002 }),
+		'2': _sensor('Temperature', 'ZLLTemperature', { 'temperature': 2000 }),
+		'3': _sensor('Daylight', 'Daylight', { 'daylight': True })
+	}
+
+	return {
+		'lights': lights,
+		'groups': groups,
+		'scenes': scenes,
+		'sensors': sensors,
+		'rules': dict(),
+		'schedules': dict(),
+		'resourcelinks': dict()
+	}
+
+def _sensor(name, stype, state):
+	state= dict(state)
+	state['lastupdated']= Timestamp
+
+	return { 'name': name, 'type': stype, 'modelid': stype,
+		'manufacturername': 'Signify Netherlands B.V.', 'swversion': '1.0',
+		'state': state, 'config': { 'on': True, 'reachable': True } }
+
+@pytest.fixture
+def emulator():
+	# Turn off the command limits so tests don't have to wait for them
+	emu= HueEmulator(datastore(), light_rate=None, group_rate=None)
+	emu.start()
+	yield emu
+	emu.stop()
+
+# Make bridges connected to the emulator. They're closed afterwards.
+
+@pytest.fixture
+def make_bridge(emulator):
+	from huectl.bridge import HueBridge
+
+	bridges= list()
+
+	def make(**kwargs):
+		kwargs.setdefault('user_id', emulator.user_id)
+		kwargs.setdefault('proto', 'http')
+		bridge= HueBridge(emulator.address, **kwargs)
+		bridges.append(bridge)
+		return bridge
+
+	yield make
+
+	for bridge in bridges:
+		bridge.close()
+
+@pytest.fixture
+def cache_file(tmp_path):
+	return str(tmp_path / 'huecache')
+
+# Run huemgr against the emulator, with a configuration file (and cache)
+# in a temporary home directory. Returns the CompletedProcess. For
+# commands that keep running, huemgr.start() returns the Popen instead.
+
+Root= os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+@pytest.fixture
+def huemgr(emulator, tmp_path):
+	import subprocess
+
+	serial= emulator.datastore['config']['mac'].replace(':', '')
+	with open(tmp_path / '.huemgr', 'w') as fp:
+		fp.write(f'[DEFAULT]\ncache_file = {tmp_path / "cache"}\n'
+			f'default_bridge = {serial}\n\n[{serial}]\n'
+			f'addr = {emulator.address}\nname = Emulator\n'
+			f'user_id = {emulator.user_id}\nproto = http\n')
+
+	env= dict(os.environ)
+	env['HOME']= str(tmp_path)
+	env['PYTHONPATH']= os.pathsep.join(filter(None, [ Root,
+		env.get('PYTHONPATH') ]))
+
+	command= [ sys.executable, os.path.join(Root, 'huemgr') ]
+
+	def run(*args, timeout=30):
+		return subprocess.run(command + list(args), env=env, cwd=str(tmp_path),
+			capture_output=True, text=True, timeout=timeout)
+
+	def start(*args):
+		proc= subprocess.Popen(command + list(args), env=env, cwd=str(tmp_path),
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+		procs.append(proc)
+		return proc
+
+	procs= list()
+	run.start= start
+	yield run
+
+	for proc in procs:
+		if proc.poll() is None:
+			proc.kill()
+		proc.communicate()
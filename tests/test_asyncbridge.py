@@ -0,0 +1,93 @@
+import asyncio
+import inspect
+import pytest
+
+aiohttp= pytest.importorskip('aiohttp')
+
+from huectl.bridge import HueBridge
+from huectl.asyncbridge import AsyncHueBridge
+
+# HueBridge methods that only use data we already have, and so are safe
+# to inherit as they are
+Inherited= ('set_user_id', 'api_version', 'name', 'queue_depth',
+	'command_wait_time', 'set_cache_refresh', 'cache_ok', 'optimistic',
+	'cache_stats', 'save_cache', 'wait_refresh', 'add_call_hook',
+	'remove_call_hook')
+
+def run(emulator, fn):
+	async def main():
+		bridge= await AsyncHueBridge.connect(emulator.address,
+			user_id=emulator.user_id, proto='http')
+		try:
+			return await fn(bridge)
+		finally:
+			await bridge.close()
+
+	return asyncio.run(main())
+
+def test_every_public_method_is_async_or_safe():
+	for name, fn in inspect.getmembers(HueBridge, inspect.isfunction):
+		if name.startswith('_') or name in Inherited:
+			continue
+
+		method= getattr(AsyncHueBridge, name)
+		assert method is not fn, f'{name} is inherited from HueBridge'
+		assert inspect.iscoroutinefunction(method), f'{name} is not a coroutine'
+
+def test_get_and_set(emulator):
+	async def fn(bridge):
+		lights= await bridge.get_all_lights()
+		assert sorted(lights.keys()) == [ '1', '2', '3' ]
+
+		assert await bridge.set_light_state('3', { 'on': True })
+		return await bridge.get_light('3')
+
+	light= run(emulator, fn)
+	assert light.lightstate.on
+	assert emulator.datastore['lights']['3']['state']['on']
+
+def test_fanout(emulator):
+	async def fn(bridge):
+		return await bridge.set_light_states({ '1': { 'bri': 10 },
+			'2': { 'bri': 20 }, '99': { 'bri': 30 } })
+
+	rv= run(emulator, fn)
+	assert rv['1'] is True and rv['2'] is True
+	assert isinstance(rv['99'], Exception)
+	assert emulator.datastore['lights']['2']['state']['bri'] == 20
+
+def test_scenes_and_schedules(emulator):
+	emulator.datastore['schedules']['1']= { 'name': 'Wake up' }
+
+	async def fn(bridge):
+		sceneid= await bridge.create_scene({ 'name': 'Dim', 'lights': [ '1' ] })
+		await bridge.modify_scene({ 'name': 'Dimmer' }, sceneid)
+		assert emulator.datastore['scenes'][sceneid]['name'] == 'Dimmer'
+
+		assert await bridge.delete_scene(sceneid)
+		assert await bridge.delete_schedule('1')
+
+	run(emulator, fn)
+	assert len(emulator.datastore['scenes']) == 1
+	assert not len(emulator.datastore['schedules'])
+
+def test_configuration(emulator):
+	async def fn(bridge):
+		await bridge.modify_configuration(name='Emulated', zigbeechannel=20)
+		data= await bridge.refresh_all()
+		assert await bridge.prefetch('lights', 'groups') is False
+		return data
+
+	data= run(emulator, fn)
+	assert data['config']['name'] == 'Emulated'
+	assert data['config']['zigbeechannel'] == 20
+	assert sorted(data['lights'].keys()) == [ '1', '2', '3' ]
+
+def test_create_user(emulator):
+	emulator.press_link_button()
+
+	async def fn(bridge):
+		return await bridge.create_user('test', 'pytest')
+
+	user_id= run(emulator, fn)
+	assert user_id in emulator.datastore['config']['whitelist']
@@ -0,0 +1,41 @@
+import json
+import os
+import os.path
+import subprocess
+import sys
+from conftest import Root
+
+#============================================================================
+# The benchmarks aren't run for their timings here, just at the smallest
+# sizes to make sure they still work.
+#============================================================================
+
+def run(script, *args, tmp_path):
+	env= dict(os.environ)
+	env['PYTHONPATH']= os.pathsep.join(filter(None, [ Root,
+		env.get('PYTHONPATH') ]))
+
+	return subprocess.run([ sys.executable, os.path.join(Root, 'benchmarks',
+		script) ] + list(args), env=env, cwd=str(tmp_path),
+		capture_output=True, text=True, timeout=120)
+
+def test_hotpaths(tmp_path):
+	path= str(tmp_path / 'results.json')
+	rv= run('hotpaths.py', '--lights', '5', '--scenes', '5', '--rounds', '1',
+		'--output', path, tmp_path=tmp_path)
+	assert rv.returncode == 0, rv.stderr
+
+	with open(path) as fp:
+		results= json.load(fp)
+
+	assert results['sizes'][0]['lights'] == 5
+	timings= results['sizes'][0]['results']
+	for name in ('light.parse_definition', 'cache.load.binary',
+		'bridge.get_all_lights'):
+		assert timings[name]['rounds'] == 1
+
+def test_cache_format(tmp_path):
+	rv= run('cache_format.py', '--lights', '5', '--scenes', '5', '--rounds',
+		'1', tmp_path=tmp_path)
+	assert rv.returncode == 0, rv.stderr
+	assert 'binary' in rv.stdout
@@ -0,0 +1,148 @@
+import threading
+import time
+import requests
+import huectl.exception
+# Work around circular import
+import huectl.bridge
+from huectl.light import HueLightStateChange
+from huectl.ratelimit import HueCommandScheduler
+from huectl.transport import HueTransport
+
+#----------------------------------------------------------------------------
+# A transport that records what it's asked to send, and can fail the
+# first few GETs as if the bridge had gone away.
+#----------------------------------------------------------------------------
+
+class CountingTransport(HueTransport):
+	def __init__(self, fail=0):
+		self.requests= list()
+		self.fail= fail
+
+	def request(self, session, method, url, **kwargs):
+		self.requests.append((method, url))
+		if method == 'GET' and self.fail > 0:
+			self.fail-= 1
+			raise requests.exceptions.ConnectionError('Connection refused')
+
+		return super().request(session, method, url, **kwargs)
+
+	def methods(self):
+		return list(map(lambda x: x[0], self.requests))
+
+# Count the connections the emulator accepts
+
+def count_connections(emulator):
+	conns= list()
+	process= emulator.server.process_request
+
+	def counting(request, address):
+		conns.append(address)
+		process(request, address)
+
+	emulator.server.process_request= counting
+
+	return conns
+
+#----------------------------------------------------------------------------
+# Connection pooling
+#----------------------------------------------------------------------------
+
+def test_calls_share_one_connection(emulator, make_bridge):
+	conns= count_connections(emulator)
+	bridge= make_bridge()
+
+	for i in range(20):
+		bridge.get_all_lights()
+
+	assert len(conns) == 1
+
+def test_pool_size_limits_connections(emulator, make_bridge):
+	emulator.latency= 0.02
+	conns= count_connections(emulator)
+	bridge= make_bridge(pool_size=2)
+
+	errors= list()
+	def worker():
+		try:
+			for i in range(5):
+				bridge.get_light('1')
+		except Exception as e:
+			errors.append(e)
+
+	threads= list(map(lambda x: threading.Thread(target=worker), range(8)))
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert not len(errors)
+	assert len(conns) <= 2
+
+#----------------------------------------------------------------------------
+# Protocol negotiation
+#----------------------------------------------------------------------------
+
+def test_saved_protocol_skips_probe(make_bridge):
+	transport= CountingTransport()
+	bridge= make_bridge(proto='http', transport=transport)
+	bridge.get_all_lights()
+
+	assert 'HEAD' not in transport.methods()
+	assert bridge.proto == 'http'
+
+def test_probe_runs_once(make_bridge):
+	transport= CountingTransport()
+	bridge= make_bridge(proto=None, transport=transport)
+	bridge.get_all_lights()
+	bridge.get_all_groups()
+
+	# The emulator doesn't do TLS, so we fall back to http
+	assert transport.methods().count('HEAD') == 1
+	assert bridge.proto == 'http'
+
+def test_saved_protocol_is_probed_again_on_connection_error(make_bridge):
+	transport= CountingTransport(fail=1)
+	bridge= make_bridge(proto='http', transport=transport)
+
+	assert transport.methods() == [ 'GET', 'HEAD', 'GET' ]
+	assert bridge.config is not None
+
+	# Only once
+	transport.fail= 1
+	try:
+		bridge.get_all_lights()
+	except requests.exceptions.ConnectionError:
+		pass
+	else:
+		assert False, 'expected ConnectionError'
+
+	assert transport.methods().count('HEAD') == 1
+
+#----------------------------------------------------------------------------
+# Fan-out
+#----------------------------------------------------------------------------
+
+def test_light_states_are_sent_concurrently(emulator, make_bridge):
+	emulator.latency= { 'PUT lights/{id}/state': 0.2 }
+	bridge= make_bridge(scheduler=HueCommandScheduler(light_rate=None))
+
+	change= HueLightStateChange()
+	change.set_power(False)
+
+	t= time.monotonic()
+	rv= bridge.set_light_states({ '1': change, '2': change, '3': { 'on': False } })
+	elapsed= time.monotonic() - t
+
+	assert rv == { '1': True, '2': True, '3': True }
+	assert elapsed < 0.5
+	for light in emulator.datastore['lights'].values():
+		assert not light['state']['on']
+
+def test_fanout_reports_each_failure(make_bridge):
+	bridge= make_bridge(scheduler=HueCommandScheduler(group_rate=None))
+
+	rv= bridge.set_group_states({ '1': { 'on': True }, '7': { 'on': True } })
+
+	assert rv['1'] is True
+	assert isinstance(rv['7'], huectl.exception.ResourceUnavailable)
+	assert bridge.set_group_states(dict()) == dict()
@@ -0,0 +1,398 @@
+import copy
+import gc
+import os
+import os.path
+import subprocess
+import sys
+import time
+import pytest
+import huectl.bridge
+
+#============================================================================
+# HueBridge with a cache, against the emulator. emulator.counts has the
+# number of calls made to each endpoint, so it shows what came from the
+# cache and what didn't.
+#============================================================================
+
+def calls(emulator):
+	return sum(emulator.counts.values())
+
+#----------------------------------------------------------------------------
+# Datastore hydration
+#----------------------------------------------------------------------------
+
+def test_refresh_all_fills_every_class(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.refresh_all()
+
+	assert emulator.counts['GET /'] == 1
+	n= calls(emulator)
+
+	assert sorted(bridge.get_all_lights().keys()) == [ '1', '2', '3' ]
+	assert sorted(bridge.get_all_groups().keys()) == [ '1' ]
+	assert len(bridge.get_all_scenes()) == 1
+	assert len(bridge.get_all_sensors()) == 3
+	bridge.get_all_rules()
+	bridge.get_all_schedules()
+
+	assert calls(emulator) == n
+
+def test_prefetch_only_when_several_classes_are_stale(emulator, make_bridge,
+	cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+
+	bridge.get_all_lights()
+	assert not bridge.prefetch('lights', 'groups')
+	assert 'GET /' not in emulator.counts
+
+	assert bridge.prefetch('groups', 'scenes')
+	assert emulator.counts['GET /'] == 1
+
+	# Everything is current now
+	assert not bridge.prefetch('groups', 'scenes', 'lights')
+
+def test_prefetch_without_cache(make_bridge):
+	assert not make_bridge().prefetch('groups', 'scenes')
+
+#----------------------------------------------------------------------------
+# Parsed objects, and saving the cache when they keep the bridge alive
+#----------------------------------------------------------------------------
+
+def test_unchanged_objects_are_reused(emulator, make_bridge):
+	bridge= make_bridge(object_cache=True)
+
+	a= bridge.get_all_lights()
+	b= bridge.get_all_lights()
+	assert a['1'] is b['1']
+
+	emulator.datastore['lights']['1']['state']['bri']= 1
+	c= bridge.get_all_lights()
+	assert c['1'] is not a['1']
+	assert c['2'] is a['2']
+	assert c['1'].lightstate.bri == 1
+
+def test_close_saves_the_cache(make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file, object_cache=True)
+	bridge.get_all_lights()
+	bridge.close()
+
+	assert os.path.exists(os.path.join(cache_file, 'lights.json'))
+
+def test_failed_construction_is_collected_quietly(make_bridge, monkeypatch):
+	errors= list()
+	monkeypatch.setattr(sys, 'unraisablehook', errors.append)
+
+	with pytest.raises(TypeError):
+		make_bridge(bogus=True)
+
+	gc.collect()
+	assert not len(errors)
+
+Script= '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from huectl.bridge import HueBridge
+bridge= HueBridge(sys.argv[2], user_id=sys.argv[3], proto='http',
+	cache_file=sys.argv[4], object_cache=True)
+lights= bridge.get_all_lights()
+'''
+
+def test_unclosed_bridge_saves_at_exit(emulator, cache_file):
+	root= os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+	rv= subprocess.run([ sys.executable, '-c', Script, root, emulator.address,
+		emulator.user_id, cache_file ], capture_output=True, text=True,
+		timeout=30)
+
+	assert rv.returncode == 0
+	assert rv.stderr == ''
+	assert os.path.exists(os.path.join(cache_file, 'lights.json'))
+
+#----------------------------------------------------------------------------
+# Per-object freshness
+#----------------------------------------------------------------------------
+
+def test_stale_objects_are_refreshed_alone(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+
+	emulator.datastore['lights']['2']['name']= 'Renamed'
+	bridge.cache.mark_dirty('lights', '2')
+
+	lights= bridge.get_all_lights()
+	assert lights['2'].name == 'Renamed'
+	assert emulator.counts['GET lights'] == 1
+	assert emulator.counts['GET lights/{id}'] == 1
+
+def test_many_stale_objects_refresh_the_class(emulator, make_bridge, cache_file,
+	monkeypatch):
+	monkeypatch.setattr(huectl.bridge.HueBridge, 'MaxOidRefresh', 1)
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+
+	bridge.cache.mark_dirty('lights', '1')
+	bridge.cache.mark_dirty('lights', '2')
+	bridge.get_all_lights()
+
+	assert emulator.counts['GET lights'] == 2
+	assert 'GET lights/{id}' not in emulator.counts
+
+#----------------------------------------------------------------------------
+# Write-through
+#----------------------------------------------------------------------------
+
+def test_light_changes_are_written_through(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+
+	bridge.set_light_state('1', { 'xy': [0.3, 0.3], 'transitiontime': 4 })
+	assert bridge.cache.optimistic('lights', '1') == [ 'state/colormode',
+		'state/xy' ]
+
+	lights= bridge.get_all_lights()
+	assert lights['1'].lightstate.colormode == 'xy'
+	assert 'GET lights/{id}' not in emulator.counts
+	assert emulator.counts['GET lights'] == 1
+
+	# A fetch confirms the change
+	bridge.refresh_all()
+	assert bridge.cache.optimistic('lights', '1') == list()
+
+def test_increments_are_applied(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+
+	bridge.set_light_state('3', { 'bri_inc': 10 })
+	assert bridge.get_all_lights()['3'].lightstate.bri == 110
+
+def test_group_action_respects_light_capabilities(emulator, make_bridge,
+	cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+	bridge.get_all_groups()
+
+	bridge.set_group_state('1', { 'hue': 1000, 'bri': 50 })
+
+	# The color light is patched, and the others are fetched again
+	assert bridge.cache.optimistic('lights', '1') == [ 'state/bri',
+		'state/colormode', 'state/hue' ]
+	assert bridge.cache.stale_oids('lights') == [ '2', '3' ]
+
+	lights= bridge.get_all_lights()
+	assert lights['1'].lightstate.hs.hue == 1000
+	assert lights['1'].lightstate.colormode == 'hs'
+	assert 'hue' not in bridge.cache.lights['2']['state']
+	assert bridge.cache.lights['2']['state']['colormode'] == 'ct'
+	assert lights['3'].lightstate.bri == 50
+
+	bridge.save_cache()
+	assert 'hue' not in huectl.cache.HueCache(cache_file).lights['2']['state']
+
+def test_colormode_is_only_set_when_the_light_has_one(emulator, make_bridge,
+	cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+	bridge.get_all_groups()
+
+	bridge.set_group_state('1', { 'on': True, 'bri': 60 })
+
+	assert bridge.cache.stale_oids('lights') == list()
+	assert 'colormode' not in bridge.cache.lights['3']['state']
+	assert bridge.cache.lights['3']['state']['bri'] == 60
+
+#----------------------------------------------------------------------------
+# Stale-while-revalidate
+#----------------------------------------------------------------------------
+
+# A bridge whose cached lights expired age seconds ago
+
+def expired_lights(emulator, make_bridge, cache_file, age, **kwargs):
+	bridge= make_bridge(cache_file=cache_file, **kwargs)
+	bridge.cache.set_ttl('lights', 10)
+	bridge.cache.update({ 'lights': copy.deepcopy(emulator.datastore['lights']) },
+		timestamp=time.time() - 10 - age)
+	emulator.counts.clear()
+
+	emulator.datastore['lights']['1']['name']= 'Renamed'
+	return bridge
+
+def test_stale_class_is_served_then_refreshed(emulator, make_bridge,
+	cache_file):
+	bridge= expired_lights(emulator, make_bridge, cache_file, 5, max_stale=30)
+
+	assert bridge.get_all_lights()['1'].name == 'Color'
+	bridge.wait_refresh(5)
+
+	assert emulator.counts['GET lights'] == 1
+	assert bridge.cache_ok('lights')
+	assert bridge.get_all_lights()['1'].name == 'Renamed'
+	assert bridge.cache_stats()['lights']['stale_hits'] == 1
+
+def test_too_stale_is_fetched(emulator, make_bridge, cache_file):
+	bridge= expired_lights(emulator, make_bridge, cache_file, 60, max_stale=30)
+
+	assert bridge.get_all_lights()['1'].name == 'Renamed'
+	assert not bridge._refreshing
+
+def test_stale_is_not_served_by_default(emulator, make_bridge, cache_file):
+	bridge= expired_lights(emulator, make_bridge, cache_file, 5)
+
+	assert bridge.get_all_lights()['1'].name == 'Renamed'
+
+def test_background_errors_are_collected(emulator, make_bridge, cache_file):
+	bridge= expired_lights(emulator, make_bridge, cache_file, 5, max_stale=30)
+	emulator.inject_error('InternalError', endpoint='lights', method='GET')
+
+	assert bridge.get_all_lights()['1'].name == 'Color'
+	bridge.wait_refresh(5)
+
+	assert len(bridge.refresh_errors) == 1
+	assert bridge.refresh_errors[0][:2] == ('lights', None)
+	assert not bridge.cache_ok('lights')
+
+#----------------------------------------------------------------------------
+# Configuration
+#----------------------------------------------------------------------------
+
+def test_other_classes_are_cached(emulator, make_bridge, cache_file):
+	emulator.datastore['schedules']['1']= { 'name': 'Wake up',
+		'localtime': 'W127/T06:00:00', 'created': '2020-01-01T00:00:00',
+		'status': 'enabled', 'command': { 'address':
+		f'/api/{emulator.user_id}/groups/1/action', 'method': 'PUT',
+		'body': { 'on': True } } }
+	bridge= make_bridge(cache_file=cache_file)
+
+	for i in range(2):
+		assert len(bridge.get_all_sensors()) == 3
+		bridge.get_all_rules()
+		bridge.get_all_schedules()
+
+	for endpoint in ('sensors', 'rules', 'schedules'):
+		assert emulator.counts[f'GET {endpoint}'] == 1
+
+	assert bridge.delete_schedule('1')
+	assert bridge.get_all_schedules() == dict()
+	assert emulator.counts['GET schedules'] == 2
+
+def test_raw_results_come_from_the_bridge(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	getters= (bridge.get_all_sensors, bridge.get_all_rules,
+		bridge.get_all_schedules, bridge.get_all_lights, bridge.get_all_groups,
+		bridge.get_all_scenes, bridge.get_configuration)
+	for getter in getters:
+		getter()
+	bridge.save_cache()
+	n= calls(emulator)
+
+	for getter in getters:
+		assert isinstance(getter(raw=True), str)
+
+	assert calls(emulator) == n + len(getters)
+	assert not bridge.cache.dirty()
+
+def test_new_users_expire_the_config(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	emulator.press_link_button()
+	user_id= bridge.create_user('pytest', 'test')
+
+	assert not bridge.cache_ok('config')
+	assert user_id in list(map(lambda x: x.user_id,
+		bridge.get_configuration().userlist.users()))
+
+def test_construction_always_fetches_config(emulator, make_bridge, cache_file):
+	make_bridge(cache_file=cache_file).close()
+	assert emulator.counts['GET config'] == 1
+
+	bridge= make_bridge(cache_file=cache_file)
+	assert emulator.counts['GET config'] == 2
+
+	# Later reads come from the cache
+	bridge.get_configuration()
+	assert emulator.counts['GET config'] == 2
+
+# With a serial number, the live check is the only request, and the full
+# configuration comes from the cache
+
+def test_construction_with_serial_uses_cached_config(emulator, make_bridge,
+	cache_file):
+	serial= emulator.datastore['config']['mac'].replace(':', '')
+
+	make_bridge(cache_file=cache_file, serial=serial).close()
+	assert emulator.counts['GET config'] == 2
+
+	bridge= make_bridge(cache_file=cache_file, serial=serial)
+	assert emulator.counts['GET config'] == 3
+	assert bridge.serial_number() == serial
+	assert 'whitelist' in bridge.cache.config
+
+def test_construction_with_serial_refetches_mismatched_config(emulator,
+	make_bridge, cache_file):
+	serial= emulator.datastore['config']['mac'].replace(':', '')
+
+	bridge= make_bridge(cache_file=cache_file, serial=serial)
+	data= dict(bridge.cache.config)
+	data['mac']= '00:17:88:ff:ff:ff'
+	bridge.cache.update({'config': data})
+	bridge.close()
+	assert emulator.counts['GET config'] == 2
+
+	bridge= make_bridge(cache_file=cache_file, serial=serial)
+	assert emulator.counts['GET config'] == 4
+	assert bridge.serial_number() == serial
+	assert bridge.cache.config['mac'] == emulator.datastore['config']['mac']
+
+def test_construction_fails_when_bridge_is_gone(emulator, make_bridge,
+	cache_file):
+	make_bridge(cache_file=cache_file).close()
+	emulator.stop()
+
+	with pytest.raises(Exception):
+		make_bridge(cache_file=cache_file, timeout=1)
+
+# The pinned serial number check reads the configuration loaded at
+# construction
+
+def test_construction_replaces_cached_config(emulator, make_bridge,
+	cache_file):
+	make_bridge(cache_file=cache_file).close()
+	emulator.datastore['config']['mac']= '00:17:88:ff:ff:ff'
+
+	bridge= make_bridge(cache_file=cache_file)
+	assert bridge.serial_number() == '001788ffffff'
+
+	# The cached copy is current, so it's kept and there's nothing to save
+	assert not bridge.cache.dirty()
+
+	bridge.cache.mark_dirty('config')
+	bridge.close()
+	bridge= make_bridge(cache_file=cache_file)
+	assert bridge.cache.config['mac'] == '00:17:88:ff:ff:ff'
+
+#----------------------------------------------------------------------------
+# Statistics
+#----------------------------------------------------------------------------
+
+def test_cache_stats(make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.get_all_lights()
+	bridge.get_all_lights()
+	bridge.get_light('1')
+
+	stats= bridge.cache_stats()['lights']
+	assert stats['misses'] == 1
+	assert stats['hits'] == 2
+	assert stats['fetches'] == 1
+	assert stats['bytes_saved'] > 0
+
+# Hits on classes that came from the datastore save their share of it
+
+def test_cache_stats_after_refresh_all(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	bridge.refresh_all()
+	bridge.get_all_lights()
+	bridge.get_all_sensors()
+
+	stats= bridge.cache_stats()
+	assert stats['lights']['bytes_saved'] > 0
+	assert stats['sensors']['bytes_saved'] > 0
+	assert (stats['lights']['bytes_saved'] + stats['sensors']['bytes_saved'] <
+		stats['datastore']['fetch_bytes'])
@@ -0,0 +1,391 @@
+import json
+import marshal
+import multiprocessing
+import os
+import os.path
+import pickle
+import time
+import pytest
+from huectl.cache import HueCache
+
+#============================================================================
+# HueCache on its own. Several HueCache objects on the same path stand in
+# for several processes sharing a cache.
+#============================================================================
+
+Lights= {
+	'1': { 'name': 'One', 'state': { 'on': True, 'bri': 10 } },
+	'2': { 'name': 'Two', 'state': { 'on': False, 'bri': 20 } }
+}
+
+Groups= {
+	'1': { 'name': 'Room', 'lights': [ '1', '2' ] }
+}
+
+def new_cache(path):
+	cache= HueCache(path)
+	cache.load()
+	return cache
+
+#----------------------------------------------------------------------------
+# Sharing between processes
+#----------------------------------------------------------------------------
+
+def test_saved_changes_are_seen_by_others(cache_file):
+	a= new_cache(cache_file)
+	b= new_cache(cache_file)
+
+	a.update({ 'lights': Lights })
+	a.save()
+
+	assert b.is_current('lights', interval=60)
+	assert b.lights == Lights
+
+def test_changes_to_different_classes_are_merged(cache_file):
+	a= new_cache(cache_file)
+	b= new_cache(cache_file)
+
+	a.update({ 'lights': Lights })
+	b.update({ 'groups': Groups })
+	a.save()
+	b.save()
+
+	c= new_cache(cache_file)
+	assert c.lights == Lights
+	assert c.groups == Groups
+
+def test_newer_refresh_wins(cache_file):
+	a= new_cache(cache_file)
+	b= new_cache(cache_file)
+
+	a.update({ 'lights': { '1': Lights['1'] } }, timestamp=time.time()-10)
+	b.update({ 'lights': Lights })
+	b.save()
+	a.save()
+
+	assert new_cache(cache_file).lights == Lights
+
+def test_changes_to_different_objects_are_merged(cache_file):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights })
+	a.save()
+
+	b= new_cache(cache_file)
+	c= new_cache(cache_file)
+	b.update_oid('lights', { '1': { 'name': 'B', 'state': dict() } })
+	c.update_oid('lights', { '2': { 'name': 'C', 'state': dict() } })
+	b.save()
+	c.save()
+
+	lights= new_cache(cache_file).lights
+	assert lights['1']['name'] == 'B'
+	assert lights['2']['name'] == 'C'
+
+def _save_scene(path, sceneid):
+	cache= HueCache(path)
+	cache.load()
+	cache.update_oid('scene_attrs', { sceneid: { 'name': sceneid } })
+	cache.save()
+
+def test_concurrent_processes(cache_file):
+	ctx= multiprocessing.get_context('fork')
+	procs= list(map(lambda x: ctx.Process(target=_save_scene,
+		args=(cache_file, f'scene{x}')), range(8)))
+	for proc in procs:
+		proc.start()
+	for proc in procs:
+		proc.join()
+		assert proc.exitcode == 0
+
+	assert sorted(new_cache(cache_file).scene_attrs.keys()) == list(map(
+		lambda x: f'scene{x}', range(8)))
+	assert os.path.exists(cache_file + '.lock')
+
+#----------------------------------------------------------------------------
+# Incremental saves
+#----------------------------------------------------------------------------
+
+# The identity of each file in the cache
+
+def stamps(path):
+	rv= dict()
+	for dirpath, dirnames, filenames in os.walk(path):
+		for name in filenames:
+			st= os.stat(os.path.join(dirpath, name))
+			rv[os.path.relpath(os.path.join(dirpath, name), path)]= (st.st_ino,
+				st.st_mtime_ns)
+
+	return rv
+
+def test_only_changed_segments_are_written(cache_file):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights, 'groups': Groups })
+	a.update_oid('scene_attrs', { 's1': { 'name': 'S1' }, 's2': { 'name': 'S2' } })
+	a.save()
+	before= stamps(cache_file)
+
+	b= new_cache(cache_file)
+	assert not b.dirty()
+	b.lights
+	b.save()
+
+	# Only the disk reads are counted, and those are just appended
+	after= stamps(cache_file)
+	after.pop('_stats.pending')
+	assert after == before
+
+	b.update({ 'lights': Lights })
+	b.update_oid('scene_attrs', { 's2': { 'name': 'Changed' } })
+	assert b.dirty()
+	b.save()
+	assert not b.dirty()
+
+	after= stamps(cache_file)
+	changed= set(filter(lambda x: after[x] != before.get(x), after.keys()))
+	assert changed == { 'lights.json', '_control.json', 'scene_attrs/s2.json',
+		'_stats.json' }
+
+def test_legacy_cache_is_converted(cache_file):
+	with open(cache_file, 'w') as fp:
+		json.dump({ 'lights': Lights, '_control': { 'lastupdated':
+			{ 'lights': time.time() } } }, fp)
+
+	a= new_cache(cache_file)
+	assert a.lights == Lights
+	a.save()
+
+	assert os.path.isdir(cache_file)
+	b= new_cache(cache_file)
+	assert b.lights == Lights
+	assert b.is_current('lights', interval=60)
+
+#----------------------------------------------------------------------------
+# Binary format
+#----------------------------------------------------------------------------
+
+def binary_segment(cache_file, oclass):
+	return os.path.join(cache_file + '.bin', oclass + '.bin')
+
+def write_segment(path, payload, version=HueCache.BinaryVersion):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as fp:
+		fp.write(HueCache.BinaryMagic + bytes([version]) + payload)
+
+def test_binary_round_trip(cache_file):
+	a= new_cache(cache_file + '.bin')
+	a.update({ 'lights': Lights, 'groups': Groups })
+	a.update_oid('scene_attrs', { 's1': { 'name': 'S1' } })
+	a.save()
+
+	b= new_cache(cache_file + '.bin')
+	assert b.lights == Lights
+	assert b.groups == Groups
+	assert b.scene_attrs == { 's1': { 'name': 'S1' } }
+	assert b.is_current('lights', interval=60)
+
+def test_binary_cache_is_seeded_from_json(cache_file):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights })
+	a.save()
+
+	b= new_cache(cache_file + '.bin')
+	assert b.lights == Lights
+	b.save()
+	assert os.path.exists(binary_segment(cache_file, 'lights'))
+
+class Exploit:
+	def __reduce__(self):
+		return (os.system, ('touch ' + Exploit.marker,))
+
+@pytest.mark.parametrize('version', [ 1, HueCache.BinaryVersion ])
+def test_binary_segments_are_not_unpickled(cache_file, tmp_path, version):
+	Exploit.marker= str(tmp_path / 'pwned')
+	path= binary_segment(cache_file, 'lights')
+	write_segment(path, pickle.dumps({ 'x': Exploit() }), version=version)
+
+	assert new_cache(cache_file + '.bin').lights == dict()
+	assert not os.path.exists(Exploit.marker)
+
+@pytest.mark.parametrize('payload', [
+	marshal.dumps(0),
+	marshal.dumps([ 'a', 'b' ]),
+	b'\xff\x00garbage',
+	b''
+])
+def test_bad_binary_segments_are_misses(cache_file, payload):
+	write_segment(binary_segment(cache_file, 'lights'), payload)
+	write_segment(binary_segment(cache_file, '_control'), payload)
+
+	cache= new_cache(cache_file + '.bin')
+	assert cache.lights == dict()
+	assert not cache.is_current('lights')
+
+def test_bad_json_segments_are_misses(cache_file):
+	os.makedirs(os.path.join(cache_file, 'lights.json'))
+	with open(os.path.join(cache_file, 'groups.json'), 'w') as fp:
+		json.dump([ 1, 2, 3 ], fp)
+	with open(os.path.join(cache_file, 'scene_attrs'), 'w') as fp:
+		fp.write('not a directory')
+
+	cache= new_cache(cache_file)
+	assert cache.lights == dict()
+	assert cache.groups == dict()
+	assert cache.scene_attrs == dict()
+
+#----------------------------------------------------------------------------
+# Per-object freshness
+#----------------------------------------------------------------------------
+
+def test_object_freshness(cache_file):
+	cache= new_cache(cache_file)
+	now= time.time()
+	cache.set_ttl('lights', 10)
+	cache.update({ 'lights': Lights }, timestamp=now-20)
+
+	assert not cache.is_current('lights')
+	assert cache.stale_oids('lights') == list()
+
+	cache.update_oid('lights', { '1': Lights['1'] })
+	assert cache.is_current('lights', oid='1')
+	assert not cache.is_current('lights', oid='2')
+
+	cache.mark_dirty('lights', '1')
+	assert not cache.is_current('lights', oid='1')
+	assert cache.stale_oids('lights') == [ '1' ]
+
+def test_object_ttl_overrides_class(cache_file):
+	cache= new_cache(cache_file)
+	cache.set_ttl('lights', 10)
+	cache.set_ttl('lights', 60, oid='2')
+	cache.update({ 'lights': Lights }, timestamp=time.time()-30)
+
+	assert cache.ttl('lights') == 10
+	assert cache.ttl('lights', '2') == 60
+	assert not cache.is_current('lights', oid='1')
+	assert cache.is_current('lights', oid='2')
+
+	cache.set_ttl('lights', None, oid='2')
+	assert cache.ttl('lights', '2') == 10
+
+	with pytest.raises(ValueError):
+		cache.set_ttl('bogus', 10)
+
+def test_object_times_are_saved(cache_file):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights }, timestamp=time.time()-100)
+	a.update_oid('lights', { '2': Lights['2'] })
+	a.save()
+
+	b= new_cache(cache_file)
+	assert b.lastupdate('lights', '2') > b.lastupdate('lights', '1')
+	assert b.is_current('lights', interval=10, oid='2')
+
+#----------------------------------------------------------------------------
+# Adaptive TTLs
+#----------------------------------------------------------------------------
+
+def adaptive_cache(path):
+	cache= new_cache(path)
+	cache.set_ttl('lights', 10)
+	cache.set_adaptive_ttl('lights', 1, 120)
+	return cache
+
+def changed(n):
+	lights= json.loads(json.dumps(Lights))
+	lights['1']['state']['bri']= n
+	return lights
+
+def test_quick_refreshes_without_changes_keep_the_ttl(cache_file):
+	cache= adaptive_cache(cache_file)
+	t= time.time()
+	cache.update({ 'lights': Lights }, timestamp=t)
+	cache.update({ 'lights': Lights }, timestamp=t+0.1)
+	cache.update({ 'lights': Lights }, timestamp=t+0.2)
+
+	assert cache.change_interval('lights') is None
+	assert cache.ttl('lights') == 10
+
+def test_quiet_class_learns_a_longer_ttl(cache_file):
+	cache= adaptive_cache(cache_file)
+	t= time.time()
+	cache.update({ 'lights': Lights }, timestamp=t-100)
+	cache.update({ 'lights': Lights }, timestamp=t)
+
+	assert cache.ttl('lights') == 50
+
+def test_busy_class_learns_a_shorter_ttl(cache_file):
+	cache= adaptive_cache(cache_file)
+	t= time.time()
+	for i in range(10):
+		cache.update({ 'lights': changed(i) }, timestamp=t-120+12*i)
+
+	assert cache.change_interval('lights') == pytest.approx(12)
+	assert cache.ttl('lights') == pytest.approx(6)
+	assert cache.ttl('lights', '1') == pytest.approx(6)
+
+	# Nothing changing for a moment doesn't make it any shorter, but
+	# nothing changing for a while makes it longer
+	cache.update({ 'lights': changed(9) }, timestamp=t-1)
+	assert cache.change_interval('lights') == pytest.approx(12)
+
+	cache.update({ 'lights': changed(9) }, timestamp=t+20)
+	assert cache.change_interval('lights') > 12
+
+#----------------------------------------------------------------------------
+# Statistics
+#----------------------------------------------------------------------------
+
+def test_statistics_alone_are_saved_now_and_then(cache_file, monkeypatch):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights })
+	a.count('lights', hits=1)
+	a.save()
+	before= stamps(cache_file)
+
+	# Counts that aren't due are only appended to the pending statistics
+	b= new_cache(cache_file)
+	b.count('lights', hits=2)
+	assert not b.dirty(stats=True)
+	b.save()
+	after= stamps(cache_file)
+	assert after.pop('_stats.pending') is not None
+	assert after == before
+
+	# They're still reported, by other caches too
+	assert b.stats()['lights']['hits'] == 3
+	assert new_cache(cache_file).stats()['lights']['hits'] == 3
+
+	monkeypatch.setattr(HueCache, 'StatsInterval', 0)
+	assert b.dirty(stats=True)
+	assert not b.dirty()
+	b.save()
+
+	after= stamps(cache_file)
+	assert set(filter(lambda x: after[x] != before[x], after.keys())) == {
+		'_stats.json' }
+	assert '_stats.pending' not in after
+	assert new_cache(cache_file).stats()['lights']['hits'] == 3
+
+# Every run's counts are kept, however often it's saved
+
+def test_statistics_from_every_run_are_kept(cache_file):
+	a= new_cache(cache_file)
+	a.update({ 'lights': Lights })
+	a.save()
+
+	for i in range(3):
+		c= new_cache(cache_file)
+		c.count('lights', hits=1)
+		c.save()
+
+	c= new_cache(cache_file)
+	c.count('lights', misses=1)
+	c.mark_dirty('lights')
+	c.save()
+
+	assert not os.path.exists(os.path.join(cache_file, '_stats.pending'))
+	stats= new_cache(cache_file).stats()['lights']
+	assert (stats['hits'], stats['misses']) == (3, 1)
+
+	c.reset_stats()
+	assert 'lights' not in new_cache(cache_file).stats()
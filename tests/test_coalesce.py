@@ -0,0 +1,89 @@
+import threading
+import time
+from huectl.coalesce import HueStateCoalescer
+from huectl.light import HueLightStateChange
+
+# Stands in for a bridge, and records the commands it's sent
+
+class RecordingBridge:
+	def __init__(self, fail=()):
+		self.sent= list()
+		self.fail= fail
+		self.event= threading.Event()
+
+	def set_light_state(self, lightid, state):
+		self._send('light', lightid, state)
+
+	def set_group_state(self, groupid, state):
+		self._send('group', groupid, state)
+
+	def _send(self, kind, targetid, state):
+		if targetid in self.fail:
+			raise ValueError(targetid)
+
+		self.sent.append((kind, targetid, dict(state)))
+		self.event.set()
+
+def test_changes_within_window_are_merged():
+	bridge= RecordingBridge()
+	coalescer= HueStateCoalescer(bridge, window=0.1)
+
+	coalescer.set_light_state('1', { 'on': True, 'bri': 10 })
+	coalescer.set_light_state('1', { 'bri': 100 })
+	coalescer.set_light_state('1', { 'bri_inc': 20 })
+	coalescer.set_group_state('1', { 'on': False })
+
+	assert coalescer.pending() == 2
+	assert not len(bridge.sent)
+
+	time.sleep(0.3)
+
+	assert sorted(bridge.sent) == [
+		('group', '1', { 'on': False }),
+		('light', '1', { 'on': True, 'bri': 120 })
+	]
+	assert coalescer.submitted == 4
+	assert coalescer.sent == 2
+
+def test_increments_add_up():
+	bridge= RecordingBridge()
+	with HueStateCoalescer(bridge, window=10) as coalescer:
+		change= HueLightStateChange()
+		change.inc_ct(10)
+		coalescer.set_light_state(2, change)
+		coalescer.set_light_state(2, { 'ct_inc': 15 })
+
+	# Closing flushes without waiting for the window
+	assert bridge.sent == [ ('light', '2', { 'ct_inc': 25 }) ]
+
+def test_new_window_after_send():
+	bridge= RecordingBridge()
+	coalescer= HueStateCoalescer(bridge, window=0.05)
+
+	coalescer.set_light_state('1', { 'bri': 1 })
+	assert bridge.event.wait(1)
+	bridge.event.clear()
+
+	coalescer.set_light_state('1', { 'bri': 2 })
+	assert bridge.event.wait(1)
+
+	assert list(map(lambda x: x[2]['bri'], bridge.sent)) == [ 1, 2 ]
+
+def test_errors_are_collected_or_reported():
+	bridge= RecordingBridge(fail=('3',))
+	coalescer= HueStateCoalescer(bridge, window=10)
+	coalescer.set_light_state('3', { 'on': True })
+	coalescer.flush()
+
+	assert len(coalescer.errors) == 1
+	assert coalescer.errors[0][:2] == ('light', '3')
+
+	reported= list()
+	coalescer= HueStateCoalescer(bridge, window=10,
+		on_error=lambda *args: reported.append(args))
+	coalescer.set_group_state('3', { 'on': True })
+	coalescer.flush()
+
+	assert not len(coalescer.errors)
+	assert reported[0][:2] == ('group', '3')
+	assert isinstance(reported[0][3], ValueError)
@@ -0,0 +1,83 @@
+import time
+import pytest
+import huectl.bridge
+import huectl.exception
+from huectl.emulator import HueEmulator
+from conftest import datastore
+
+#============================================================================
+# The emulator itself. Most calls go through emulator.handle(), which
+# returns the HTTP status and the decoded reply.
+#============================================================================
+
+def test_create_user(emulator, make_bridge):
+	bridge= make_bridge()
+	data= { 'devicetype': 'pytest#test', 'generate clientkey': True }
+
+	with pytest.raises(huectl.exception.HueGenericException, match='^101 '):
+		bridge.call('/api', full_uri=True, method='POST', data=data)
+
+	emulator.press_link_button()
+	rv= bridge.call('/api', full_uri=True, method='POST', data=data)
+	assert rv[0]['success']['username'] in emulator.datastore['config']['whitelist']
+	assert len(rv[0]['success']['clientkey']) == 32
+
+	user_id= bridge.create_user('pytest', 'test', client_key=True)
+	assert user_id in emulator.datastore['config']['whitelist']
+
+def test_unknown_user(emulator):
+	status, rv= emulator.handle('GET', '/api/nobody/lights', None)
+	assert status == 200
+	assert rv[0]['error']['type'] == 1
+
+	# The public configuration doesn't need a user
+	status, rv= emulator.handle('GET', '/api/nobody/config', None)
+	assert 'whitelist' not in rv
+	assert rv['mac'] == emulator.datastore['config']['mac']
+
+def test_latency():
+	emu= HueEmulator(datastore(), latency={ 'GET lights/{id}': 0.2, '*': 0 })
+
+	t= time.monotonic()
+	emu.handle('GET', f'/api/{emu.user_id}/lights', None)
+	assert time.monotonic() - t < 0.1
+
+	t= time.monotonic()
+	emu.handle('GET', f'/api/{emu.user_id}/lights/1', None)
+	assert time.monotonic() - t >= 0.2
+
+def test_command_limits():
+	emu= HueEmulator(datastore(), light_rate=1, light_burst=2, group_rate=None)
+	path= f'/api/{emu.user_id}/lights/1/state'
+
+	replies= list(map(lambda x: emu.handle('PUT', path, '{"bri": 10}')[1],
+		range(3)))
+	assert 'success' in replies[0][0]
+	assert 'success' in replies[1][0]
+	assert replies[2][0]['error']['type'] == 901
+
+	# Groups aren't limited
+	for i in range(3):
+		rv= emu.handle('PUT', f'/api/{emu.user_id}/groups/1/action',
+			'{"on": true}')[1]
+		assert 'success' in rv[0]
+
+def test_injected_errors(emulator, make_bridge):
+	bridge= make_bridge()
+
+	emulator.inject_error('ResourceUnavailable', endpoint='lights/{id}',
+		method='GET', count=1)
+	with pytest.raises(huectl.exception.ResourceUnavailable):
+		bridge.get_light('1', use_cache=False)
+	assert bridge.get_light('1', use_cache=False).name == 'Color'
+
+	rule= emulator.inject_error(500, endpoint='groups')
+	status, rv= emulator.handle('GET', f'/api/{emulator.user_id}/groups', None)
+	assert status == 500
+	emulator.remove_error(rule)
+	assert emulator.handle('GET', f'/api/{emulator.user_id}/groups', None)[0] == 200
+
+	with pytest.raises(ValueError):
+		emulator.inject_error('NoSuchError')
+	with pytest.raises(TypeError):
+		emulator.inject_error(1.5)
@@ -0,0 +1,102 @@
+import json
+import pstats
+import pytest
+import time
+
+#============================================================================
+# The huemgr command, run against the emulator
+#============================================================================
+
+def test_light_list(huemgr):
+	rv= huemgr('light')
+
+	assert rv.returncode == 0, rv.stderr
+	assert rv.stdout.splitlines()[0].startswith('1 Color')
+
+#----------------------------------------------------------------------------
+# Profiling
+#----------------------------------------------------------------------------
+
+def test_profile_runs_the_command(huemgr):
+	rv= huemgr('--profile', 'light')
+
+	assert rv.returncode == 0, rv.stderr
+	assert len(rv.stdout.splitlines()) == 3
+	assert 'parse_definition' in rv.stderr
+	assert 'command' in rv.stderr
+
+def test_profile_output(huemgr, tmp_path):
+	path= str(tmp_path / 'light.prof')
+	rv= huemgr('--profile-output', path, 'light')
+
+	assert rv.returncode == 0, rv.stderr
+	assert len(rv.stdout.splitlines()) == 3
+	assert 'command' in rv.stderr
+	assert pstats.Stats(path).total_calls > 0
+
+#----------------------------------------------------------------------------
+# watch
+#----------------------------------------------------------------------------
+
+def test_watch_initial(huemgr):
+	rv= huemgr('watch', '--lights', '--initial', '--count', '3')
+
+	assert rv.returncode == 0, rv.stderr
+	events= list(map(json.loads, rv.stdout.splitlines()))
+	assert list(map(lambda x: (x['type'], x['class'], x['id']), events)) == [
+		('added', 'lights', '1'), ('added', 'lights', '2'),
+		('added', 'lights', '3') ]
+	assert events[0]['new']['name'] == 'Color'
+
+def test_watch_streams_changes(emulator, huemgr):
+	proc= huemgr.start('watch', '--lights', '--light-interval', '0.05',
+		'--type', 'brightness', '--type', 'on', '--count', '2')
+
+	# Change the lights once the baseline has been taken
+	deadline= time.monotonic() + 10
+	while emulator.counts.get('GET lights', 0) < 1:
+		assert time.monotonic() < deadline, proc.stderr.read()
+		time.sleep(0.01)
+
+	lights= emulator.datastore['lights']
+	lights['1']['name']= 'Not reported'
+	lights['2']['state']['bri']= 10
+	time.sleep(0.2)
+	lights['3']['state']['on']= True
+
+	out, err= proc.communicate(timeout=10)
+	assert proc.returncode == 0, err
+
+	events= list(map(json.loads, out.splitlines()))
+	assert list(map(lambda x: (x['type'], x['id'], x['attr'], x['new']),
+		events)) == [ ('brightness', '2', 'state.bri', 10),
+		('on', '3', 'state.on', True) ]
+
+def test_watch_rejects_bad_intervals(huemgr):
+	rv= huemgr('watch', '--interval', '0')
+
+	assert rv.returncode == 1
+	assert 'must be positive' in rv.stdout
+
+def test_watch_adaptive_sensors(huemgr):
+	rv= huemgr('watch', '--sensors', '--adaptive-sensors', '--initial',
+		'--count', '3')
+
+	assert rv.returncode == 0, rv.stderr
+	events= list(map(json.loads, rv.stdout.splitlines()))
+	assert sorted(map(lambda x: (x['type'], x['id']), events)) == [
+		('added', '1'), ('added', '2'), ('added', '3') ]
+
+#----------------------------------------------------------------------------
+# Raw output comes from the bridge, even when the cache is warm
+#----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('command', [ 'sensor', 'rule', 'schedule', 'light',
+	'group', 'scene', 'bridge-config' ])
+def test_raw_output_with_a_warm_cache(emulator, huemgr, command):
+	assert huemgr(command).returncode == 0
+
+	for flag in ('-r', '-R'):
+		rv= huemgr(command, flag)
+		assert rv.returncode == 0, rv.stderr
+		assert isinstance(json.loads(rv.stdout), dict)
@@ -0,0 +1,116 @@
+import json
+import os
+import pytest
+import socket
+import huectl.bridge
+from huectl.metrics import HueMetrics, HueHistogram, endpoint_template
+from huectl.ratelimit import HueCommandScheduler
+
+@pytest.mark.parametrize('endpoint, template', [
+	(None, '/'),
+	('lights', 'lights'),
+	('lights/5/state', 'lights/{id}/state'),
+	('/groups/0/action', 'groups/{id}/action'),
+	('lights/new', 'lights/new'),
+	('config', 'config')
+])
+def test_endpoint_template(endpoint, template):
+	assert endpoint_template(endpoint) == template
+
+def test_histogram():
+	hist= HueHistogram((1, 2, 4))
+	assert hist.quantile(0.5) is None
+
+	for value in (0.5, 1.5, 1.5, 3, 10):
+		hist.observe(value)
+
+	assert hist.count == 5
+	assert hist.sum == 16.5
+	assert hist.cumulative() == [ (1, 1), (2, 3), (4, 4), (float('inf'), 5) ]
+	assert hist.quantile(0.5) == pytest.approx(1.75)
+	assert hist.quantile(0.99) == 4
+
+#----------------------------------------------------------------------------
+# Call hooks
+#----------------------------------------------------------------------------
+
+def test_hooks_see_every_call(emulator, make_bridge):
+	calls= list()
+	bridge= make_bridge()
+
+	def broken(*args):
+		raise RuntimeError('hook')
+
+	bridge.add_call_hook(broken)
+	bridge.add_call_hook(lambda *args: calls.append(args))
+
+	bridge.get_all_lights()
+	emulator.inject_error(503, endpoint='groups')
+	with pytest.raises(Exception):
+		bridge.get_all_groups()
+
+	endpoint, method, status, nbytes, parse_time, latency= calls[0]
+	assert (endpoint, method, status) == ('lights', 'GET', 200)
+	assert nbytes > 100
+	assert 0 <= parse_time <= latency
+
+	assert calls[1][:3] == ('groups', 'GET', 503)
+
+	bridge.remove_call_hook(broken)
+	assert len(bridge.call_hooks) == 1
+
+# Stands in for HueMetrics, and keeps the calls it's sent
+
+class Calls(list):
+	def attach(self, bridge):
+		bridge.add_call_hook(lambda *args: self.append(args))
+
+def test_unreachable_bridge_has_no_status():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		address= '127.0.0.1:%d' % sock.getsockname()[1]
+
+	calls= Calls()
+	with pytest.raises(Exception):
+		huectl.bridge.HueBridge(address, user_id='test', proto='http',
+			timeout=1, metrics=calls)
+
+	assert calls[0][:3] == ('config', 'GET', None)
+
+#----------------------------------------------------------------------------
+# HueMetrics
+#----------------------------------------------------------------------------
+
+def test_metrics(make_bridge, tmp_path):
+	metrics= HueMetrics()
+	bridge= make_bridge(metrics=metrics,
+		scheduler=HueCommandScheduler(light_rate=100))
+
+	bridge.get_light('1')
+	bridge.get_light('2')
+	bridge.set_light_state('1', { 'on': True })
+
+	d= metrics.as_dict()
+	endpoints= dict(map(lambda x: ((x['endpoint'], x['method']), x),
+		d['endpoints']))
+	assert endpoints[('lights/{id}', 'GET')]['statuses'] == { '200': 2 }
+	assert endpoints[('lights/{id}', 'GET')]['latency']['count'] == 2
+	assert endpoints[('lights/{id}/state', 'PUT')]['statuses'] == { '200': 1 }
+	assert d['scheduler']['light']['commands'] == 1
+
+	text= metrics.prometheus()
+	assert 'hue_requests_total{endpoint="lights/{id}",method="GET",status="200"} 2' in text
+	assert 'hue_request_duration_seconds_bucket{endpoint="lights/{id}",method="GET",le="+Inf"} 2' in text
+	assert 'hue_commands_total{kind="light"} 1' in text
+
+	path= str(tmp_path / 'hue.prom')
+	metrics.write_prometheus(path)
+	metrics.write_json(str(tmp_path / 'hue.json'))
+	with open(path) as fp:
+		assert fp.read() == text
+	with open(tmp_path / 'hue.json') as fp:
+		assert json.load(fp)['scheduler']['light']['commands'] == 1
+	assert sorted(os.listdir(tmp_path)) == [ 'hue.json', 'hue.prom' ]
+
+	metrics.clear()
+	assert metrics.as_dict()['endpoints'] == list()
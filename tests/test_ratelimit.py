@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+import pytest
+from huectl.ratelimit import HueTokenBucket, HueCommandScheduler
+
+def test_bucket_rejects_bad_parameters():
+	with pytest.raises(ValueError):
+		HueTokenBucket(0)
+	with pytest.raises(ValueError):
+		HueTokenBucket(10, burst=0)
+
+def test_burst_then_paced():
+	bucket= HueTokenBucket(20, burst=3)
+
+	waits= list(map(lambda x: bucket.reserve(), range(5)))
+
+	# The burst goes straight through, and the rest are spaced out by
+	# the interval
+	assert waits[:3] == [ 0, 0, 0 ]
+	assert waits[3] == pytest.approx(0.05, abs=0.01)
+	assert waits[4] == pytest.approx(0.10, abs=0.01)
+
+	stats= bucket.stats()
+	assert stats['commands'] == 5
+	assert stats['delayed'] == 2
+	assert stats['max_wait'] == pytest.approx(0.10, abs=0.01)
+
+def test_acquire_paces_threads():
+	bucket= HueTokenBucket(50)
+	times= list()
+	lock= threading.Lock()
+
+	def worker():
+		bucket.acquire()
+		with lock:
+			times.append(time.monotonic())
+
+	threads= list(map(lambda x: threading.Thread(target=worker), range(6)))
+	t= time.monotonic()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	# Six commands at 50 per second take at least five intervals
+	assert max(times) - t >= 5/50 - 0.005
+	assert bucket.queued == 0
+
+def test_acquire_async():
+	bucket= HueTokenBucket(50)
+
+	async def main():
+		t= time.monotonic()
+		await asyncio.gather(*map(lambda x: bucket.acquire_async(), range(4)))
+		return time.monotonic() - t
+
+	assert asyncio.run(main()) >= 3/50 - 0.005
+
+def test_scheduler_kinds():
+	scheduler= HueCommandScheduler(light_rate=10, group_rate=None)
+
+	assert scheduler.acquire(HueCommandScheduler.Light) == 0
+	assert scheduler.wait_time(HueCommandScheduler.Light) > 0
+
+	# Groups aren't paced
+	for i in range(5):
+		assert scheduler.acquire(HueCommandScheduler.Group) == 0
+	assert scheduler.wait_time(HueCommandScheduler.Group) == 0
+
+	assert list(scheduler.stats().keys()) == [ HueCommandScheduler.Light ]
+
+	with pytest.raises(ValueError):
+		scheduler.acquire('sensor')
+
+def test_bridge_paces_light_commands(make_bridge):
+	bridge= make_bridge(scheduler=HueCommandScheduler(light_rate=20))
+
+	t= time.monotonic()
+	for i in range(4):
+		bridge.set_light_state('1', { 'bri': 100+i })
+
+	assert time.monotonic() - t >= 3/20 - 0.005
+	assert bridge.scheduler.stats()['light']['commands'] == 4
@@ -0,0 +1,153 @@
+import copy
+import pytest
+import huectl.bridge
+import huectl.exception
+import huectl.sensorpoll
+from huectl.sensorpoll import HueSensorScheduler
+from huectl.watch import HueWatcher, HueEvent
+from conftest import datastore
+
+# Stands in for a bridge without a cache, and records what it's asked for
+
+class FakeBridge:
+	cache= None
+
+	def __init__(self):
+		self.sensors= datastore()['sensors']
+		self.calls= list()
+		self.error= None
+
+	# Like a cached bridge, hand out the data we keep rather than a copy
+
+	def fetch(self, oclass, oid=None):
+		self.calls.append(oclass if oid is None else f'{oclass}/{oid}')
+		if self.error is not None:
+			raise self.error
+
+		if oid is None:
+			return self.sensors
+
+		if oid not in self.sensors:
+			raise huectl.exception.ResourceUnavailable(f'{oclass}/{oid}')
+
+		return self.sensors[oid]
+
+# A clock that only moves when told to
+
+class Clock:
+	def __init__(self):
+		self.now= 1000.0
+
+	def monotonic(self):
+		return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock= Clock()
+	monkeypatch.setattr(huectl.sensorpoll, 'time', clock)
+	return clock
+
+def press(bridge, sensorid, n):
+	bridge.sensors[sensorid]['state']['lastupdated']= f'2020-01-01T00:00:{n:02d}'
+
+def test_first_poll_fetches_every_sensor(clock):
+	bridge= FakeBridge()
+	scheduler= HueSensorScheduler(bridge)
+
+	changed, wait= scheduler.poll_due()
+	assert sorted(changed) == [ '1', '2', '3' ]
+	assert bridge.calls == [ 'sensors' ]
+	assert wait == pytest.approx(0.25)
+
+	# Each sensor gets the interval for its type
+	assert scheduler.interval('1') == 0.25
+	assert scheduler.interval('2') == 60
+	assert scheduler.interval('3') == 300
+
+def test_idle_sensors_back_off(clock):
+	bridge= FakeBridge()
+	scheduler= HueSensorScheduler(bridge)
+	changed, wait= scheduler.poll_due()
+
+	intervals= list()
+	for i in range(8):
+		clock.now+= wait
+		changed, wait= scheduler.poll_due()
+		assert not len(changed)
+		intervals.append(scheduler.interval('1'))
+
+	assert intervals[:3] == [ 0.375, 0.5625, 0.84375 ]
+	assert intervals[-1] == 0.25*HueSensorScheduler.MaxBackoff
+	assert set(bridge.calls[1:]) == { 'sensors/1' }
+
+	# A button press brings it straight back
+	press(bridge, '1', 5)
+	clock.now+= wait
+	changed, wait= scheduler.poll_due()
+	assert changed == [ '1' ]
+	assert scheduler.interval('1') == 0.25
+
+def test_sensors_due_together_are_batched(clock):
+	bridge= FakeBridge()
+	scheduler= HueSensorScheduler(bridge, intervals={ 'ZLLTemperature': 0.3 })
+	scheduler.poll_due()
+
+	clock.now+= 0.25
+	scheduler.poll_due()
+	assert bridge.calls == [ 'sensors', 'sensors' ]
+	assert scheduler.stats() == { 'sensors': 3, 'batch_polls': 2,
+		'single_polls': 0, 'changes': 3 }
+
+def test_removed_sensors(clock):
+	bridge= FakeBridge()
+	scheduler= HueSensorScheduler(bridge)
+	seen= list()
+	scheduler.subscribe(lambda *args: seen.append(args))
+	scheduler.poll_due()
+	seen.clear()
+
+	# On its own
+	del bridge.sensors['1']
+	clock.now+= 0.25
+	assert scheduler.poll_due()[0] == [ '1' ]
+	assert seen[0][0] == '1' and seen[0][2] is None
+
+	# In a batch
+	del bridge.sensors['2']
+	scheduler.schedule['3'][0]= clock.now
+	scheduler.schedule['2'][0]= clock.now
+	assert scheduler.poll_due()[0] == [ '2' ]
+	assert sorted(scheduler.sensors.keys()) == [ '3' ]
+
+def test_poll_errors(clock):
+	bridge= FakeBridge()
+	scheduler= HueSensorScheduler(bridge)
+	scheduler.poll_due()
+	scheduler.schedule['1'][1]= 4
+
+	bridge.error= huectl.exception.InternalError('busy')
+	clock.now+= 1
+	changed, wait= scheduler.poll_due()
+
+	assert changed == list()
+	assert len(scheduler.poll_errors) == 1
+	assert wait == pytest.approx(0.25)
+
+def test_watcher_uses_the_scheduler(emulator, make_bridge):
+	bridge= make_bridge()
+	scheduler= HueSensorScheduler(bridge)
+	watcher= HueWatcher(bridge, sensor_scheduler=scheduler,
+		intervals={ 'lights': None, 'groups': None })
+	assert watcher.intervals == dict()
+
+	events, wait= watcher.poll_due()
+	assert events == list()
+	assert 'sensors' in watcher.snapshot
+
+	emulator.datastore['sensors']['2']['state']['temperature']= 2500
+	scheduler.schedule['2'][0]= 0
+	events, wait= watcher.poll_due()
+
+	assert list(map(lambda x: (x.type, x.oid, x.new), events)) == [
+		(HueEvent.SensorState, '2', 2500) ]
+	assert emulator.counts['GET sensors/{id}'] == 1
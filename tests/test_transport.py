@@ -0,0 +1,69 @@
+import json
+import pytest
+import huectl.bridge
+import huectl.exception
+from huectl.transport import HueRecorder, HueReplayer
+
+#============================================================================
+# Recording calls to the emulator and replaying them
+#============================================================================
+
+# Real user ids are 40 characters
+Me= '5b0e7d4a1c9f2e8b3a6d0c7f4e1b8a5d2c9f6e3b'
+Other= 'a8d0c3f1e9b24c6d8f0e1a2b3c4d5e6f7a8b9c0d'
+
+@pytest.fixture
+def recording(emulator, make_bridge, tmp_path):
+	whitelist= emulator.datastore['config']['whitelist']
+	whitelist[Me]= dict(whitelist[emulator.user_id])
+	whitelist[Other]= dict(whitelist[emulator.user_id])
+	emulator.datastore['scenes']['scene00000001']['owner']= Other
+
+	path= str(tmp_path / 'calls.rec')
+	bridge= make_bridge(user_id=Me, transport=HueRecorder(path))
+	bridge.get_all_lights()
+	bridge.get_all_scenes()
+	bridge.set_light_state('1', { 'bri': 10 })
+
+	emulator.press_link_button()
+	rv= bridge.call('/api', full_uri=True, method='POST',
+		data={ 'devicetype': 'pytest#test', 'generate clientkey': True })
+	bridge.close()
+
+	return path, rv[0]['success']
+
+def test_credentials_are_redacted(emulator, recording):
+	path, created= recording
+	with open(path) as fp:
+		text= fp.read()
+
+	for secret in (Me, Other, created['username'],
+		created['clientkey']):
+		assert secret not in text
+
+	records= list(map(json.loads, text.splitlines()))
+	config= json.loads(records[0]['text'])
+	assert sorted(config['whitelist'].keys()) == [ '{user1}', '{user2}',
+		'{user}' ]
+	assert records[0]['path'] == '/api/{user}/config'
+
+	scenes= json.loads(records[2]['text'])
+	assert scenes['scene00000001']['owner'] == '{user2}'
+
+	created= json.loads(records[-1]['text'])[0]['success']
+	assert created == { 'username': '{user3}', 'clientkey': '{clientkey}' }
+
+def test_replay_with_another_user(recording):
+	path, created= recording
+	bridge= huectl.bridge.HueBridge('192.0.2.1', user_id='replayinguser',
+		proto='http', transport=HueReplayer(path, latency_scale=0))
+	try:
+		users= sorted(map(lambda x: x.user_id, bridge.userlist().users()))
+		assert users == [ 'replayinguser', '{user1}', '{user2}' ]
+		assert bridge.get_all_lights(use_cache=False)['1'].name == 'Color'
+		assert bridge.set_light_state('1', { 'bri': 10 })
+
+		with pytest.raises(huectl.exception.NotRecorded):
+			bridge.get_all_groups()
+	finally:
+		bridge.close()
@@ -0,0 +1,140 @@
+import threading
+import huectl.bridge
+from huectl.watch import HueWatcher, HueEvent
+
+def events_of(events):
+	return list(map(lambda x: (x.type, x.oclass, x.oid, x.attr), events))
+
+def test_first_poll_is_a_baseline(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge())
+	assert watcher.poll('lights') == list()
+
+	watcher= HueWatcher(make_bridge(), initial=True)
+	events= watcher.poll('lights')
+	assert events_of(events) == [ (HueEvent.Added, 'lights', oid, None)
+		for oid in ('1', '2', '3') ]
+	assert events[0].new['name'] == 'Color'
+
+def test_light_events(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge())
+	watcher.poll('lights')
+
+	lights= emulator.datastore['lights']
+	lights['1']['state']['bri']= 10
+	lights['2']['state']['ct']= 400
+	lights['3']['state']['on']= True
+	lights['3']['state']['reachable']= False
+	lights['1']['name']= 'Renamed'
+
+	events= watcher.poll('lights')
+	assert sorted(events_of(events)) == sorted([
+		(HueEvent.Brightness, 'lights', '1', 'state.bri'),
+		(HueEvent.Changed, 'lights', '1', 'name'),
+		(HueEvent.Color, 'lights', '2', 'state.ct'),
+		(HueEvent.On, 'lights', '3', 'state.on'),
+		(HueEvent.Unreachable, 'lights', '3', 'state.reachable')
+	])
+
+	bri= list(filter(lambda x: x.attr == 'state.bri', events))[0]
+	assert (bri.old, bri.new) == (254, 10)
+	assert bri.as_dict()['class'] == 'lights'
+
+	del lights['3']
+	assert events_of(watcher.poll('lights')) == [ (HueEvent.Removed, 'lights',
+		'3', None) ]
+
+def test_group_events(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge())
+	watcher.poll('groups')
+
+	emulator.handle('PUT', f'/api/{emulator.user_id}/groups/1/action',
+		'{"on": false}')
+
+	assert (HueEvent.Off, 'groups', '1', 'state.any_on') in events_of(
+		watcher.poll('groups'))
+
+def test_sensor_events(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge())
+	watcher.poll('sensors')
+
+	sensors= emulator.datastore['sensors']
+	# The same button pressed again
+	sensors['1']['state']['lastupdated']= '2020-01-01T00:00:05'
+	sensors['2']['state']['temperature']= 2100
+
+	assert sorted(events_of(watcher.poll('sensors'))) == sorted([
+		(HueEvent.Button, 'sensors', '1', 'state.buttonevent'),
+		(HueEvent.SensorState, 'sensors', '2', 'state.temperature')
+	])
+
+def test_subscriptions(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge())
+	seen= list()
+
+	def broken(event):
+		raise RuntimeError('callback')
+
+	watcher.subscribe(broken)
+	sub= watcher.subscribe(seen.append, types=HueEvent.Brightness,
+		oclass='lights', oid=[ '2', '3' ])
+	watcher.poll('lights')
+
+	for light in emulator.datastore['lights'].values():
+		light['state']['bri']= 1
+	emulator.datastore['lights']['2']['state']['on']= False
+	watcher.poll('lights')
+
+	assert events_of(seen) == [
+		(HueEvent.Brightness, 'lights', '2', 'state.bri'),
+		(HueEvent.Brightness, 'lights', '3', 'state.bri')
+	]
+	assert len(watcher.callback_errors) == 4
+
+	watcher.unsubscribe(sub)
+	emulator.datastore['lights']['2']['state']['bri']= 2
+	watcher.poll('lights')
+	assert len(seen) == 2
+
+def test_polls_keep_the_cache_current(emulator, make_bridge, cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	watcher= HueWatcher(bridge)
+	watcher.poll('lights')
+	n= emulator.counts['GET lights']
+
+	emulator.datastore['lights']['1']['state']['bri']= 10
+	watcher.poll('lights')
+	assert bridge.get_all_lights()['1'].lightstate.bri == 10
+	assert emulator.counts['GET lights'] == n+1
+
+# Changes written through the cache mustn't change the watcher's snapshot
+
+def test_changes_made_through_a_cached_bridge(emulator, make_bridge,
+	cache_file):
+	bridge= make_bridge(cache_file=cache_file)
+	watcher= HueWatcher(bridge)
+	watcher.poll('lights')
+
+	bridge.set_light_state('3', { 'on': True })
+	assert (HueEvent.On, 'lights', '3', 'state.on') in events_of(
+		watcher.poll('lights'))
+
+def test_background_thread(emulator, make_bridge):
+	watcher= HueWatcher(make_bridge(), intervals={ 'lights': 0.05,
+		'groups': None, 'sensors': None })
+	assert list(watcher.intervals.keys()) == [ 'lights' ]
+
+	done= threading.Event()
+	watcher.subscribe(lambda event: done.set(), types=HueEvent.On)
+	watcher.start()
+	try:
+		# Wait for the baseline before changing anything
+		while 'lights' not in watcher.snapshot:
+			done.wait(0.01)
+
+		emulator.datastore['lights']['3']['state']['on']= True
+		assert done.wait(5)
+	finally:
+		watcher.stop()
+
+	assert watcher.thread is None
+	assert not len(watcher.poll_errors)